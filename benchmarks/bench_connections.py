@@ -0,0 +1,151 @@
+"""Benchmark how many Socket.IO connections one server process holds.
+
+Starts a single chatroomsite.py process in ``--mode`` on a scratch
+database, then opens websocket clients in steps of ``--step`` up to
+``--clients``. After each step it waits ``--idle`` seconds and reports the
+server's resident memory and CPU use with every socket idle. It stops early
+once connections start failing. Then ``--active`` of the sockets join one
+room, ``--senders`` of them post for ``--duration`` seconds while the rest
+stay connected, and the delivered copies, their latency and the server's
+CPU use are reported:
+
+    pip install "python-socketio[asyncio_client]"
+    python benchmarks/bench_connections.py --mode gevent --clients 5000 --step 1000
+
+The clients run in this process; on a small machine they compete with the
+server for CPU, so the active figures are a lower bound. Run it with
+``--source`` pointed at an older checkout for the before figure (see
+harness.py); revisions without async modes ignore ``--mode``.
+"""
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from harness import REPO, argument_parser
+
+sys.path.insert(0, REPO)
+import socketio  # noqa: E402
+from loadtest import Run, percentile, send_messages, session_cookie, wait_for_port  # noqa: E402
+
+TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def server_usage(pid):
+    """(resident MiB, CPU seconds) of process ``pid``."""
+    with open(f'/proc/{pid}/status') as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:')) / 1024
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return rss, (int(fields[11]) + int(fields[12])) / TICKS
+
+
+def start_server(source, mode, port):
+    work = tempfile.mkdtemp(prefix='chatroom-bench-')
+    os.makedirs(os.path.join(work, 'static', 'avatars'))
+    env = dict(os.environ, CHATROOM_DB=os.path.join(work, 'chatroom.db'), CHATROOM_ASYNC_MODE=mode,
+               CHATROOM_LOGIN_IP_BURST='1000000', CHATROOM_MESSAGE_RATE='1000', CHATROOM_MESSAGE_BURST='1000')
+    server = subprocess.Popen([sys.executable, os.path.join(source, 'chatroomsite.py'), '--host', '127.0.0.1',
+                               '--port', str(port)], cwd=work, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port, 30)
+    return server
+
+
+async def connect(run, url, cookie, gate, received):
+    # sockets join no room until the active phase: every join is announced to the whole room
+    client = socketio.AsyncClient(reconnection=False)
+
+    @client.on('message')
+    async def on_message(message):
+        received[0] += 1
+        run.received(message.get('text') or '')
+
+    async with gate:
+        try:
+            await client.connect(url, headers={'Cookie': cookie}, transports=['websocket'], wait_timeout=10)
+        except Exception as error:
+            run.connect_errors += 1
+            print(f'connect failed: {error}', file=sys.stderr)
+            return None
+    return client
+
+
+async def measure(args, server, url):
+    run = Run()
+    cookie = session_cookie(url, 'bench')
+    gate = asyncio.Semaphore(args.connect_concurrency)
+    clients = []
+    received = [0]
+    baseline, _ = server_usage(server.pid)
+    print(f'{args.mode}: {baseline:.0f} MiB before any connection')
+    while len(clients) < args.clients:
+        batch = min(args.step, args.clients - len(clients))
+        started = time.monotonic()
+        opened = await asyncio.gather(*(connect(run, url, cookie, gate, received) for _ in range(batch)))
+        clients += [client for client in opened if client is not None]
+        connect_seconds = time.monotonic() - started
+        _, cpu_before = server_usage(server.pid)
+        await asyncio.sleep(args.idle)
+        rss, cpu_after = server_usage(server.pid)
+        print(f'{len(clients):6} idle  {rss:7.0f} MiB  {(rss - baseline) * 1024 / len(clients):6.1f} KiB/conn  '
+              f'{(cpu_after - cpu_before) / args.idle * 100:5.1f}% CPU  connected in {connect_seconds:.1f}s')
+        if run.connect_errors:
+            print(f'{run.connect_errors} connections failed, stopping here')
+            break
+    active = clients[:args.active]
+    for client in active:
+        await client.emit('joinRoom', {'roomId': 'public'})
+    # wait out the "joined the room" announcements, which grow with the square of the room size
+    while True:
+        before = received[0]
+        await asyncio.sleep(1)
+        if received[0] == before:
+            break
+    _, cpu_before = server_usage(server.pid)
+    started = time.monotonic()
+    await asyncio.gather(*(send_messages(run, client, 'public', args.rate, args.duration)
+                           for client in active[:args.senders]))
+    await asyncio.sleep(args.drain)
+    rss, cpu_after = server_usage(server.pid)
+    latencies = sorted(run.latencies)
+    expected = run.sent * len(active)
+    print(f'{len(active):6} active of {len(clients)}, {args.senders} senders x {args.rate}/s: '
+          f'delivered {len(latencies)}/{expected}  {rss:.0f} MiB  '
+          f'{(cpu_after - cpu_before) / (time.monotonic() - started) * 100:.1f}% CPU')
+    if latencies:
+        print('latency ms: ' + ' '.join(f'{name} {percentile(latencies, fraction) * 1000:.1f}'
+                                        for name, fraction in (('p50', .5), ('p99', .99), ('max', 1))))
+    await asyncio.gather(*(client.disconnect() for client in clients))
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--mode', default='gevent', choices=('threading', 'gevent', 'eventlet'))
+    parser.add_argument('--clients', type=int, default=2000)
+    parser.add_argument('--step', type=int, default=500)
+    parser.add_argument('--idle', type=float, default=5, help='seconds idle after each step')
+    parser.add_argument('--active', type=int, default=500, help='sockets that join the room for the active phase')
+    parser.add_argument('--senders', type=int, default=5)
+    parser.add_argument('--rate', type=float, default=1, help='messages per second per sender')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--drain', type=float, default=3)
+    parser.add_argument('--connect-concurrency', type=int, default=20)
+    parser.add_argument('--port', type=int, default=5700)
+    args = parser.parse_args()
+    # every client costs a descriptor here and one in the server
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    server = start_server(os.path.abspath(args.source), args.mode, args.port)
+    try:
+        asyncio.run(measure(args, server, f'http://127.0.0.1:{args.port}'))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    main()
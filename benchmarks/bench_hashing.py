@@ -0,0 +1,62 @@
+"""Benchmark successful logins per second, per hashing core.
+
+Registers one account, then ``--clients`` threads log into it
+``--logins`` times in total through the Flask test client. The hashing
+pool gets ``--workers`` processes (one by default, so the figure is per
+core) and hashes with ``--method``, or the configured
+CHATROOM_PASSWORD_HASH_METHOD when it is not given:
+
+    python benchmarks/bench_hashing.py --logins 50
+    python benchmarks/bench_hashing.py --method pbkdf2:sha256:600000 --workers 2
+
+Run it with ``--source`` pointed at an older checkout for the before
+figure (see harness.py); revisions that hash on the request thread ignore
+``--workers``.
+"""
+import threading
+
+from harness import argument_parser, load_chatroomsite, signed_in_client, timed
+
+
+def log_in(cs, clients, logins):
+    statuses = {}
+    lock = threading.Lock()
+
+    def run(count):
+        client = cs.app.test_client()
+        for _ in range(count):
+            status = client.post('/login', json={'username': 'bench', 'password': 'bench-password'}).status_code
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=run, args=(logins // clients + (index < logins % clients),))
+               for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--logins', type=int, default=50)
+    parser.add_argument('--workers', type=int, default=1, help='hashing processes')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent login threads')
+    parser.add_argument('--method', help='werkzeug hash method, e.g. scrypt:32768:8:1')
+    args = parser.parse_args()
+    env = {'CHATROOM_PASSWORD_WORKERS': str(args.workers), 'CHATROOM_LOGIN_ACCOUNT_BURST': '1000000'}
+    if args.method:
+        env['CHATROOM_PASSWORD_HASH_METHOD'] = args.method
+    cs = load_chatroomsite(args.source, **env)
+    signed_in_client(cs, 'bench')
+    log_in(cs, 1, 2)   # start the pool processes
+    seconds, statuses = timed(log_in, cs, args.clients, args.logins)
+    method = cs.app.config.get('PASSWORD_HASH_METHOD', 'werkzeug default')
+    print(f'{method}, {args.workers} hashing workers, {args.clients} clients')
+    print(f'{args.logins / seconds:8.1f} logins/s  {args.logins / seconds / args.workers:8.1f} per worker  '
+          f'statuses {statuses}')
+
+
+if __name__ == '__main__':
+    main()
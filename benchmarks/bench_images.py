@@ -0,0 +1,57 @@
+"""Benchmark image processing throughput per core.
+
+Writes ``--images`` synthetic photos of ``--width`` x ``--height`` and runs
+them through the image pool with ``--workers`` processes (one by default,
+so the figure is per core), once as avatars and once as upload previews.
+It reports images per second from submit to the last variant on disk:
+
+    python benchmarks/bench_images.py --images 40
+    python benchmarks/bench_images.py --workers 2 --width 4000 --height 3000
+
+Needs Pillow. Only revisions with the image pool can be measured.
+"""
+import os
+import random
+from concurrent.futures import wait
+
+from PIL import Image
+
+from harness import argument_parser, load_chatroomsite, timed
+
+
+def synthetic_photo(path, width, height, seed):
+    # noise compresses like a photo, unlike a flat colour
+    rng = random.Random(seed)
+    small = Image.frombytes('RGB', (width // 8, height // 8), rng.randbytes(width // 8 * (height // 8) * 3))
+    small.resize((width, height), Image.BILINEAR).save(path, 'JPEG', quality=90)
+
+
+def process_all(cs, paths, sizes, crop):
+    futures = [cs.image_pipeline.submit(path, sizes, crop) for path in paths]
+    wait(futures)
+    return sum(future.exception() is not None for future in futures)
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=1, help='image processes')
+    parser.add_argument('--width', type=int, default=2048)
+    parser.add_argument('--height', type=int, default=1536)
+    args = parser.parse_args()
+    cs = load_chatroomsite(args.source, CHATROOM_IMAGE_WORKERS=str(args.workers))
+    os.makedirs('photos')
+    paths = [os.path.abspath(f'photos/{index}.jpg') for index in range(args.images)]
+    for index, path in enumerate(paths):
+        synthetic_photo(path, args.width, args.height, index)
+    process_all(cs, paths[:args.workers], cs.UPLOAD_PREVIEW_SIZES, False)   # start the pool processes
+    print(f'{args.images} images of {args.width}x{args.height}, {args.workers} image workers')
+    for name, sizes, crop in (('avatars', cs.AVATAR_SIZES, True), ('previews', cs.UPLOAD_PREVIEW_SIZES, False)):
+        seconds, failed = timed(process_all, cs, paths, sizes, crop)
+        print(f'{name:9} {args.images / seconds:7.1f} images/s  {args.images / seconds / args.workers:7.1f} per worker  '
+              f'{failed} failed')
+    cs.image_pipeline.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Benchmark requests per second for the chat page at ``/``.
+
+Measures a signed-out visitor, a signed-in user, and a signed-in user
+revalidating with the ETag of their last response (a 304 where the page
+supports it), each over ``--requests`` sequential requests through the
+Flask test client:
+
+    python benchmarks/bench_page.py --requests 2000
+
+Run it with ``--source`` pointed at an older checkout for the before
+figure (see harness.py).
+"""
+from harness import argument_parser, load_chatroomsite, signed_in_client, timed
+
+
+def hammer(client, requests, headers=None):
+    statuses = {}
+    for _ in range(requests):
+        status = client.get('/', headers=headers or {}).status_code
+        statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+    cs = load_chatroomsite(args.source)
+    signed_in = signed_in_client(cs, 'bench')
+    etag = signed_in.get('/').headers.get('ETag')
+    cases = [('signed out', cs.app.test_client(), None), ('signed in', signed_in, None)]
+    if etag:
+        cases.append(('revalidated', signed_in, {'If-None-Match': etag}))
+    for name, client, headers in cases:
+        hammer(client, 20, headers)   # warm caches
+        seconds, statuses = timed(hammer, client, args.requests, headers)
+        print(f'{name:12} {args.requests / seconds:8.0f} req/s  statuses {statuses}')
+
+
+if __name__ == '__main__':
+    main()
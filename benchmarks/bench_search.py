@@ -0,0 +1,59 @@
+"""Benchmark /search over a large synthetic corpus.
+
+Fills a scratch database with ``--rows`` room messages from
+search_corpus.py (a million by default; generating them takes a few
+minutes), then times ``--queries`` requests each for a very common, a
+middling and a rare word, two words together and a three-letter prefix.
+For comparison it also times the substring scan a search without the
+full-text index needs:
+
+    python benchmarks/bench_search.py
+    python benchmarks/bench_search.py --rows 100000 --queries 50
+
+Revisions without /search only get the scan figures.
+"""
+import sqlite3
+import statistics
+import time
+
+from harness import argument_parser, load_chatroomsite, signed_in_client, timed
+from search_corpus import fill, vocabulary
+
+
+def time_requests(client, params, queries):
+    durations, statuses = [], {}
+    for _ in range(queries):
+        started = time.perf_counter()
+        status = client.get('/search', query_string=params).status_code
+        durations.append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+    return durations, statuses
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=100, help='requests per search')
+    args = parser.parse_args()
+    cs = load_chatroomsite(args.source)
+    client = signed_in_client(cs, 'bench')
+    database = cs.app.config.get('DATABASE', 'chatroom.db')
+    seconds, _ = timed(fill, database, args.rows)
+    print(f'{args.rows} messages generated and indexed in {seconds:.0f}s')
+    words = vocabulary()
+    searches = [('common word', words[0]), ('middling word', words[99]), ('rare word', words[9999]),
+                ('two words', f'{words[4]} {words[49]}'), ('prefix', words[20][:3])]
+    for name, text in searches:
+        durations, statuses = time_requests(client, {'q': text}, args.queries)
+        durations.sort()
+        print(f'{name:14} {statistics.mean(durations) * 1000:8.1f} ms mean  '
+              f'{durations[int(len(durations) * 0.95) - 1] * 1000:8.1f} ms p95  statuses {statuses}')
+    conn = sqlite3.connect(database)
+    for name, text in (('common word', words[0]), ('rare word', words[9999])):
+        seconds, _ = timed(lambda: conn.execute('SELECT id FROM messages WHERE text LIKE ? ORDER BY id DESC LIMIT 20',
+                                                (f'%{text}%',)).fetchall())
+        print(f'LIKE scan, {name:11} {seconds * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Benchmark sendMessage throughput with concurrent Socket.IO clients.
+
+Each of ``--clients`` threads drives its own in-process Socket.IO test
+client in the public room and emits ``--messages`` messages. It reports
+messages per second for the emits alone and until every row is committed,
+then checks that the row count matches:
+
+    python benchmarks/bench_send.py --clients 8 --messages 500
+
+Run it with ``--source`` pointed at an older checkout for the before
+figure (see harness.py).
+"""
+import sqlite3
+import threading
+
+from harness import argument_parser, load_chatroomsite, signed_in_client, timed
+
+
+# ignored now; revisions before connection identities read the sender from the event
+SENDER = {'user': {'username': 'bench'}}
+
+
+def send_all(cs, clients, messages):
+    def run(index, client):
+        for sequence in range(messages):
+            client.emit('sendMessage', {'roomId': 'public', 'message': f'bench {index}:{sequence}', **SENDER})
+
+    threads = [threading.Thread(target=run, args=(index, client)) for index, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def flush(cs):
+    # older revisions write synchronously and have no writer to wait for
+    writer = getattr(cs, 'message_writer', None)
+    if writer is not None:
+        writer.flush()
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--messages', type=int, default=500, help='messages per client')
+    args = parser.parse_args()
+    cs = load_chatroomsite(args.source, CHATROOM_MESSAGE_RATE='1000000', CHATROOM_MESSAGE_BURST='1000000')
+    flask_client = signed_in_client(cs, 'bench')
+    clients = [cs.socketio.test_client(cs.app, flask_test_client=flask_client) for _ in range(args.clients)]
+    for client in clients:
+        client.emit('joinRoom', {'roomId': 'public', **SENDER})
+    total = args.clients * args.messages
+    emit_seconds, _ = timed(send_all, cs, clients, args.messages)
+    flush_seconds, _ = timed(flush, cs)
+    rows = sqlite3.connect(cs.app.config.get('DATABASE', 'chatroom.db')).execute(
+        "SELECT COUNT(*) FROM messages WHERE text LIKE 'bench %'").fetchone()[0]
+    print(f'{args.clients} clients x {args.messages} messages')
+    print(f'emitted   {total / emit_seconds:9.0f} msg/s')
+    print(f'committed {total / (emit_seconds + flush_seconds):9.0f} msg/s ({rows}/{total} rows)')
+    for client in clients:
+        client.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Benchmark the size and encoding cost of room messages on the wire.
+
+Encodes ``--messages`` room messages from the search corpus (made-up
+Persian and Latin words) as the Socket.IO packets each kind of client
+receives: verbose with \\uXXXX escapes, as before the UTF-8 encoder,
+verbose in UTF-8, and compact. It reports the mean bytes per packet, raw
+and after permessage-deflate with context takeover as browsers negotiate
+it, and the microseconds spent building and encoding each packet, which
+the server pays once per message whatever the room size:
+
+    python benchmarks/bench_wire.py --messages 20000
+
+Revisions without the compact format only get the escaped verbose row.
+"""
+import json
+import time
+import zlib
+from datetime import datetime
+
+from socketio.packet import EVENT, Packet
+
+from harness import argument_parser, load_chatroomsite
+from search_corpus import messages
+
+
+def encoders(cs):
+    # the server sets its json module on Packet itself, so pin each encoding explicitly
+    class EscapedPacket(Packet):
+        json = json
+
+    class Utf8Packet(Packet):
+        json = getattr(cs, 'Utf8JSON', json)
+
+    def escaped(message_id, text, timestamp):
+        return EscapedPacket(EVENT, ['message', {'user': 'bench', 'text': text, 'timestamp': timestamp, 'id': message_id}]).encode()
+
+    def verbose(message_id, text, timestamp):
+        return Utf8Packet(EVENT, ['message', {'user': 'bench', 'text': text, 'timestamp': timestamp, 'id': message_id}]).encode()
+
+    def compact(message_id, text, timestamp):
+        return Utf8Packet(EVENT, ['m', [message_id, 1, text, cs.epoch_ms(timestamp)]]).encode()
+
+    found = [('verbose, escaped', escaped)]
+    if hasattr(cs, 'Utf8JSON'):
+        found.append(('verbose, UTF-8', verbose))
+    if hasattr(cs, 'epoch_ms'):
+        found.append(('compact', compact))
+    return found
+
+
+def deflated_sizes(packets):
+    # one compressor for the whole stream, flushed after every message, as permessage-deflate does
+    compressor = zlib.compressobj(wbits=-15)
+    return [len(compressor.compress(packet.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4 for packet in packets]
+
+
+def main():
+    parser = argument_parser(__doc__)
+    parser.add_argument('--messages', type=int, default=20000)
+    args = parser.parse_args()
+    cs = load_chatroomsite(args.source)
+    timestamp = datetime.now().isoformat()
+    corpus = [(index + 1, text, timestamp) for index, text in enumerate(messages(args.messages))]
+    print(f'{args.messages} messages, {sum(len(text.encode()) for _, text, _ in corpus) / len(corpus):.0f} bytes of text each on average')
+    for name, encode in encoders(cs):
+        started = time.perf_counter()
+        packets = [encode(*message) for message in corpus]
+        seconds = time.perf_counter() - started
+        raw = sum(len(packet.encode()) for packet in packets) / len(packets)
+        deflated = sum(deflated_sizes(packets)) / len(packets)
+        print(f'{name:17} {raw:7.1f} B  {deflated:7.1f} B deflated  {seconds / len(packets) * 1e6:6.1f} us/message')
+
+
+if __name__ == '__main__':
+    main()
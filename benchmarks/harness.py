@@ -0,0 +1,60 @@
+"""Shared setup for the benchmarks: import chatroomsite on a scratch database.
+
+Every benchmark takes ``--source DIR``, the directory holding the
+chatroomsite.py to measure (this checkout by default). To compare two
+revisions, check the older one out next to this one and run the benchmark
+against each:
+
+    git worktree add /tmp/before <revision>
+    python benchmarks/bench_send.py --source /tmp/before
+    python benchmarks/bench_send.py
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description.split('\n\n', 1)[0])
+    parser.add_argument('--source', default=REPO, help='directory of the chatroomsite.py to measure')
+    return parser
+
+
+def load_chatroomsite(source, **env):
+    """Import ``source``/chatroomsite.py inside a fresh scratch directory and return the module.
+
+    ``env`` holds CHATROOM_* overrides, applied before the import since the
+    module reads its configuration when it loads. The scratch directory is
+    also where uploads, avatars and archives end up.
+    """
+    work = tempfile.mkdtemp(prefix='chatroom-bench-')
+    os.chdir(work)
+    # older revisions keep media under static/ and expect the directories to exist
+    for directory in ('static/avatars', 'static/uploads'):
+        os.makedirs(directory, exist_ok=True)
+    os.environ.update({'CHATROOM_DB': os.path.join(work, 'chatroom.db'), 'CHATROOM_LOGIN_IP_BURST': '1000000'})
+    os.environ.update(env)
+    sys.path.insert(0, os.path.abspath(source))
+    import chatroomsite
+    return chatroomsite
+
+
+def signed_in_client(cs, username):
+    """A Flask test client logged in as a freshly registered ``username``."""
+    client = cs.app.test_client()
+    response = client.post('/register', data={'username': username, 'email': f'{username}@bench.invalid',
+                                                'password': 'bench-password'})
+    if response.status_code != 200:
+        raise RuntimeError(f'registering {username} failed: {response.status_code} {response.get_data(as_text=True)}')
+    return client
+
+
+def timed(fn, *args):
+    """Run ``fn(*args)``; return (seconds, result)."""
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
@@ -0,0 +1,72 @@
+"""Fill a chatroom database with a synthetic corpus of room messages for search benchmarks.
+
+Words come from a fixed vocabulary of made-up Persian and Latin words whose
+frequencies follow Zipf's law, like words in real chat, so the most common
+word is in a large share of messages and the rarest in a handful. The same
+``--seed`` always yields the same corpus:
+
+    python benchmarks/search_corpus.py chatroom.db --rows 1000000
+
+The database must already have the chatroomsite schema (start the app on it
+once); the FTS index fills through its triggers as rows go in.
+"""
+import argparse
+import itertools
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+PERSIAN_LETTERS = 'ابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی'
+LATIN_LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+VOCABULARY_SIZE = 20000
+BATCH = 10000
+
+
+def vocabulary(seed=0):
+    """VOCABULARY_SIZE distinct words, the most frequent first."""
+    rng = random.Random(seed)
+    words = {}
+    while len(words) < VOCABULARY_SIZE:
+        letters = PERSIAN_LETTERS if len(words) % 2 else LATIN_LETTERS
+        words[''.join(rng.choices(letters, k=rng.randint(3, 9)))] = None
+    return list(words)
+
+
+def messages(count, seed=0):
+    """``count`` message texts of 3 to 20 words."""
+    rng = random.Random(seed)
+    words = vocabulary(seed)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+    for _ in range(count):
+        yield ' '.join(rng.choices(words, cum_weights=weights, k=rng.randint(3, 20)))
+
+
+def fill(path, rows, seed=0):
+    """Append ``rows`` messages spread over every room and user in the database at ``path``."""
+    conn = sqlite3.connect(path)
+    rooms = [row[0] for row in conn.execute('SELECT id FROM rooms')]
+    users = [row[0] for row in conn.execute('SELECT id FROM users')]
+    if not rooms or not users:
+        raise SystemExit(f'{path} needs at least one room and one user')
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(seconds=rows)
+    texts = messages(rows, seed)
+    for offset in range(0, rows, BATCH):
+        conn.executemany('INSERT INTO messages (room_id, user_id, text, timestamp) VALUES (?, ?, ?, ?)',
+                         ((rng.choice(rooms), rng.choice(users), text, (start + timedelta(seconds=offset + index)).isoformat())
+                          for index, text in enumerate(itertools.islice(texts, BATCH))))
+        conn.commit()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('database')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    fill(args.database, args.rows, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,745 @@
-from flask import Flask, render_template_string, request, jsonify, session
+import os
+
+# a process of the spawned hashing or image pools re-runs this script as __mp_main__ before it
+# unpickles its job; the jobs live in offload.py, so skip everything here that touches the world
+POOL_PROCESS = __name__ == '__mp_main__'
+
+# gevent/eventlet have to patch the standard library before anything else imports it
+ASYNC_MODE = os.environ.get('CHATROOM_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    if not POOL_PROCESS:
+        monkey.patch_all()
+elif ASYNC_MODE == 'eventlet':
+    import eventlet
+    if not POOL_PROCESS:
+        eventlet.monkey_patch()
+elif ASYNC_MODE != 'threading':
+    raise RuntimeError(f'CHATROOM_ASYNC_MODE must be threading, gevent or eventlet, not {ASYNC_MODE!r}')
+
+from flask import Flask, request, jsonify, session, send_from_directory, g
+from flask.sessions import SessionInterface, SessionMixin
 from flask_socketio import SocketIO, join_room, leave_room, emit
 import sqlite3
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
-import os
+from werkzeug.security import safe_join
+from werkzeug.datastructures import CallbackDict
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from jinja2.utils import htmlsafe_json_dumps
+from offload import spawn_pool, hash_password, check_password, image_variant_path, make_image_variants
+import _thread
+import atexit
+import fcntl
+import functools
+import gzip
+import hashlib
+import hmac
+import html
+import inspect
+import json
+import math
+import posixpath
+import queue
+import re
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask(__name__)
 app.secret_key = 'super_secret_key_2025'
-socketio = SocketIO(app)
+app.config['DATABASE'] = os.environ.get('CHATROOM_DB', 'chatroom.db')
+# read-only connections; every write goes through a single writer connection per worker
+app.config['DB_POOL_SIZE'] = int(os.environ.get('CHATROOM_DB_POOL_SIZE', '8'))
+# copy of DATABASE refreshed every READ_REPLICA_INTERVAL seconds for admin and reporting
+# queries; empty runs them on the reader pool
+app.config['READ_REPLICA'] = os.environ.get('CHATROOM_READ_REPLICA', '')
+app.config['READ_REPLICA_INTERVAL'] = int(os.environ.get('CHATROOM_READ_REPLICA_INTERVAL', '300'))
+# private messages spread over this many extra SQLite files by conversation; 0 keeps them
+# in DATABASE. Raising it later is fine (rows move at startup), lowering it is not
+app.config['PRIVATE_SHARDS'] = int(os.environ.get('CHATROOM_PRIVATE_SHARDS', '0'))
+# 'batched' commits queued messages every WRITE_BATCH_INTERVAL_MS or WRITE_BATCH_SIZE rows,
+# 'immediate' commits each message before it is broadcast
+app.config['MESSAGE_DURABILITY'] = os.environ.get('CHATROOM_MESSAGE_DURABILITY', 'batched')
+app.config['WRITE_BATCH_INTERVAL_MS'] = int(os.environ.get('CHATROOM_WRITE_BATCH_INTERVAL_MS', '50'))
+app.config['WRITE_BATCH_SIZE'] = int(os.environ.get('CHATROOM_WRITE_BATCH_SIZE', '200'))
+# 'sqlite', 'memory' (single worker) or redis://... for server-side session data
+app.config['SESSION_STORE'] = os.environ.get('CHATROOM_SESSION_STORE', 'sqlite')
+# seconds a worker may serve a user record another worker has changed
+app.config['USER_CACHE_TTL'] = float(os.environ.get('CHATROOM_USER_CACHE_TTL', '30'))
+# redis://... to share presence between workers; empty keeps it in process memory
+app.config['PRESENCE_URL'] = os.environ.get('CHATROOM_PRESENCE_URL', '')
+# a worker that stops refreshing its presence heartbeat for this long is presumed dead
+# and its sockets are dropped from the shared presence store by the surviving workers
+app.config['PRESENCE_TTL'] = int(os.environ.get('CHATROOM_PRESENCE_TTL', '30'))
+# seconds between checks of the shared rooms version made by other workers
+app.config['ROOMS_CACHE_CHECK_INTERVAL'] = float(os.environ.get('CHATROOM_ROOMS_CACHE_CHECK_INTERVAL', '1'))
+# uploads and avatars live outside static/ so only serve_media, with its headers, hands them out;
+# they are still linked as /static/uploads/... and /static/avatars/..., the URLs stored in the database
+app.config['MEDIA_DIR'] = os.environ.get('CHATROOM_MEDIA_DIR', 'media')
+app.config['UPLOAD_DIR'] = os.path.join(app.config['MEDIA_DIR'], 'uploads')
+app.config['AVATAR_DIR'] = os.path.join(app.config['MEDIA_DIR'], 'avatars')
+# unfinished chunked uploads; finished ones are renamed into UPLOAD_DIR, so keep both on one filesystem
+app.config['PARTIAL_UPLOAD_DIR'] = os.environ.get('CHATROOM_PARTIAL_UPLOAD_DIR', 'instance/partial_uploads')
+app.config['MAX_UPLOAD_SIZE'] = int(os.environ.get('CHATROOM_MAX_UPLOAD_SIZE', str(1024 * 1024 * 1024)))
+app.config['USER_UPLOAD_QUOTA'] = int(os.environ.get('CHATROOM_USER_UPLOAD_QUOTA', str(5 * 1024 * 1024 * 1024)))
+# chunk size the client is told to send, and the buffer used when copying request bodies to disk
+app.config['UPLOAD_CHUNK_SIZE'] = 8 * 1024 * 1024
+app.config['UPLOAD_READ_SIZE'] = 256 * 1024
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_UPLOAD_SIZE'] + 1024 * 1024
+# internal nginx location (e.g. /_media/) to hand media downloads to via X-Accel-Redirect
+app.config['MEDIA_ACCEL_REDIRECT'] = os.environ.get('CHATROOM_MEDIA_ACCEL_REDIRECT', '')
+app.config['IMAGE_WORKERS'] = int(os.environ.get('CHATROOM_IMAGE_WORKERS', str(os.cpu_count() or 1)))
+# newest messages kept in memory per room, and the memory cap across all rooms
+app.config['RECENT_MESSAGES_PER_ROOM'] = int(os.environ.get('CHATROOM_RECENT_MESSAGES_PER_ROOM', '200'))
+app.config['RECENT_MESSAGES_MAX_BYTES'] = int(os.environ.get('CHATROOM_RECENT_MESSAGES_MAX_BYTES', str(64 * 1024 * 1024)))
+# room messages older than this many days move to monthly archive files (0 keeps them);
+# rooms.retention_days overrides it per room
+app.config['ARCHIVE_DIR'] = os.environ.get('CHATROOM_ARCHIVE_DIR', 'archive')
+app.config['ARCHIVE_AFTER_DAYS'] = int(os.environ.get('CHATROOM_ARCHIVE_AFTER_DAYS', '0'))
+app.config['PRIVATE_ARCHIVE_AFTER_DAYS'] = int(os.environ.get('CHATROOM_PRIVATE_ARCHIVE_AFTER_DAYS', '0'))
+app.config['ARCHIVE_INTERVAL'] = int(os.environ.get('CHATROOM_ARCHIVE_INTERVAL', '3600'))
+app.config['ARCHIVE_BATCH_SIZE'] = 2000
+# typing indicators are aggregated per room and broadcast at most once per tick
+app.config['TYPING_TICK_MS'] = int(os.environ.get('CHATROOM_TYPING_TICK_MS', '500'))
+app.config['ACTIVITY_TICK_MS'] = int(os.environ.get('CHATROOM_ACTIVITY_TICK_MS', '1000'))
+# per-connection token buckets: sustained events per second and burst size
+app.config['MESSAGE_RATE'] = float(os.environ.get('CHATROOM_MESSAGE_RATE', '2'))
+app.config['MESSAGE_BURST'] = int(os.environ.get('CHATROOM_MESSAGE_BURST', '10'))
+app.config['TYPING_RATE'] = float(os.environ.get('CHATROOM_TYPING_RATE', '2'))
+app.config['TYPING_BURST'] = int(os.environ.get('CHATROOM_TYPING_BURST', '5'))
+# login/register attempts per client IP and login attempts per account, checked before any hashing
+app.config['LOGIN_IP_RATE'] = float(os.environ.get('CHATROOM_LOGIN_IP_RATE', '1'))
+app.config['LOGIN_IP_BURST'] = int(os.environ.get('CHATROOM_LOGIN_IP_BURST', '20'))
+app.config['LOGIN_ACCOUNT_RATE'] = float(os.environ.get('CHATROOM_LOGIN_ACCOUNT_RATE', '0.2'))
+app.config['LOGIN_ACCOUNT_BURST'] = int(os.environ.get('CHATROOM_LOGIN_ACCOUNT_BURST', '5'))
+# X-Forwarded-For entries set by trusted proxies, so throttling sees client IPs behind nginx
+app.config['PROXY_HOPS'] = int(os.environ.get('CHATROOM_PROXY_HOPS', '0'))
+# werkzeug method string such as 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000';
+# older hashes are redone with it at the next successful login
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('CHATROOM_PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+app.config['PASSWORD_WORKERS'] = int(os.environ.get('CHATROOM_PASSWORD_WORKERS', str(os.cpu_count() or 1)))
+# hashing jobs in flight before login and register answer 503
+app.config['PASSWORD_QUEUE_SIZE'] = int(os.environ.get('CHATROOM_PASSWORD_QUEUE_SIZE', '32'))
+# redis://... (or any Flask-SocketIO message queue URL) so emits reach clients on every worker
+app.config['MESSAGE_QUEUE'] = os.environ.get('CHATROOM_MESSAGE_QUEUE', '')
+app.config['ASYNC_MODE'] = ASYNC_MODE
+# concurrent connections a gevent/eventlet worker accepts
+app.config['MAX_CONNECTIONS'] = int(os.environ.get('CHATROOM_MAX_CONNECTIONS', '20000'))
+# bearer token required by /metrics; empty leaves it open (restrict it at the proxy instead)
+app.config['METRICS_TOKEN'] = os.environ.get('CHATROOM_METRICS_TOKEN', '')
+# room whose latest messages and members are inlined into the page for its first open
+app.config['DEFAULT_ROOM'] = os.environ.get('CHATROOM_DEFAULT_ROOM', 'public')
+# text responses at least this large are sent brotli (if installed) or gzip compressed; 0 turns it off
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('CHATROOM_COMPRESS_MIN_SIZE', '1024'))
+if app.config['PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'])
+
+# متریک‌ها با فرمت متنی Prometheus: هر ورکر متریک‌های خودش را روی /metrics می‌دهد
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+FANOUT_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+def _metric_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_metric_labels(self.labels, labels)} {value}')
+        return lines
+
+
+class Gauge:
+    """A gauge read from ``callback`` at scrape time."""
+
+    def __init__(self, name, help, callback):
+        self.name, self.help, self.callback = name, help, callback
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.callback()}']
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, labels, buckets
+        self._series = {}         # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{_metric_labels(self.labels + ("le",), labels + (bound,))} {count}')
+                lines.append(f'{self.name}_bucket{_metric_labels(self.labels + ("le",), labels + ("+Inf",))} {series[-1]}')
+                lines.append(f'{self.name}_sum{_metric_labels(self.labels, labels)} {series[-2]}')
+                lines.append(f'{self.name}_count{_metric_labels(self.labels, labels)} {series[-1]}')
+        return lines
+
+
+HTTP_REQUEST_SECONDS = Histogram('chatroom_http_request_duration_seconds', 'Time spent handling HTTP requests.',
+                                 ('endpoint', 'method', 'status'))
+SOCKET_EVENT_SECONDS = Histogram('chatroom_socketio_event_duration_seconds', 'Time spent in Socket.IO event handlers.',
+                                 ('event',))
+SOCKET_EVENT_ERRORS = Counter('chatroom_socketio_event_errors_total', 'Socket.IO handlers that raised.', ('event',))
+DB_CALL_SECONDS = Histogram('chatroom_db_call_duration_seconds', 'Time spent in SQLite connection and cursor calls.',
+                            ('call',), DB_BUCKETS)
+EMIT_FANOUT = Histogram('chatroom_socketio_emit_fanout', 'Sockets on this worker addressed by each emit.',
+                        ('event',), FANOUT_BUCKETS)
+AUTH_REJECTED = Counter('chatroom_auth_rejected_total', 'Login and register requests refused before hashing.',
+                        ('reason',))
+METRICS = [HTTP_REQUEST_SECONDS, SOCKET_EVENT_SECONDS, SOCKET_EVENT_ERRORS, DB_CALL_SECONDS, EMIT_FANOUT,
+           AUTH_REJECTED]
+
+
+class InstrumentedSocketIO(SocketIO):
+    """SocketIO that times every ``@socketio.on`` handler and records emit fan-out."""
+
+    def on(self, message, namespace=None):
+        register = super().on(message, namespace)
+
+        def decorator(handler):
+            signature = inspect.signature(handler)
+
+            @functools.wraps(handler)
+            def timed(*args, **kwargs):
+                if message == 'connect':
+                    # Flask-SocketIO calls connect handlers with (auth) and retries without it on TypeError
+                    signature.bind(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return handler(*args, **kwargs)
+                except Exception:
+                    SOCKET_EVENT_ERRORS.inc(message)
+                    raise
+                finally:
+                    SOCKET_EVENT_SECONDS.observe(time.perf_counter() - start, message)
+            register(timed)
+            return handler
+        return decorator
+
+    def emit(self, event, *args, **kwargs):
+        namespace = kwargs.get('namespace') or '/'
+        room = kwargs.get('to', kwargs.get('room'))
+        participants = self.server.manager.rooms.get(namespace, {})
+        # participants of None are every socket connected to the namespace
+        rooms = room if isinstance(room, list) else [room]
+        EMIT_FANOUT.observe(sum(len(participants.get(name, ())) for name in rooms), event)
+        return super().emit(event, *args, **kwargs)
+
+
+# پروفایلر نمونه‌بردار: یک ترد واقعی (نه گرین‌لت) پشته همه تردها را دوره‌ای می‌شمارد
+if ASYNC_MODE == 'gevent':
+    _start_native_thread = monkey.get_original('_thread', 'start_new_thread')
+    _native_sleep = monkey.get_original('time', 'sleep')
+elif ASYNC_MODE == 'eventlet':
+    _start_native_thread = eventlet.patcher.original('_thread').start_new_thread
+    _native_sleep = eventlet.patcher.original('time').sleep
+else:
+    _start_native_thread = _thread.start_new_thread
+    _native_sleep = time.sleep
+
+
+class SamplingProfiler:
+    """Counts the stacks of every thread every ``interval`` seconds while running.
+
+    The report is in folded-stack format, ready for flamegraph.pl or speedscope.
+    """
+
+    MAX_DEPTH = 64
+
+    def __init__(self):
+        self.running = False
+        self.interval = 0.01
+        self.samples = 0
+        self._stacks = {}
+        self._thread_id = None
+        # each start gets a new generation; a sampler thread exits once its generation is over,
+        # so a stop followed at once by a start never leaves two of them sampling
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def start(self, interval):
+        with self._lock:
+            if self.running:
+                return
+            self.interval = interval
+            self.samples = 0
+            self._stacks = {}
+            self.running = True
+            self._generation += 1
+            self._thread_id = _start_native_thread(self._run, (self._generation, self._stacks))
+
+    def stop(self):
+        with self._lock:
+            self.running = False
+            self._generation += 1
+
+    def _run(self, generation, stacks):
+        # a native thread: no locks shared with green threads in here
+        me = _thread.get_ident()
+        samples = 0
+        while self._generation == generation:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+            if self._generation == generation:
+                self.samples = samples
+            _native_sleep(self.interval)
+
+    def report(self, limit=None):
+        stacks = sorted(dict(self._stacks).items(), key=lambda item: item[1], reverse=True)
+        return [f'{stack} {count}' for stack, count in stacks[:limit]]
+
+
+profiler = SamplingProfiler()
+
+# کدگذاری JSON بسته‌های Socket.IO: متن فارسی به صورت UTF-8 و نه \uXXXX
+_LONE_SURROGATE = re.compile('[\ud800-\udfff]')
+
+
+class Utf8JSON:
+    """json module for Socket.IO packets that keeps non-ASCII text as UTF-8 instead of \\uXXXX escapes.
+
+    Strings with lone surrogates cannot be encoded as UTF-8, so those packets
+    keep the escaped form.
+    """
+
+    loads = staticmethod(json.loads)
+
+    @staticmethod
+    def dumps(*args, **kwargs):
+        text = json.dumps(*args, ensure_ascii=False, **kwargs)
+        return json.dumps(*args, **kwargs) if _LONE_SURROGATE.search(text) else text
+
+
+socketio = InstrumentedSocketIO(app, async_mode=ASYNC_MODE, message_queue=app.config['MESSAGE_QUEUE'] or None,
+                                json=Utf8JSON)
+
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_PAGE_MAX = 200
+UNREAD_COUNT_CAP = 100
+
+# استخر اتصال SQLite
+DB_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+)
+# per-database pragmas repeated for every attached shard
+ATTACHED_PRAGMAS = (
+    'PRAGMA {}.journal_mode = WAL',
+    'PRAGMA {}.synchronous = NORMAL',
+)
+# the replica is never written, so it needs no journal pragmas
+REPLICA_PRAGMAS = (
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+)
+REPLICA_POOL_SIZE = 2
+# SQLITE_MAX_ATTACHED defaults to 10
+PRIVATE_SHARDS_MAX = 8
+
+
+# sqlite3 blocks in C, out of reach of monkey patching; under gevent/eventlet
+# every call on a connection or cursor runs on a native thread pool instead
+if ASYNC_MODE == 'gevent':
+    import gevent
+
+    def run_blocking(fn, *args, **kwargs):
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+
+    def _set_blocking_threads(count):
+        gevent.get_hub().threadpool.maxsize = count
+elif ASYNC_MODE == 'eventlet':
+    from eventlet import tpool
+
+    run_blocking = tpool.execute
+    _set_blocking_threads = tpool.set_num_threads
+else:
+    def run_blocking(fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+    def _set_blocking_threads(count):
+        pass
+
+
+class InstrumentedSQLite:
+    """Proxy for a sqlite3 connection or cursor that times each method call and runs it through ``run_blocking``."""
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with DB_CALL_SECONDS.time(name):
+                result = run_blocking(attr, *args, **kwargs)
+            return InstrumentedSQLite(result) if isinstance(result, sqlite3.Cursor) else result
+        return call
+
+    def __iter__(self):
+        with DB_CALL_SECONDS.time('fetchall'):
+            return iter(run_blocking(self._target.fetchall))
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections shared by routes and socket handlers.
+
+    A thread (or greenlet) that already holds a connection gets the same one
+    back on nested checkouts, so helpers can call ``get_db()`` freely.
+    ``attach`` maps schema names to database files opened alongside ``path``
+    on every connection. ``query_only`` connections refuse to write.
+    """
+
+    def __init__(self, path, size, attach=None, query_only=False):
+        self.path = path
+        self.size = size
+        self.attach = attach or {}
+        self.query_only = query_only
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        for name, path in self.attach.items():
+            conn.execute(f'ATTACH DATABASE ? AS {name}', (path,))
+            for pragma in ATTACHED_PRAGMAS:
+                conn.execute(pragma.format(name))
+        if self.query_only:
+            conn.execute('PRAGMA query_only = ON')
+        return InstrumentedSQLite(conn)
+
+    def held(self):
+        """True if the calling thread has a connection checked out."""
+        return getattr(self._local, 'conn', None) is not None
+
+    def acquire(self):
+        held = getattr(self._local, 'conn', None)
+        if held is not None:
+            self._local.depth += 1
+            return held
+        self._slots.acquire()
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._slots.release()
+                raise
+        self._local.conn = conn
+        self._local.depth = 1
+        return conn
+
+    def release(self, conn):
+        self._local.depth -= 1
+        if self._local.depth:
+            return
+        self._local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class ReplicaPool(ConnectionPool):
+    """Read-only connections to the read replica file.
+
+    The refresher swaps in a new file with ``os.replace``; connections still
+    open on the old one are reopened at their next checkout.
+    """
+
+    def __init__(self, path, size):
+        super().__init__(path, size)
+        self._inodes = {}   # id(connection) -> inode of the file it opened
+
+    def _connect(self):
+        inode = os.stat(self.path).st_ino
+        conn = sqlite3.connect(f'file:{os.path.abspath(self.path)}?mode=ro', uri=True,
+                               check_same_thread=False, cached_statements=256)
+        for pragma in REPLICA_PRAGMAS:
+            conn.execute(pragma)
+        conn = InstrumentedSQLite(conn)
+        self._inodes[id(conn)] = inode
+        return conn
+
+    def acquire(self):
+        conn = super().acquire()
+        if self._local.depth > 1:
+            return conn
+        try:
+            if self._inodes.get(id(conn)) != os.stat(self.path).st_ino:
+                stale, conn = conn, None
+                self._inodes.pop(id(stale), None)
+                stale.close()
+                conn = self._connect()
+                self._local.conn = conn
+        except Exception:
+            # the replica can vanish or be mid-swap; give back the slot either way
+            if conn is not None:
+                self.release(conn)
+            else:
+                self._local.conn = None
+                self._slots.release()
+            raise
+        return conn
+
+
+def _private_shard_files():
+    shards = app.config['PRIVATE_SHARDS']
+    if not 0 <= shards <= PRIVATE_SHARDS_MAX:
+        raise RuntimeError(f'CHATROOM_PRIVATE_SHARDS must be between 0 and {PRIVATE_SHARDS_MAX}')
+    stem = os.path.splitext(app.config['DATABASE'])[0]
+    return {f'dm{index}': f'{stem}-dm{index}.db' for index in range(shards)}
+
+
+# WAL readers never wait for the writer; writes queue on a single connection
+# instead of contending for the SQLite write lock and sleeping in busy_timeout
+db_pool = ConnectionPool(app.config['DATABASE'], app.config['DB_POOL_SIZE'], _private_shard_files(), query_only=True)
+write_pool = ConnectionPool(app.config['DATABASE'], 1, db_pool.attach)
+replica_pool = ReplicaPool(app.config['READ_REPLICA'], REPLICA_POOL_SIZE) if app.config['READ_REPLICA'] else None
+_set_blocking_threads(app.config['DB_POOL_SIZE'] + 1 + (REPLICA_POOL_SIZE if replica_pool else 0))
+
+
+@contextmanager
+def _checkout(pool):
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+def get_db():
+    """A reader connection, or the writer when this thread already holds it (so it reads its own writes)."""
+    return _checkout(write_pool if write_pool.held() else db_pool)
+
+
+def get_write_db():
+    """The worker's single writer connection; hold it only for the statements that write."""
+    return _checkout(write_pool)
+
+
+def get_replica_db():
+    """A connection for admin and reporting queries: the read replica once it exists, else a reader."""
+    if replica_pool is not None and os.path.exists(replica_pool.path):
+        return _checkout(replica_pool)
+    return get_db()
+
+
+# صف نوشتن پیام‌ها: هندلرها فوراً emit می‌کنند و ردیف‌ها دسته‌ای کامیت می‌شوند
+class MessageWriter:
+    """Background writer that commits queued INSERTs in batched transactions.
+
+    In 'immediate' durability mode ``submit`` writes and commits on the
+    calling thread instead, so every message is on disk before it is emitted.
+    """
+
+    def __init__(self, durability, interval, batch_size):
+        self.durability = durability
+        self.interval = interval
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, sql, params, callback=None):
+        """Persist one row; ``callback`` receives the new row id once written.
+
+        Returns the row id in immediate mode and ``None`` when batched.
+        """
+        if self.durability == 'immediate':
+            with get_write_db() as conn:
+                row_id = conn.execute(sql, params).lastrowid
+                conn.commit()
+            if callback:
+                callback(row_id)
+            return row_id
+        self._ensure_started()
+        self._queue.put((sql, params, callback))
+        return None
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """Block until everything queued so far has been committed."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            # nothing may end this thread: flush() and stop() wait on task_done for every row
+            try:
+                self._write(batch)
+            except Exception:
+                app.logger.exception('message writer dropped a batch of %d rows', len(batch))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                self._queue.task_done()
+                return
+
+    def _write(self, batch):
+        with get_write_db() as conn:
+            try:
+                ids = [conn.execute(sql, params).lastrowid for sql, params, _ in batch]
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                app.logger.exception('batched message write failed, retrying rows one by one')
+                ids = []
+                for sql, params, _ in batch:
+                    try:
+                        ids.append(conn.execute(sql, params).lastrowid)
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        app.logger.exception('dropping message row that could not be written')
+                        ids.append(None)
+        for (_, _, callback), row_id in zip(batch, ids):
+            if callback and row_id is not None:
+                try:
+                    callback(row_id)
+                except Exception:
+                    app.logger.exception('message writer callback failed for row %d', row_id)
+
+
+message_writer = MessageWriter(app.config['MESSAGE_DURABILITY'],
+                               app.config['WRITE_BATCH_INTERVAL_MS'] / 1000,
+                               app.config['WRITE_BATCH_SIZE'])
+atexit.register(message_writer.stop)
+
 
 # دیتابیس SQLite
 def init_db():
-    conn = sqlite3.connect('chatroom.db')
+    with get_write_db() as conn:
+        _create_schema(conn)
+        migrate(conn)
+        init_private_shards(conn)
+
+
+def _create_schema(conn):
     c = conn.cursor()
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -54,14 +782,1807 @@ def init_db():
     ]
     c.executemany('INSERT OR IGNORE INTO rooms (slug, title, color, banner) VALUES (?, ?, ?, ?)', default_rooms)
     conn.commit()
-    conn.close()
 
-init_db()
+
+# مایگریشن‌های شِما: هر مرحله یک بار و به ترتیب نسخه اجرا می‌شود
+# Arabic code points that Persian text mixes in, folded to the Persian letter in
+# both the index and queries. Each pair is the same UTF-8 length and letter class,
+# so snippet() token offsets into the stored text stay aligned.
+FTS_CHAR_FOLDS = (('ي', 'ی'), ('ى', 'ی'), ('ك', 'ک'))
+
+
+def _fts_fold_sql(expr):
+    for src, dst in FTS_CHAR_FOLDS:
+        expr = f"replace({expr}, '{src}', '{dst}')"
+    return expr
+
+
+def _fts_table_steps(table, schema=None):
+    """Steps creating ``<table>_fts`` over ``table.text`` plus the triggers that keep it in sync.
+
+    With ``schema`` the index and triggers are created in that attached database.
+    """
+    fts = f'{table}_fts'
+    prefix = f'{schema}.' if schema else ''
+    new_text, old_text = _fts_fold_sql('new.text'), _fts_fold_sql('old.text')
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS {prefix}{fts} USING fts5 (
+            text, content='{table}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )""",
+        f"""CREATE TRIGGER IF NOT EXISTS {prefix}{fts}_ai AFTER INSERT ON {table} BEGIN
+            INSERT INTO {fts} (rowid, text) VALUES (new.id, {new_text});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {prefix}{fts}_ad AFTER DELETE ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, text) VALUES ('delete', old.id, {old_text});
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {prefix}{fts}_au AFTER UPDATE OF text ON {table} BEGIN
+            INSERT INTO {fts} ({fts}, rowid, text) VALUES ('delete', old.id, {old_text});
+            INSERT INTO {fts} (rowid, text) VALUES (new.id, {new_text});
+        END""",
+        f"INSERT INTO {prefix}{fts} (rowid, text) SELECT id, {_fts_fold_sql('text')} FROM {prefix}{table} WHERE text IS NOT NULL",
+    ]
+
+
+MIGRATIONS = [
+    (1, 'room history by (room_id, id)', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room_id, id)',
+    ]),
+    (2, 'private message conversation and unread lookups', [
+        'CREATE INDEX IF NOT EXISTS idx_private_messages_to_from_read ON private_messages (to_user_id, from_user_id, read)',
+        'CREATE INDEX IF NOT EXISTS idx_private_messages_from_to ON private_messages (from_user_id, to_user_id, id)',
+    ]),
+    (3, 'online users lookup', [
+        'CREATE INDEX IF NOT EXISTS idx_users_online ON users (online)',
+    ]),
+    (4, 'unread room messages', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_unread ON messages (room_id) WHERE read = 0',
+    ]),
+    (5, 'cache version counters', [
+        'CREATE TABLE IF NOT EXISTS cache_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)',
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('rooms', 0)",
+    ]),
+    (6, 'per-user room read cursors', [
+        '''CREATE TABLE IF NOT EXISTS read_cursors (
+            user_id INTEGER NOT NULL,
+            room_id INTEGER NOT NULL,
+            last_read_message_id INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, room_id)
+        ) WITHOUT ROWID''',
+    ]),
+    (7, 'content-addressed uploads and resumable upload sessions', [
+        '''CREATE TABLE IF NOT EXISTS uploads (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            created_at TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS user_uploads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            filename TEXT,
+            created_at TEXT
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_user_uploads_user ON user_uploads (user_id)',
+        '''CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            filename TEXT,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_upload_sessions_user ON upload_sessions (user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_upload_sessions_created ON upload_sessions (created_at)',
+    ]),
+    (8, 'full-text search over room and private messages', [
+        *_fts_table_steps('messages'),
+        *_fts_table_steps('private_messages'),
+    ]),
+    (9, 'server-side sessions', [
+        '''CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)',
+    ]),
+    (10, 'message retention policies and archive lookup', [
+        'ALTER TABLE rooms ADD COLUMN retention_days INTEGER',
+        '''CREATE TABLE IF NOT EXISTS archived_conversations (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            PRIMARY KEY (kind, key)
+        ) WITHOUT ROWID''',
+    ]),
+    (11, 'private conversations keyed by ordered user pair', [
+        '''CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_low INTEGER NOT NULL,
+            user_high INTEGER NOT NULL,
+            created_at TEXT,
+            UNIQUE (user_low, user_high)
+        )''',
+        'ALTER TABLE private_messages ADD COLUMN conversation_id INTEGER',
+        '''INSERT OR IGNORE INTO conversations (user_low, user_high, created_at)
+           SELECT min(from_user_id, to_user_id) AS low, max(from_user_id, to_user_id) AS high, MIN(timestamp)
+           FROM private_messages WHERE from_user_id IS NOT NULL AND to_user_id IS NOT NULL
+           GROUP BY low, high ORDER BY MIN(id)''',
+        '''UPDATE private_messages SET conversation_id = (
+           SELECT id FROM conversations
+           WHERE user_low = min(from_user_id, to_user_id) AND user_high = max(from_user_id, to_user_id))''',
+        'CREATE INDEX IF NOT EXISTS idx_private_messages_conversation ON private_messages (conversation_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_private_messages_unread ON private_messages (conversation_id, to_user_id) WHERE read = 0',
+        'DROP INDEX IF EXISTS idx_private_messages_to_from_read',
+        'DROP INDEX IF EXISTS idx_private_messages_from_to',
+        'CREATE TABLE IF NOT EXISTS private_shard_layout (shards INTEGER NOT NULL)',
+        'INSERT INTO private_shard_layout (shards) VALUES (0)',
+    ]),
+    # unread counts come from read_cursors and presence from the presence store, so
+    # messages.read stays 0 forever and users.online is never queried
+    (12, 'drop indexes on columns no longer read', [
+        'DROP INDEX IF EXISTS idx_messages_unread',
+        'DROP INDEX IF EXISTS idx_users_online',
+    ]),
+    (13, 'cache version for archived rooms', [
+        "INSERT OR IGNORE INTO cache_versions (name, version) VALUES ('archived_rooms', 0)",
+    ]),
+]
+
+
+def migrate(conn):
+    """Apply pending MIGRATIONS in order, recording each in schema_version.
+
+    A step is either an SQL string or a callable taking the connection. Each
+    version runs in its own IMMEDIATE transaction so workers starting at the
+    same time apply it exactly once.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT
+    )''')
+    for version, description, steps in MIGRATIONS:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone():
+                conn.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute('INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)',
+                         (version, description, datetime.now().isoformat()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+# شاردهای پیام خصوصی: هر گفتگو بر اساس شناسه‌اش در یکی از فایل‌های dmN ذخیره می‌شود
+PRIVATE_MESSAGE_COLUMNS = 'id, from_user_id, to_user_id, text, timestamp, read, conversation_id'
+
+
+def _private_shard_steps(schema):
+    return [
+        f'''CREATE TABLE IF NOT EXISTS {schema}.private_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            from_user_id INTEGER,
+            to_user_id INTEGER,
+            text TEXT,
+            timestamp TEXT,
+            read INTEGER DEFAULT 0,
+            conversation_id INTEGER
+        )''',
+        f'CREATE INDEX IF NOT EXISTS {schema}.idx_private_messages_conversation ON private_messages (conversation_id, id)',
+        f'CREATE INDEX IF NOT EXISTS {schema}.idx_private_messages_unread ON private_messages (conversation_id, to_user_id) WHERE read = 0',
+        # created together with the table, so there is nothing to backfill
+        *_fts_table_steps('private_messages', schema)[:-1],
+    ]
+
+
+def init_private_shards(conn):
+    """Create the attached shard schemas and move rows whose shard changed.
+
+    Rows only move when PRIVATE_SHARDS differs from the recorded layout: out
+    of the main database when sharding is first enabled, and between shards
+    when the count is raised. Ids are kept, so archived copies still match.
+    """
+    shards = list(db_pool.attach)
+    for schema in shards:
+        for step in _private_shard_steps(schema):
+            conn.execute(step)
+    conn.commit()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        recorded = conn.execute('SELECT shards FROM private_shard_layout').fetchone()[0]
+        if recorded == len(shards):
+            conn.rollback()
+            return
+        if len(shards) < recorded:
+            raise RuntimeError(f'CHATROOM_PRIVATE_SHARDS cannot go below {recorded} once private messages were sharded')
+        for source in ['main', *shards]:
+            for index, target in enumerate(shards):
+                if source == target:
+                    continue
+                conn.execute(f'INSERT OR IGNORE INTO {target}.private_messages ({PRIVATE_MESSAGE_COLUMNS}) '
+                             f'SELECT {PRIVATE_MESSAGE_COLUMNS} FROM {source}.private_messages '
+                             'WHERE conversation_id % ? = ?', (len(shards), index))
+                conn.execute(f'DELETE FROM {source}.private_messages WHERE conversation_id % ? = ?', (len(shards), index))
+        conn.execute('UPDATE private_shard_layout SET shards = ?', (len(shards),))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+
+# نشانگر خواندن فقط جلو می‌رود
+MARK_ROOM_READ_SQL = ('INSERT INTO read_cursors (user_id, room_id, last_read_message_id) '
+                      'VALUES (?, ?, (SELECT COALESCE(MAX(id), 0) FROM messages WHERE room_id = ?)) '
+                      'ON CONFLICT (user_id, room_id) DO UPDATE SET '
+                      'last_read_message_id = MAX(last_read_message_id, excluded.last_read_message_id)')
+
+
+# کوئری‌های پرتکرار که هرگز نباید به اسکن کامل جدول برگردند
+HOT_QUERIES = {
+    'room_history': ('SELECT m.id, u.username, m.text, m.timestamp FROM messages m JOIN users u ON m.user_id = u.id '
+                     'WHERE m.room_id = ? AND m.id < ? ORDER BY m.id DESC LIMIT ?', (1, 1, 1)),
+    'room_mark_read': (MARK_ROOM_READ_SQL, (1, 1, 1)),
+    'conversation_lookup': ('SELECT id FROM conversations WHERE user_low = ? AND user_high = ?', (1, 2)),
+    'private_history': ('SELECT pm.id, u.username, pm.text, pm.timestamp FROM private_messages pm JOIN users u ON u.id = pm.from_user_id '
+                        'WHERE pm.conversation_id = ? AND pm.id < ? ORDER BY pm.id DESC LIMIT ?', (1, 1, 1)),
+    'private_mark_read': ('UPDATE private_messages SET read = 1 WHERE conversation_id = ? AND to_user_id = ? AND read = 0', (1, 1)),
+    'read_cursors': ('SELECT room_id, last_read_message_id FROM read_cursors WHERE user_id = ?', (1,)),
+    'unread_count': ('SELECT COUNT(*) FROM (SELECT 1 FROM messages WHERE room_id = ? AND id > ? LIMIT ?)', (1, 1, 1)),
+    'login_lookup': ('SELECT * FROM users WHERE username = ? OR email = ?', ('a', 'a')),
+    'room_search': ('SELECT m.id FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid '
+                    'WHERE messages_fts MATCH ? AND m.room_id = ? ORDER BY messages_fts.rank LIMIT ?', ('"a"', 1, 1)),
+}
+
+
+# a rowid range walks the table from one end, filtering as it goes: a full scan
+# with extra steps, which is what a history query falls back to without its index
+FULL_SCAN_PLAN = re.compile(r'SCAN \w+|SEARCH \w+ USING INTEGER PRIMARY KEY \(rowid[<>]=?\?\)')
+
+
+def find_full_scans(conn):
+    """Return (query name, plan detail) for every hot query that scans a whole table."""
+    regressions = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            if FULL_SCAN_PLAN.fullmatch(row[3]):
+                regressions.append((name, row[3]))
+    return regressions
+
+
+if not POOL_PROCESS:
+    init_db()
+
+# حضور کاربران: عضویت هر اتصال در روم‌ها، بدون ستون online در دیتابیس
+class PresenceRegistry:
+    """In-process presence: which users are connected and which rooms they sit in.
+
+    A user counts as present in a room while at least one of their sockets
+    has joined it, so extra tabs do not produce duplicate join/leave deltas.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}          # sid -> user dict
+        self._sids = {}           # username -> set of sids
+        self._rooms = {}          # room -> {username: set of sids}
+        self._sid_rooms = {}      # sid -> set of rooms
+
+    def connect(self, sid, user):
+        with self._lock:
+            self._users[sid] = user
+            self._sids.setdefault(user['username'], set()).add(sid)
+            self._sid_rooms.setdefault(sid, set())
+
+    def disconnect(self, sid):
+        """Forget ``sid``; return its user and the rooms that user has now left."""
+        with self._lock:
+            user = self._users.pop(sid, None)
+            if user is None:
+                return None, []
+            left = [room for room in self._sid_rooms.pop(sid, ()) if self._remove(room, sid, user)]
+            sids = self._sids.get(user['username'])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._sids[user['username']]
+            return user, left
+
+    def join(self, room, sid):
+        """Add ``sid`` to ``room``; return its user and whether the user is new to the room."""
+        with self._lock:
+            user = self._users.get(sid)
+            if user is None:
+                return None, False
+            members = self._rooms.setdefault(room, {})
+            first = user['username'] not in members
+            members.setdefault(user['username'], set()).add(sid)
+            self._sid_rooms[sid].add(room)
+            return user, first
+
+    def leave(self, room, sid):
+        """Remove ``sid`` from ``room``; return its user and whether the user has left entirely."""
+        with self._lock:
+            user = self._users.get(sid)
+            if user is None or room not in self._sid_rooms.get(sid, ()):
+                return user, False
+            self._sid_rooms[sid].discard(room)
+            return user, self._remove(room, sid, user)
+
+    def _remove(self, room, sid, user):
+        members = self._rooms.get(room, {})
+        sids = members.get(user['username'])
+        if sids is None:
+            return False
+        sids.discard(sid)
+        if sids:
+            return False
+        del members[user['username']]
+        if not members:
+            self._rooms.pop(room, None)
+        return True
+
+    def rooms_of(self, sid):
+        with self._lock:
+            return set(self._sid_rooms.get(sid, ()))
+
+    def in_room(self, sid, room):
+        with self._lock:
+            return room in self._sid_rooms.get(sid, ())
+
+    def members(self, room):
+        with self._lock:
+            return [self._users[next(iter(sids))] for sids in self._rooms.get(room, {}).values()]
+
+    def is_online(self, username):
+        with self._lock:
+            return username in self._sids
+
+
+class RedisPresenceRegistry:
+    """PresenceRegistry backed by a Redis-compatible server, shared by all workers.
+
+    Every sid is also filed under the worker that owns it. A worker refreshes a
+    heartbeat key that expires after ``ttl`` seconds; when one stops (crash,
+    SIGKILL) the next heartbeat of any other worker, or of its own restart,
+    disconnects its sids, so they do not linger as ghost members.
+    """
+
+    def __init__(self, url, ttl, prefix='chatroom:presence'):
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+        self.ttl = ttl
+        self.worker = uuid.uuid4().hex
+
+    def _key(self, *parts):
+        return ':'.join((self._prefix,) + parts)
+
+    def _user(self, sid):
+        raw = self._redis.get(self._key('sid', sid))
+        return json.loads(raw) if raw else None
+
+    def connect(self, sid, user):
+        pipe = self._redis.pipeline()
+        pipe.set(self._key('sid', sid), json.dumps(user))
+        pipe.sadd(self._key('online', user['username']), sid)
+        pipe.sadd(self._key('worker', self.worker, 'sids'), sid)
+        pipe.execute()
+
+    def disconnect(self, sid, worker=None):
+        user = self._user(sid)
+        if user is None:
+            return None, []
+        left = [room for room in self.rooms_of(sid) if self._remove(room, sid, user)]
+        pipe = self._redis.pipeline()
+        pipe.delete(self._key('sid', sid), self._key('sid', sid, 'rooms'))
+        pipe.srem(self._key('online', user['username']), sid)
+        pipe.srem(self._key('worker', worker or self.worker, 'sids'), sid)
+        pipe.execute()
+        return user, left
+
+    def join(self, room, sid):
+        user = self._user(sid)
+        if user is None:
+            return None, False
+        pipe = self._redis.pipeline()
+        pipe.sadd(self._key('sid', sid, 'rooms'), room)
+        pipe.sadd(self._key('room', room, user['username']), sid)
+        pipe.scard(self._key('room', room, user['username']))
+        pipe.hset(self._key('room', room), user['username'], json.dumps(user))
+        _, _, count, _ = pipe.execute()
+        return user, count == 1
+
+    def leave(self, room, sid):
+        user = self._user(sid)
+        if user is None or not self._redis.srem(self._key('sid', sid, 'rooms'), room):
+            return user, False
+        return user, self._remove(room, sid, user)
+
+    def _remove(self, room, sid, user):
+        sids = self._key('room', room, user['username'])
+        self._redis.srem(sids, sid)
+
+        # WATCH makes the emptiness check and the hdel one step: a join from another
+        # tab in between aborts the transaction, and the retry sees its sid
+        def drop_if_empty(pipe):
+            empty = pipe.scard(sids) == 0
+            pipe.multi()
+            if empty:
+                pipe.hdel(self._key('room', room), user['username'])
+            return empty
+        return self._redis.transaction(drop_if_empty, sids, value_from_callable=True)
+
+    def rooms_of(self, sid):
+        return self._redis.smembers(self._key('sid', sid, 'rooms'))
+
+    def in_room(self, sid, room):
+        return bool(self._redis.sismember(self._key('sid', sid, 'rooms'), room))
+
+    def members(self, room):
+        return [json.loads(raw) for raw in self._redis.hvals(self._key('room', room))]
+
+    def is_online(self, username):
+        return self._redis.scard(self._key('online', username)) > 0
+
+    def heartbeat(self):
+        """Refresh this worker's heartbeat, then reap workers whose heartbeat expired.
+
+        Returns (user, rooms left) for every socket dropped, so the caller can
+        tell the rooms.
+        """
+        pipe = self._redis.pipeline()
+        pipe.set(self._key('worker', self.worker), 1, ex=self.ttl)
+        pipe.sadd(self._key('workers'), self.worker)
+        pipe.execute()
+        gone = []
+        for worker in self._redis.smembers(self._key('workers')):
+            if worker != self.worker and not self._redis.exists(self._key('worker', worker)):
+                gone += self.reap(worker)
+        return gone
+
+    def reap(self, worker):
+        """Disconnect every sid of ``worker``; only the caller that unregisters it does the work."""
+        if not self._redis.srem(self._key('workers'), worker):
+            return []
+        gone = []
+        for sid in self._redis.smembers(self._key('worker', worker, 'sids')):
+            user, left = self.disconnect(sid, worker)
+            if user is not None:
+                gone.append((user, left))
+        self._redis.delete(self._key('worker', worker), self._key('worker', worker, 'sids'))
+        return gone
+
+    def shutdown(self):
+        self.reap(self.worker)
+
+
+if app.config['PRESENCE_URL']:
+    if redis is None:
+        raise RuntimeError('CHATROOM_PRESENCE_URL is set but the redis package is not installed')
+    presence = RedisPresenceRegistry(app.config['PRESENCE_URL'], app.config['PRESENCE_TTL'])
+else:
+    presence = PresenceRegistry()
+
+# نشست سمت سرور: کوکی فقط شناسه نشست را دارد و داده در حافظه، SQLite یا Redis می‌ماند
+class MemorySessionStore:
+    """Sessions in process memory, least-recently-used first out past ``max_entries``.
+
+    Only for a single worker; sessions are lost on restart.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()     # sid -> (data, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._entries.get(sid)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[sid]
+                return None
+            self._entries.move_to_end(sid)
+            return dict(entry[0])
+
+    def set(self, sid, data, ttl):
+        with self._lock:
+            self._entries[sid] = (dict(data), time.time() + ttl)
+            self._entries.move_to_end(sid)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._entries.pop(sid, None)
+
+
+class SQLiteSessionStore:
+    """Sessions in the sessions table, shared by every worker on the host."""
+
+    PURGE_INTERVAL = 3600
+
+    def __init__(self):
+        self._last_purge = 0
+
+    def get(self, sid):
+        with get_db() as conn:
+            row = conn.execute('SELECT data FROM sessions WHERE id = ? AND expires_at > ?', (sid, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, sid, data, ttl):
+        now = time.time()
+        with get_write_db() as conn:
+            conn.execute('INSERT INTO sessions (id, data, expires_at) VALUES (?, ?, ?) '
+                         'ON CONFLICT (id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at',
+                         (sid, json.dumps(data), now + ttl))
+            if now - self._last_purge > self.PURGE_INTERVAL:
+                self._last_purge = now
+                conn.execute('DELETE FROM sessions WHERE expires_at <= ?', (now,))
+            conn.commit()
+
+    def delete(self, sid):
+        with get_write_db() as conn:
+            conn.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+            conn.commit()
+
+
+class RedisSessionStore:
+    """Sessions in a Redis-compatible server, expired by Redis itself."""
+
+    def __init__(self, url, prefix='chatroom:session'):
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    def get(self, sid):
+        raw = self._redis.get(f'{self._prefix}:{sid}')
+        return json.loads(raw) if raw else None
+
+    def set(self, sid, data, ttl):
+        self._redis.set(f'{self._prefix}:{sid}', json.dumps(data), ex=int(ttl))
+
+    def delete(self, sid):
+        self._redis.delete(f'{self._prefix}:{sid}')
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, data=None, sid=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(data, on_update)
+        self.sid = sid
+        self.previous_sid = None
+        self.modified = False
+
+    def rotate(self):
+        """Move the data to a fresh session id, e.g. on login, so a planted id is worthless."""
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = None
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps session data in ``store``; the cookie only carries a random session id."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        data = self.store.get(sid) if sid else None
+        if data is None:
+            return ServerSession()
+        return ServerSession(data, sid)
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.previous_sid:
+            self.store.delete(session.previous_sid)
+        if not session:
+            if session.modified and (session.sid or session.previous_sid):
+                if session.sid:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        self.store.set(session.sid, dict(session), app.permanent_session_lifetime.total_seconds())
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app), domain=domain, path=path,
+                            secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+
+if app.config['SESSION_STORE'] == 'memory':
+    session_store = MemorySessionStore()
+elif app.config['SESSION_STORE'] == 'sqlite':
+    session_store = SQLiteSessionStore()
+else:
+    if redis is None:
+        raise RuntimeError('CHATROOM_SESSION_STORE points at Redis but the redis package is not installed')
+    session_store = RedisSessionStore(app.config['SESSION_STORE'])
+app.session_interface = ServerSessionInterface(session_store)
+
+
+# کش کاربران: نشست فقط user_id دارد و رکورد کاربر از اینجا خوانده می‌شود
+class UserCache:
+    """Read-through cache of user records by id.
+
+    ``invalidate`` drops a record on this worker; other workers pick up
+    changes within ``ttl`` seconds.
+    """
+
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._users = OrderedDict()       # id -> (user dict or None, loaded at)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._users.move_to_end(user_id)
+                return entry[0]
+        with get_db() as conn:
+            row = conn.execute('SELECT id, username, email, avatar, bio FROM users WHERE id = ?', (user_id,)).fetchone()
+        user = {'id': row[0], 'username': row[1], 'email': row[2], 'avatar': row[3], 'bio': row[4],
+                'is_admin': row[0] == 1} if row else None
+        with self._lock:
+            self._users[user_id] = (user, now)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_entries:
+                self._users.popitem(last=False)
+        return user
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+
+user_cache = UserCache(app.config['USER_CACHE_TTL'])
+
+
+def current_user():
+    """The signed-in user's record, or None."""
+    user_id = session.get('user_id')
+    return user_cache.get(user_id) if user_id is not None else None
+
+
+# کش روم‌ها: شمارنده نسخه در دیتابیس به ورکرهای دیگر خبر می‌دهد که کپی‌شان کهنه شده
+class RoomsCache:
+    """Read-through cache of the rooms table, keyed by slug.
+
+    The shared version in cache_versions is re-checked at most every
+    ``check_interval`` seconds, so a change made by another worker shows up
+    within that window; changes made by this process show up immediately.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._rooms = None
+        self._by_slug = {}
+
+    def _load(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._rooms is not None and now - self._checked_at < self.check_interval:
+                self.hits += 1
+                return self._rooms, self._by_slug
+        with get_db() as conn:
+            version = conn.execute("SELECT version FROM cache_versions WHERE name = 'rooms'").fetchone()[0]
+            with self._lock:
+                if self._rooms is not None and version == self._version:
+                    self.hits += 1
+                    self._checked_at = now
+                    return self._rooms, self._by_slug
+            rows = conn.execute('SELECT id, slug, title, color, banner FROM rooms ORDER BY id').fetchall()
+        rooms = [{'id': r[0], 'slug': r[1], 'title': r[2], 'color': r[3], 'banner': r[4]} for r in rows]
+        by_slug = {room['slug']: room for room in rooms}
+        with self._lock:
+            self.misses += 1
+            self._rooms, self._by_slug = rooms, by_slug
+            self._version, self._checked_at = version, now
+        return rooms, by_slug
+
+    def all(self):
+        return self._load()[0]
+
+    def get(self, slug):
+        return self._load()[1].get(slug)
+
+    def invalidate(self, conn):
+        """Bump the shared version on ``conn`` (committed by the caller) and drop the local copy."""
+        conn.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'rooms'")
+        with self._lock:
+            self._rooms = None
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'version': self._version}
+
+
+rooms_cache = RoomsCache(app.config['ROOMS_CACHE_CHECK_INTERVAL'])
+
+# آخرین پیام‌های هر روم در حافظه تا ورود به روم به دیتابیس نرسد
+class RecentMessages:
+    """Ring buffer of the newest messages per room, shared by a single worker.
+
+    A room's buffer is always the exact tail of its history: it is loaded
+    from the database on first use, then appended to as the message writer
+    commits new rows, so every buffered message has its id.
+    Rooms are evicted least-recently-used first once ``max_bytes`` is exceeded.
+    Disabled (``per_room`` 0) when several workers share a message queue, since
+    a worker never sees messages sent through the others.
+    """
+
+    def __init__(self, per_room, max_bytes):
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._rooms = OrderedDict()   # room id -> deque of message dicts
+        self._sizes = {}              # room id -> approximate bytes held
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.per_room > 0
+
+    @staticmethod
+    def _size(message):
+        # str() so a row that is not text (e.g. stored before sends were validated) cannot break the count
+        return len(str(message['text'] or '')) + len(str(message['user'] or '')) + 200
+
+    def _load(self, room_id):
+        with get_db() as conn:
+            rows = conn.execute('SELECT m.id, u.username, m.text, m.timestamp FROM messages m JOIN users u ON m.user_id = u.id '
+                                'WHERE m.room_id = ? ORDER BY m.id DESC LIMIT ?', (room_id, self.per_room)).fetchall()
+        return [{'id': r[0], 'user': r[1], 'text': r[2], 'timestamp': r[3]} for r in reversed(rows)]
+
+    def _store(self, room_id, messages):
+        # caller holds the lock
+        self._drop(room_id)
+        self._rooms[room_id] = deque(messages, maxlen=self.per_room)
+        self._sizes[room_id] = sum(self._size(message) for message in messages)
+        self._bytes += self._sizes[room_id]
+        self._evict()
+
+    def _drop(self, room_id):
+        if self._rooms.pop(room_id, None) is not None:
+            self._bytes -= self._sizes.pop(room_id)
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._rooms) > 1:
+            self._drop(next(iter(self._rooms)))
+
+    def latest(self, room_id, limit):
+        """The newest ``limit`` messages of the room, oldest first."""
+        with self._lock:
+            buffer = self._rooms.get(room_id)
+            if buffer is not None:
+                self._rooms.move_to_end(room_id)
+                self.hits += 1
+            else:
+                # loading under the lock keeps appends from slipping in between the read and the store
+                self.misses += 1
+                self._store(room_id, self._load(room_id))
+                buffer = self._rooms[room_id]
+            return list(buffer)[-limit:]
+
+    def append(self, room_id, message):
+        """Add a committed message; rooms not loaded yet will read it from the database."""
+        with self._lock:
+            buffer = self._rooms.get(room_id)
+            if buffer is None or (buffer and buffer[-1]['id'] >= message['id']):
+                return
+            if len(buffer) == buffer.maxlen:
+                self._sizes[room_id] -= self._size(buffer[0])
+                self._bytes -= self._size(buffer[0])
+            buffer.append(message)
+            self._sizes[room_id] += self._size(message)
+            self._bytes += self._size(message)
+            self._rooms.move_to_end(room_id)
+            self._evict()
+
+    def discard(self, room_id=None):
+        """Forget one room, or every room when ``room_id`` is None."""
+        with self._lock:
+            if room_id is None:
+                self._rooms.clear()
+                self._sizes.clear()
+                self._bytes = 0
+            else:
+                self._drop(room_id)
+
+    def warm_up(self):
+        if not self.enabled:
+            return
+        for room in rooms_cache.all():
+            with self._lock:
+                self._store(room['id'], self._load(room['id']))
+
+    def stats(self):
+        with self._lock:
+            return {'rooms': len(self._rooms), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'per_room': self.per_room, 'hits': self.hits, 'misses': self.misses}
+
+
+recent_messages = RecentMessages(0 if app.config['MESSAGE_QUEUE'] else app.config['RECENT_MESSAGES_PER_ROOM'],
+                                 app.config['RECENT_MESSAGES_MAX_BYTES'])
+
+# گفتگوهای خصوصی: هر جفت کاربر یک گفتگو دارد و پیام‌هایش با (conversation_id, id) خوانده می‌شوند
+def private_schema(conversation_id):
+    """Attached schema holding the messages of ``conversation_id``."""
+    shards = len(db_pool.attach)
+    return f'dm{conversation_id % shards}' if shards else 'main'
+
+
+def private_schemas():
+    return list(db_pool.attach) or ['main']
+
+
+def _private_id_sql(schema):
+    # every shard hands out ids above the highest one any database has used, in its
+    # own residue class, so ids stay unique (and archivable) across files
+    if schema == 'main':
+        return 'NULL'
+    shards = len(db_pool.attach)
+    sequences = ', '.join(f"COALESCE((SELECT seq FROM {name}.sqlite_sequence WHERE name = 'private_messages'), 0)"
+                          for name in ['main', *db_pool.attach])
+    return f'(MAX({sequences}) / {shards} + 1) * {shards} + {schema[2:]}'
+
+
+def find_conversation(user_id, other_id):
+    with get_db() as conn:
+        row = conn.execute('SELECT id FROM conversations WHERE user_low = ? AND user_high = ?',
+                           (min(user_id, other_id), max(user_id, other_id))).fetchone()
+    return row[0] if row else None
+
+
+def private_room(user_id, other_id):
+    """Socket.IO room of the conversation between two users, named by their ids.
+
+    Usernames may contain ``_``, so a name built from them could belong to
+    two different pairs; integer ids cannot.
+    """
+    return f'private_{min(user_id, other_id)}_{max(user_id, other_id)}'
+
+
+def open_conversation(user_id, other_id):
+    """Id of the conversation between two users, created on first use."""
+    conversation_id = find_conversation(user_id, other_id)
+    if conversation_id is None:
+        with get_write_db() as conn:
+            conn.execute('INSERT OR IGNORE INTO conversations (user_low, user_high, created_at) VALUES (?, ?, ?)',
+                         (min(user_id, other_id), max(user_id, other_id), datetime.now().isoformat()))
+            conn.commit()
+        conversation_id = find_conversation(user_id, other_id)
+    return conversation_id
+
+
+def submit_private_message(conversation_id, from_user_id, to_user_id, text, timestamp):
+    schema = private_schema(conversation_id)
+    return message_writer.submit(
+        f'INSERT INTO {schema}.private_messages (id, conversation_id, from_user_id, to_user_id, text, timestamp) '
+        f'VALUES ({_private_id_sql(schema)}, ?, ?, ?, ?, ?)',
+        (conversation_id, from_user_id, to_user_id, text, timestamp))
+
+
+def private_history(conversation_id, before, limit):
+    """Messages of a conversation with id < ``before``, oldest first, in the /private-messages format."""
+    with get_db() as conn:
+        rows = conn.execute(f'SELECT pm.id, u.username, pm.text, pm.timestamp FROM {private_schema(conversation_id)}.private_messages pm '
+                            'JOIN users u ON u.id = pm.from_user_id '
+                            'WHERE pm.conversation_id = ? AND pm.id < ? ORDER BY pm.id DESC LIMIT ?',
+                            (conversation_id, before, limit)).fetchall()
+    return [{'id': r[0], 'from': r[1], 'text': r[2], 'timestamp': r[3]} for r in reversed(rows)]
+
+
+def mark_private_read(conversation_id, user_id):
+    # queued behind any messages of the conversation that are not written yet
+    message_writer.submit(f'UPDATE {private_schema(conversation_id)}.private_messages SET read = 1 '
+                          'WHERE conversation_id = ? AND to_user_id = ? AND read = 0', (conversation_id, user_id))
+
+
+# بایگانی پیام‌های قدیمی: فایل‌های SQLite ماهانه با متن فشرده، جدول اصلی کوچک می‌ماند
+ARCHIVE_SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        room_id INTEGER,
+        user_id INTEGER,
+        username TEXT,
+        text BLOB,
+        timestamp TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_messages_room_id ON messages (room_id, id)',
+    '''CREATE TABLE IF NOT EXISTS private_messages (
+        id INTEGER PRIMARY KEY,
+        from_user_id INTEGER,
+        to_user_id INTEGER,
+        from_username TEXT,
+        text BLOB,
+        timestamp TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_private_messages_pair ON private_messages (from_user_id, to_user_id, id)',
+)
+
+
+def _pack_text(text):
+    # zlib only pays off on longer messages; short ones stay TEXT
+    raw = (text or '').encode()
+    packed = zlib.compress(raw, 9)
+    return packed if len(packed) < len(raw) else text
+
+
+def _unpack_text(value):
+    return zlib.decompress(value).decode() if isinstance(value, bytes) else value
+
+
+def _archive_path(month):
+    return os.path.join(app.config['ARCHIVE_DIR'], f'messages-{month}.db')
+
+
+def _archive_months():
+    """Archived months, newest first."""
+    if not os.path.isdir(app.config['ARCHIVE_DIR']):
+        return []
+    names = (re.fullmatch(r'messages-(\d{4}-\d{2})\.db', name) for name in os.listdir(app.config['ARCHIVE_DIR']))
+    return sorted((match.group(1) for match in names if match), reverse=True)
+
+
+def _write_archive(table, rows):
+    """Copy ``rows`` (already compressed) into their monthly archive files and commit them."""
+    by_month = {}
+    for row in rows:
+        by_month.setdefault(row[-1][:7], []).append(row)
+    os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+    for month, month_rows in by_month.items():
+        archive = sqlite3.connect(_archive_path(month))
+        try:
+            for statement in ARCHIVE_SCHEMA:
+                archive.execute(statement)
+            archive.executemany(f'INSERT OR IGNORE INTO {table} VALUES (?, ?, ?, ?, ?, ?)', month_rows)
+            archive.commit()
+        finally:
+            archive.close()
+
+
+def _read_archive(sql, params, limit):
+    """Run ``sql`` against archive months newest first until ``limit`` rows are found."""
+    rows = []
+    for month in _archive_months():
+        archive = sqlite3.connect(f'file:{_archive_path(month)}?mode=ro', uri=True)
+        try:
+            rows += archive.execute(sql, params + (limit - len(rows),)).fetchall()
+        finally:
+            archive.close()
+        if len(rows) >= limit:
+            break
+    return rows
+
+
+def _pair_key(user_id, other_id):
+    return f'{min(user_id, other_id)}:{max(user_id, other_id)}'
+
+
+def _has_archive(kind, key):
+    # saves opening every monthly file for conversations that were never archived
+    with get_db() as conn:
+        return conn.execute('SELECT 1 FROM archived_conversations WHERE kind = ? AND key = ?', (kind, key)).fetchone() is not None
+
+
+class ArchivedRooms:
+    """Ids of the rooms that have messages in the archive, so history pages of other rooms skip it without a query.
+
+    Shared like RoomsCache: the archiver bumps the 'archived_rooms' version in
+    cache_versions, and other workers re-read the set within ``check_interval``
+    seconds.
+    """
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._version = None
+        self._checked_at = 0.0
+        self._room_ids = None
+
+    def _load(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._room_ids is not None and now - self._checked_at < self.check_interval:
+                return self._room_ids
+        with get_db() as conn:
+            version = conn.execute("SELECT version FROM cache_versions WHERE name = 'archived_rooms'").fetchone()[0]
+            with self._lock:
+                if self._room_ids is not None and version == self._version:
+                    self._checked_at = now
+                    return self._room_ids
+            room_ids = {int(key) for (key,) in conn.execute("SELECT key FROM archived_conversations WHERE kind = 'room'")}
+        with self._lock:
+            self._room_ids, self._version, self._checked_at = room_ids, version, now
+        return room_ids
+
+    def has(self, room_id):
+        return room_id in self._load()
+
+    def invalidate(self, conn):
+        """Bump the shared version on ``conn`` (committed by the caller) and drop the local copy."""
+        conn.execute("UPDATE cache_versions SET version = version + 1 WHERE name = 'archived_rooms'")
+        with self._lock:
+            self._room_ids = None
+
+
+archived_rooms = ArchivedRooms(app.config['ROOMS_CACHE_CHECK_INTERVAL'])
+
+
+def archived_room_messages(room_id, before, limit):
+    """Archived messages of a room with id < ``before``, oldest first, in the /messages format."""
+    if not archived_rooms.has(room_id):
+        return []
+    rows = run_blocking(_read_archive, 'SELECT id, username, text, timestamp FROM messages '
+                        'WHERE room_id = ? AND id < ? AND username IS NOT NULL ORDER BY id DESC LIMIT ?',
+                        (room_id, before), limit)
+    return [{'id': r[0], 'user': r[1], 'text': _unpack_text(r[2]), 'timestamp': r[3]} for r in reversed(rows)]
+
+
+def archived_private_messages(user_id, other_id, before, limit):
+    """Archived messages between two users with id < ``before``, oldest first, in the /private-messages format."""
+    if not _has_archive('private', _pair_key(user_id, other_id)):
+        return []
+    rows = run_blocking(_read_archive, 'SELECT id, from_username, text, timestamp FROM private_messages '
+                        'WHERE ((from_user_id = ? AND to_user_id = ?) OR (from_user_id = ? AND to_user_id = ?)) '
+                        'AND id < ? ORDER BY id DESC LIMIT ?', (user_id, other_id, other_id, user_id, before), limit)
+    return [{'id': r[0], 'from': r[1], 'text': _unpack_text(r[2]), 'timestamp': r[3]} for r in reversed(rows)]
+
+
+def _archive_batch(table, select_sql, params, schema='main'):
+    """Move one batch of the rows ``select_sql`` picks out of ``table``; return how many moved.
+
+    ``select_sql`` does the age filtering itself, so every row of a full batch
+    is moved and a short batch means nothing is left to archive.
+    Rows are committed to the archive before they are deleted here, so a crash
+    in between only leaves duplicates that the next run skips.
+    """
+    with get_db() as conn:
+        rows = conn.execute(select_sql, params + (app.config['ARCHIVE_BATCH_SIZE'],)).fetchall()
+    if not rows:
+        return 0
+    rows = [row[:4] + (_pack_text(row[4]),) + row[5:] for row in rows]
+    run_blocking(_write_archive, table, rows)
+    if table == 'messages':
+        conversations = {('room', str(row[1])) for row in rows}
+        new_rooms = any(not archived_rooms.has(row[1]) for row in rows)
+    else:
+        conversations = {('private', _pair_key(row[1], row[2])) for row in rows}
+        new_rooms = False
+    with get_write_db() as conn:
+        conn.executemany('INSERT OR IGNORE INTO archived_conversations (kind, key) VALUES (?, ?)', conversations)
+        if new_rooms:
+            archived_rooms.invalidate(conn)
+        conn.executemany(f'DELETE FROM {schema}.{table} WHERE id = ?', [(row[0],) for row in rows])
+        conn.commit()
+    return len(rows)
+
+
+def _archive_room(room_id, days, now):
+    if days <= 0:
+        return 0
+    cutoff = (now - timedelta(days=days)).isoformat()
+    moved = 0
+    # oldest rows first through the (room_id, id) index; rows without a timestamp are kept
+    while True:
+        count = _archive_batch('messages', 'SELECT m.id, m.room_id, m.user_id, u.username, m.text, m.timestamp '
+                               'FROM messages m LEFT JOIN users u ON u.id = m.user_id '
+                               'WHERE m.room_id = ? AND m.timestamp < ? ORDER BY m.id LIMIT ?', (room_id, cutoff))
+        moved += count
+        if count < app.config['ARCHIVE_BATCH_SIZE']:
+            return moved
+
+
+def archive_messages(now=None):
+    """Apply the retention policies once; return the number of rows archived."""
+    now = now or datetime.now()
+    moved = 0
+    with get_db() as conn:
+        policies = conn.execute('SELECT id, retention_days FROM rooms').fetchall()
+    for room_id, days in policies:
+        # one room with a bad policy or a failing batch must not hold up the others
+        try:
+            moved += _archive_room(room_id, app.config['ARCHIVE_AFTER_DAYS'] if days is None else days, now)
+        except Exception:
+            app.logger.exception('archiving room %s (retention_days=%r) failed', room_id, days)
+    days = app.config['PRIVATE_ARCHIVE_AFTER_DAYS']
+    if days > 0:
+        cutoff = (now - timedelta(days=days)).isoformat()
+        for schema in private_schemas():
+            while True:
+                count = _archive_batch('private_messages', 'SELECT pm.id, pm.from_user_id, pm.to_user_id, u.username, pm.text, pm.timestamp '
+                                       f'FROM {schema}.private_messages pm LEFT JOIN users u ON u.id = pm.from_user_id '
+                                       'WHERE pm.timestamp < ? ORDER BY pm.id LIMIT ?', (cutoff,), schema)
+                moved += count
+                if count < app.config['ARCHIVE_BATCH_SIZE']:
+                    break
+    return moved
+
+
+def run_archiver(interval):
+    while True:
+        try:
+            moved = archive_messages()
+            if moved:
+                app.logger.info('archived %d messages', moved)
+        except Exception:
+            app.logger.exception('message archiving failed')
+        socketio.sleep(interval)
+
+
+# کپی فقط‌خواندنی دیتابیس برای کوئری‌های مدیریتی و گزارش‌ها، جدا از خواننده‌های مسیر داغ
+def refresh_read_replica():
+    """Copy DATABASE to READ_REPLICA with the backup API and swap the copy in atomically.
+
+    The copy reads one WAL snapshot, so it never blocks the writer. Private
+    message shards are not copied.
+    """
+    path = app.config['READ_REPLICA']
+    partial = f'{path}.partial'
+
+    def copy():
+        source = sqlite3.connect(app.config['DATABASE'])
+        target = sqlite3.connect(partial)
+        try:
+            source.backup(target)
+            # readers open the file read-only, which a WAL database does not allow without its -shm
+            target.execute('PRAGMA journal_mode = DELETE')
+        finally:
+            target.close()
+            source.close()
+
+    run_blocking(copy)
+    os.replace(partial, path)
+
+
+def run_presence_heartbeat(interval):
+    while True:
+        try:
+            for user, left in presence.heartbeat():
+                for room in left:
+                    socketio.emit('userLeft', {'username': user['username']}, to=room_targets(room))
+        except Exception:
+            app.logger.exception('presence heartbeat failed')
+        socketio.sleep(interval)
+
+
+def run_replica_refresher(interval):
+    while True:
+        try:
+            started = time.monotonic()
+            refresh_read_replica()
+            app.logger.info('read replica refreshed in %.1fs', time.monotonic() - started)
+        except Exception:
+            app.logger.exception('read replica refresh failed')
+        socketio.sleep(interval)
+
+
+# شمارش پیام‌های خوانده‌نشده با نشانگر خواندن هر کاربر در هر روم
+def unread_counts(user_id):
+    """Unread messages per room slug for ``user_id``, each capped at UNREAD_COUNT_CAP."""
+    counts = {}
+    with get_db() as conn:
+        cursors = dict(conn.execute('SELECT room_id, last_read_message_id FROM read_cursors WHERE user_id = ?',
+                                    (user_id,)).fetchall())
+        for room in rooms_cache.all():
+            count = conn.execute('SELECT COUNT(*) FROM (SELECT 1 FROM messages WHERE room_id = ? AND id > ? LIMIT ?)',
+                                 (room['id'], cursors.get(room['id'], 0), UNREAD_COUNT_CAP)).fetchone()[0]
+            if count:
+                counts[room['slug']] = count
+    return counts
+
+
+def mark_room_read(user_id, room_id):
+    """Move the user's cursor to the newest message in the room.
+
+    Goes through the message writer so the cursor lands after any messages
+    still queued for that room.
+    """
+    message_writer.submit(MARK_ROOM_READ_SQL, (user_id, room_id, room_id))
+
+
+def room_history(room_id, before=None, limit=MESSAGES_PAGE_SIZE):
+    """A page of room messages older than ``before`` (newest page if None), oldest first."""
+    if before is None and limit <= recent_messages.per_room:
+        messages = recent_messages.latest(room_id, limit)
+    else:
+        with get_db() as conn:
+            c = conn.cursor()
+            if before is None:
+                c.execute('SELECT m.id, u.username, m.text, m.timestamp FROM messages m JOIN users u ON m.user_id = u.id '
+                          'WHERE m.room_id = ? ORDER BY m.id DESC LIMIT ?', (room_id, limit))
+            else:
+                c.execute('SELECT m.id, u.username, m.text, m.timestamp FROM messages m JOIN users u ON m.user_id = u.id '
+                          'WHERE m.room_id = ? AND m.id < ? ORDER BY m.id DESC LIMIT ?', (room_id, before, limit))
+            messages = [{'id': r[0], 'user': r[1], 'text': r[2], 'timestamp': r[3]} for r in reversed(c.fetchall())]
+    if len(messages) < limit:
+        # a short page holds the oldest hot row of the room (the recent buffer is its exact tail),
+        # so older messages can only be in the archive; archived_rooms answers that from memory
+        oldest = messages[0]['id'] if messages else (before or sys.maxsize)
+        messages = archived_room_messages(room_id, oldest, limit - len(messages)) + messages
+    return messages
+
+# داده‌های اولیه صفحه: روم‌ها، خوانده‌نشده‌ها، کاربران آنلاین و آخرین صفحه روم پیش‌فرض در یک پاسخ
+def bootstrap_data(user, slug=None):
+    """Everything the page needs before its first round trip.
+
+    Nothing is marked read; that happens when the client's socket joins the room.
+    """
+    rooms = rooms_cache.all()
+    room = rooms_cache.get(slug or app.config['DEFAULT_ROOM']) or (rooms[0] if rooms else None)
+    return {
+        'rooms': rooms,
+        'unread': unread_counts(user['id']),
+        'room': room['slug'] if room else None,
+        'messages': room_history(room['id']) if room else [],
+        'users': presence.members(room['slug']) if room else [],
+    }
+
+# جستجوی متن کامل در پیام‌های روم و پیام‌های خصوصی با FTS5
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_OFFSET = 1000
+SEARCH_MAX_TERMS = 8
+_SNIPPET_OPEN, _SNIPPET_CLOSE = '\ue000', '\ue001'
+_FTS_FOLD_TABLE = str.maketrans(dict(FTS_CHAR_FOLDS))
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match, the last one as a prefix.
+
+    Words are quoted so FTS5 operators typed by users are treated as text.
+    Returns None when the text has no searchable words.
+    """
+    terms = re.findall(r'\w+', text.translate(_FTS_FOLD_TABLE))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"' for term in terms) + '*'
+
+
+def _snippet_html(snippet):
+    # messages may hold markup; escape it and only let the match markers through as HTML
+    return (html.escape(snippet)
+            .replace(_SNIPPET_OPEN, '<mark>').replace(_SNIPPET_CLOSE, '</mark>'))
+
+
+def search_messages(user_id, query, scope='all', room_id=None, with_user_id=None, limit=SEARCH_PAGE_SIZE, offset=0):
+    """Rank room and private messages visible to ``user_id`` against an FTS5 ``query``.
+
+    Room messages are visible to every signed-in user; private messages only
+    to their sender and recipient.
+    """
+    parts, params = [], []
+    if scope in ('all', 'rooms') and with_user_id is None:
+        sql = ("SELECT 'room', m.id, m.room_id, u.username, NULL, m.timestamp, "
+               "snippet(messages_fts, 0, ?, ?, '…', 12), messages_fts.rank "
+               'FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN users u ON u.id = m.user_id '
+               'WHERE messages_fts MATCH ?')
+        params += [_SNIPPET_OPEN, _SNIPPET_CLOSE, query]
+        if room_id is not None:
+            sql += ' AND m.room_id = ?'
+            params.append(room_id)
+        parts.append(sql)
+    if scope in ('all', 'private') and room_id is None:
+        if with_user_id is None:
+            schemas, conversation_id = private_schemas(), None
+        else:
+            conversation_id = find_conversation(user_id, with_user_id)
+            schemas = [private_schema(conversation_id)] if conversation_id else []
+        # one part per shard; FTS5 tables in attached databases are matched by their bare name
+        for schema in schemas:
+            sql = ("SELECT 'private', pm.id, NULL, f.username, t.username, pm.timestamp, "
+                   "snippet(private_messages_fts, 0, ?, ?, '…', 12), private_messages_fts.rank "
+                   f'FROM {schema}.private_messages_fts JOIN {schema}.private_messages pm ON pm.id = private_messages_fts.rowid '
+                   'JOIN users f ON f.id = pm.from_user_id JOIN users t ON t.id = pm.to_user_id '
+                   'WHERE private_messages_fts MATCH ?')
+            params += [_SNIPPET_OPEN, _SNIPPET_CLOSE, query]
+            if conversation_id is None:
+                sql += ' AND (pm.from_user_id = ? OR pm.to_user_id = ?)'
+                params += [user_id, user_id]
+            else:
+                sql += ' AND pm.conversation_id = ?'
+                params.append(conversation_id)
+            parts.append(sql)
+    if not parts:
+        return []
+    rooms = {room['id']: room['slug'] for room in rooms_cache.all()}
+    with get_db() as conn:
+        rows = conn.execute(' UNION ALL '.join(parts) + ' ORDER BY 8 LIMIT ? OFFSET ?',
+                            params + [limit, offset]).fetchall()
+    results = []
+    for kind, message_id, room, sender, recipient, timestamp, snippet, _ in rows:
+        result = {'type': kind, 'id': message_id, 'user': sender, 'timestamp': timestamp,
+                  'snippet': _snippet_html(snippet)}
+        if kind == 'room':
+            result['roomId'] = rooms.get(room)
+        else:
+            result['to'] = recipient
+        results.append(result)
+    return results
+
+
+# نشانگر تایپ: وضعیت هر روم روی سرور جمع می‌شود و در هر تیک حداکثر یک بار پخش می‌شود
+TYPING_TIMEOUT = 5
+TYPING_NAMES_SHOWN = 3
+
+
+class TypingTracker:
+    """Per-room typing state, broadcast as one aggregated update per room per tick.
+
+    Keystrokes only refresh a deadline; a room is re-broadcast when someone
+    starts or stops typing. Each worker reports its own typists under its
+    ``worker_id`` and clients merge the reports.
+    """
+
+    def __init__(self, tick, timeout=TYPING_TIMEOUT):
+        self.tick = tick
+        self.timeout = timeout
+        self.worker_id = uuid.uuid4().hex[:8]
+        self._rooms = {}          # room -> {username: deadline}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._task = None
+
+    def start(self, room, username):
+        with self._lock:
+            typists = self._rooms.setdefault(room, {})
+            if username not in typists:
+                self._dirty.add(room)
+            typists[username] = time.monotonic() + self.timeout
+            if self._task is None:
+                self._task = socketio.start_background_task(self._run)
+
+    def stop(self, room, username):
+        with self._lock:
+            if self._rooms.get(room, {}).pop(username, None) is not None:
+                self._dirty.add(room)
+
+    def _collect(self):
+        """Drop expired typists; return (room, usernames) for every room that changed."""
+        now = time.monotonic()
+        with self._lock:
+            for room, typists in self._rooms.items():
+                expired = [username for username, deadline in typists.items() if deadline <= now]
+                for username in expired:
+                    del typists[username]
+                if expired:
+                    self._dirty.add(room)
+            changed = [(room, sorted(self._rooms.get(room, {}))) for room in self._dirty]
+            self._dirty.clear()
+            for room, usernames in changed:
+                if not usernames:
+                    self._rooms.pop(room, None)
+        return changed
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.tick)
+            for room, usernames in self._collect():
+                socketio.emit('typingUsers', {'roomId': room, 'worker': self.worker_id,
+                                              'users': usernames[:TYPING_NAMES_SHOWN], 'count': len(usernames)},
+                              to=room_targets(room))
+
+
+typing_tracker = TypingTracker(app.config['TYPING_TICK_MS'] / 1000)
+
+
+# نشان خوانده‌نشده‌ها: شمار پیام‌های هر روم در هر تیک یک بار برای همه پخش می‌شود
+class RoomActivity:
+    """Counts new messages per room and broadcasts the counts once per tick.
+
+    Every connected client needs these for its unread badges, so one
+    broadcast per message would cost a full fan-out per message.
+    """
+
+    def __init__(self, tick):
+        self.tick = tick
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    def add(self, room):
+        with self._lock:
+            self._counts[room] = self._counts.get(room, 0) + 1
+            if self._task is None:
+                self._task = socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.tick)
+            with self._lock:
+                counts, self._counts = self._counts, {}
+            if counts:
+                socketio.emit('roomActivity', {'rooms': counts})
+
+
+room_activity = RoomActivity(app.config['ACTIVITY_TICK_MS'] / 1000)
+
+
+class RateLimiter:
+    """Token buckets per (connection, event): ``rate`` events per second, bursting to ``burst``.
+
+    Keys other than socket ids (client IPs, account names) are never
+    forgotten explicitly; once SWEEP_AT buckets exist, the full ones are
+    dropped, since a missing bucket starts full anyway.
+    """
+
+    SWEEP_AT = 10000
+
+    def __init__(self, limits):
+        self.limits = limits      # event -> (rate, burst)
+        self._buckets = {}        # (sid, event) -> [tokens, last refill]
+        self._lock = threading.Lock()
+
+    def allow(self, sid, event):
+        rate, burst = self.limits[event]
+        now = time.monotonic()
+        with self._lock:
+            if len(self._buckets) >= self.SWEEP_AT:
+                self._sweep(now)
+            bucket = self._buckets.setdefault((sid, event), [burst, now])
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                return False
+            bucket[0] -= 1
+            return True
+
+    def forget(self, sid):
+        with self._lock:
+            for event in self.limits:
+                self._buckets.pop((sid, event), None)
+
+    def _sweep(self, now):
+        for key, (tokens, last) in list(self._buckets.items()):
+            rate, burst = self.limits[key[1]]
+            if tokens + (now - last) * rate >= burst:
+                del self._buckets[key]
+
+
+rate_limiter = RateLimiter({
+    'sendMessage': (app.config['MESSAGE_RATE'], app.config['MESSAGE_BURST']),
+    'typing': (app.config['TYPING_RATE'], app.config['TYPING_BURST']),
+})
+
+# هش رمز عبور در پروسه‌های جدا؛ تلاش‌های ورود پیش از رسیدن به آن‌ها برای هر IP و هر حساب محدود می‌شوند
+class PasswordHasher:
+    """Hashes and checks passwords in a process pool so scrypt never runs on a request thread.
+
+    At most ``queue_size`` jobs are in flight; past that ``hash`` and
+    ``check`` return None right away and callers answer 503 instead of
+    queueing more CPU work behind a login storm.
+    """
+
+    def __init__(self, workers, queue_size, method):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.method = method
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._prefix = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+
+    def _call(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.queue_size:
+                self.rejected += 1
+                return None
+            if self._executor is None:
+                self._executor = spawn_pool(self.workers)
+            self.pending += 1
+        try:
+            return self._executor.submit(fn, *args).result()
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+
+    def hash(self, password):
+        return self._call(hash_password, password, self.method)
+
+    def check(self, pwhash, password):
+        return self._call(check_password, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether ``pwhash`` was made with another method or cost than the configured one."""
+        if self._prefix is None:
+            # werkzeug fills in default parameters, so compare against a real hash;
+            # concurrent logins wait for one probe instead of each hashing their own
+            with self._probe_lock:
+                if self._prefix is None:
+                    sample = self.hash('')
+                    if sample is None:
+                        return False
+                    self._prefix = sample.split('$', 1)[0]
+        return pwhash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'method': self.method, 'pending': self.pending,
+                    'completed': self.completed, 'rejected': self.rejected}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+password_hasher = PasswordHasher(app.config['PASSWORD_WORKERS'], app.config['PASSWORD_QUEUE_SIZE'],
+                                 app.config['PASSWORD_HASH_METHOD'])
+atexit.register(password_hasher.shutdown)
+auth_limiter = RateLimiter({
+    'ip': (app.config['LOGIN_IP_RATE'], app.config['LOGIN_IP_BURST']),
+    'account': (app.config['LOGIN_ACCOUNT_RATE'], app.config['LOGIN_ACCOUNT_BURST']),
+})
+
+
+def auth_throttled(account=None):
+    """Error response when this client (or ``account``) is out of login attempts, else None."""
+    if not auth_limiter.allow(request.remote_addr, 'ip'):
+        reason = 'ip'
+    elif account and not auth_limiter.allow(account.strip().lower(), 'account'):
+        reason = 'account'
+    else:
+        return None
+    AUTH_REJECTED.inc(reason)
+    error = 'تلاش‌های زیادی انجام شد، کمی بعد دوباره امتحان کنید' if session.get('lang', 'fa') == 'fa' else 'Too many attempts, try again shortly'
+    return jsonify({'success': False, 'error': error}), 429
+
+
+def credentials_missing():
+    error = 'نام کاربری و رمز عبور الزامی است' if session.get('lang', 'fa') == 'fa' else 'Username and password are required'
+    return jsonify({'success': False, 'error': error}), 400
+
+
+def hasher_busy():
+    AUTH_REJECTED.inc('busy')
+    error = 'سرور مشغول است، کمی بعد دوباره امتحان کنید' if session.get('lang', 'fa') == 'fa' else 'Server is busy, try again shortly'
+    return jsonify({'success': False, 'error': error}), 503
+
+
+# آپلود فایل: تکه‌تکه و قابل ادامه، مستقیم روی دیسک، با حذف فایل‌های تکراری بر اساس هش
+UPLOAD_SESSION_TTL = 24 * 3600
+
+
+MEDIA_DIRS = {'uploads': app.config['UPLOAD_DIR'], 'avatars': app.config['AVATAR_DIR']}
+
+
+def media_path(url):
+    """Disk path of a /static/uploads/... or /static/avatars/... URL."""
+    kind, filename = url[len('/static/'):].split('/', 1)
+    return os.path.join(MEDIA_DIRS[kind], filename)
+
+
+def move_legacy_media():
+    """Move uploads and avatars out of static/, where they were kept before MEDIA_DIR."""
+    for kind, directory in MEDIA_DIRS.items():
+        legacy = os.path.join('static', kind)
+        if os.path.isdir(legacy) and not os.path.exists(directory):
+            os.makedirs(os.path.dirname(directory), exist_ok=True)
+            os.replace(legacy, directory)
+    legacy_partial = os.path.join(app.config['UPLOAD_DIR'], '.partial')
+    if os.path.isdir(legacy_partial) and not os.path.exists(app.config['PARTIAL_UPLOAD_DIR']):
+        os.makedirs(os.path.dirname(app.config['PARTIAL_UPLOAD_DIR']), exist_ok=True)
+        os.replace(legacy_partial, app.config['PARTIAL_UPLOAD_DIR'])
+
+
+def _partial_upload_path(upload_id):
+    return os.path.join(app.config['PARTIAL_UPLOAD_DIR'], upload_id)
+
+
+@contextmanager
+def _locked_partial_upload(upload_id):
+    """Open the partial file of ``upload_id`` under an exclusive flock; yield None while another request holds it.
+
+    The lock is taken without blocking so an eventlet worker never stalls on it,
+    and it is shared across workers since they all see the same file.
+    """
+    # raises FileNotFoundError once the upload has expired or been completed
+    with open(_partial_upload_path(upload_id), 'r+b') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield None
+            return
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _copy_stream(stream, out, limit):
+    """Copy ``stream`` into ``out`` in UPLOAD_READ_SIZE pieces; return bytes written, or -1 past ``limit``."""
+    written = 0
+    while True:
+        chunk = stream.read(app.config['UPLOAD_READ_SIZE'])
+        if not chunk:
+            return written
+        written += len(chunk)
+        if written > limit:
+            return -1
+        out.write(chunk)
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(app.config['UPLOAD_READ_SIZE']), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _user_upload_usage(conn, user_id):
+    # each stored file counts once per user, however often they upload it again
+    stored = conn.execute('SELECT COALESCE(SUM(size), 0) FROM uploads WHERE hash IN '
+                          '(SELECT hash FROM user_uploads WHERE user_id = ?)', (user_id,)).fetchone()[0]
+    pending = conn.execute('SELECT COALESCE(SUM(size), 0) FROM upload_sessions WHERE user_id = ?', (user_id,)).fetchone()[0]
+    return stored + pending
+
+
+def _upload_charge(conn, user_id, digest, size):
+    """Bytes a finished file adds to the user's usage: nothing if they already reference its hash."""
+    held = conn.execute('SELECT 1 FROM user_uploads WHERE user_id = ? AND hash = ?', (user_id, digest)).fetchone()
+    return 0 if held else size
+
+
+def store_upload(path, filename, user_id, digest=None):
+    """Move the finished file at ``path`` into content-addressed storage and return its URL.
+
+    A file whose hash is already stored is dropped and the existing copy is
+    referenced instead.
+    """
+    digest = digest or _file_digest(path)
+    size = os.path.getsize(path)
+    stored_name = digest + os.path.splitext(secure_filename(filename))[1].lower()[:16]
+    with get_write_db() as conn:
+        row = conn.execute('SELECT path FROM uploads WHERE hash = ?', (digest,)).fetchone()
+        if row:
+            os.remove(path)
+            url = row[0]
+        else:
+            url = f"/static/uploads/{stored_name}"
+            os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
+            os.replace(path, media_path(url))
+            conn.execute('INSERT OR IGNORE INTO uploads (hash, size, path, created_at) VALUES (?, ?, ?, ?)',
+                         (digest, size, url, datetime.now().isoformat()))
+        conn.execute('INSERT INTO user_uploads (user_id, hash, filename, created_at) VALUES (?, ?, ?, ?)',
+                     (user_id, digest, filename, datetime.now().isoformat()))
+        conn.commit()
+    return url, digest
+
+
+def expire_upload_sessions(conn):
+    cutoff = time.time() - UPLOAD_SESSION_TTL
+    for (upload_id,) in conn.execute('SELECT id FROM upload_sessions WHERE created_at < ?', (cutoff,)).fetchall():
+        try:
+            os.remove(_partial_upload_path(upload_id))
+        except FileNotFoundError:
+            pass
+        conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+
+# پردازش تصویر در پروسه‌های جدا: تصاویر کوچک WebP بدون متادیتا برای آواتارها و آپلودها
+AVATAR_SIZES = (40, 80, 128)
+UPLOAD_PREVIEW_SIZES = (320, 960)
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'}
+
+
+class ImagePipeline:
+    """Resizes images in a process pool so request threads never decode pixels.
+
+    Does nothing when Pillow is not installed; callers then keep serving the
+    original files.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pending = 0
+        self.processed = 0
+        self.failed = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def submit(self, path, sizes, crop=False):
+        if not self.available:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = spawn_pool(self.workers)
+            self.pending += 1
+        future = self._executor.submit(make_image_variants, path, sizes, crop)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        error = future.exception()
+        with self._lock:
+            self.pending -= 1
+            if error is None:
+                self.processed += 1
+            else:
+                self.failed += 1
+        if error is not None:
+            app.logger.error('image processing failed: %s', error)
+
+    def stats(self):
+        with self._lock:
+            return {'available': self.available, 'workers': self.workers, 'queue_depth': self.pending,
+                    'processed': self.processed, 'failed': self.failed}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+image_pipeline = ImagePipeline(app.config['IMAGE_WORKERS'])
+atexit.register(image_pipeline.shutdown)
+
+
+def save_avatar(avatar, username):
+    """Save an uploaded avatar, queue its thumbnails and return its URL."""
+    url = f"/static/avatars/{secure_filename(f'{username}_{avatar.filename}')}"
+    os.makedirs(app.config['AVATAR_DIR'], exist_ok=True)
+    avatar.save(media_path(url))
+    image_pipeline.submit(media_path(url), AVATAR_SIZES, crop=True)
+    return url
+
+
+def avatar_url(url, size):
+    """URL of the smallest avatar variant at least ``size`` px wide, or ``url`` until one exists."""
+    for candidate in AVATAR_SIZES:
+        if candidate >= size:
+            variant = image_variant_path(url, candidate)
+            if os.path.exists(media_path(variant)):
+                return variant
+            break
+    return url
+
+
+def queue_upload_preview(url):
+    """Queue previews for an uploaded image; return the preview URL, or None for other files."""
+    if not image_pipeline.available or os.path.splitext(url)[1] not in IMAGE_EXTENSIONS:
+        return None
+    preview = image_variant_path(url, UPLOAD_PREVIEW_SIZES[0])
+    if not os.path.exists(media_path(preview)):
+        image_pipeline.submit(media_path(url), UPLOAD_PREVIEW_SIZES)
+    return preview
 
 # HTML Template
 HTML_TEMPLATE = '''
 <!DOCTYPE html>
-<html lang="{{ 'fa' if session.get('lang', 'fa') == 'fa' else 'en' }}" dir="{{ 'rtl' if session.get('lang', 'fa') == 'fa' else 'ltr' }}">
+<html lang="{{ 'fa' if lang == 'fa' else 'en' }}" dir="{{ 'rtl' if lang == 'fa' else 'ltr' }}">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
@@ -92,13 +2613,14 @@ HTML_TEMPLATE = '''
     </style>
 </head>
 <body>
+    <script>/*page-data*/</script>
     <!-- هدر ثابت -->
     <header class="bg-gray-900 p-4 sticky top-0 z-50 shadow-xl">
         <div class="container mx-auto flex justify-between items-center">
             <div class="flex items-center space-x-4">
                 <select id="language" class="bg-gray-800 text-white p-2 rounded-lg focus:outline-none focus:ring-2 focus:ring-blue-500">
-                    <option value="fa" {{ 'selected' if session.get('lang', 'fa') == 'fa' else '' }}>فارسی</option>
-                    <option value="en" {{ 'selected' if session.get('lang', 'fa') == 'en' else '' }}>English</option>
+                    <option value="fa" {{ 'selected' if lang == 'fa' else '' }}>فارسی</option>
+                    <option value="en" {{ 'selected' if lang == 'en' else '' }}>English</option>
                 </select>
                 <button id="theme-toggle" class="bg-gray-800 text-white p-2 rounded-lg hover:bg-gray-700 transition">
                     <svg class="w-5 h-5" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M12 3v1m0 16v1m9-9h-1M4 12H3m15.364 6.364l-.707-.707M6.343 6.343l-.707-.707m12.728 0l-.707.707M6.343 17.657l-.707.707M16 12a4 4 0 11-8 0 4 4 0 018 0z"></path></svg>
@@ -107,9 +2629,9 @@ HTML_TEMPLATE = '''
             <div class="relative">
                 <button id="room-menu-btn" class="bg-blue-600 text-white px-4 py-2 rounded-lg flex items-center hover:bg-blue-700 transition">
                     <svg class="w-5 h-5 mr-2" fill="none" stroke="currentColor" viewBox="0 0 24 24"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M4 6h16M4 12h16m-7 6h7"></path></svg>
-                    {{ 'چت‌روم‌ها' if session.get('lang', 'fa') == 'fa' else 'Chat Rooms' }} <span id="unread-count" class="badge ml-2"></span>
+                    {{ 'چت‌روم‌ها' if lang == 'fa' else 'Chat Rooms' }} <span id="unread-count" class="badge ml-2"></span>
                 </button>
-                <div id="room-menu" class="hidden absolute {{ 'right-0' if session.get('lang', 'fa') == 'fa' else 'left-0' }} mt-2 w-48 bg-gray-800 rounded-lg shadow-xl dropdown-menu">
+                <div id="room-menu" class="hidden absolute {{ 'right-0' if lang == 'fa' else 'left-0' }} mt-2 w-48 bg-gray-800 rounded-lg shadow-xl dropdown-menu">
                     {% for room in rooms %}
                     <a href="#" class="{{ room.color }} block px-4 py-2 hover:bg-gray-700 transition" onclick="joinRoom('{{ room.slug }}')">{{ room.title }} <span id="unread-{{ room.slug }}" class="badge"></span></a>
                     {% endfor %}
@@ -119,15 +2641,15 @@ HTML_TEMPLATE = '''
     </header>
 
     <!-- صفحه ورود -->
-    <div id="login-page" class="{{ 'hidden' if session.get('user') else '' }} min-h-screen flex items-center justify-center animate-fade-in">
+    <div id="login-page" class="min-h-screen flex items-center justify-center animate-fade-in">
         <div class="bg-gray-800 p-8 rounded-2xl shadow-2xl max-w-md w-full">
             <img src="/static/logo.png" alt="Logo" class="mx-auto h-20 mb-6 rounded-full shadow-lg" onerror="this.src='https://source.unsplash.com/random/100x100?logo';">
             <form id="login-form">
-                <input type="text" id="username" placeholder="{{ 'نام کاربری یا ایمیل' if session.get('lang', 'fa') == 'fa' else 'Username or Email' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required>
-                <input type="password" id="password" placeholder="{{ 'رمز عبور' if session.get('lang', 'fa') == 'fa' else 'Password' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required>
-                <button type="submit" class="w-full bg-blue-600 text-white p-3 rounded-lg hover:bg-blue-700 transition">{{ 'ورود' if session.get('lang', 'fa') == 'fa' else 'Login' }}</button>
+                <input type="text" id="username" placeholder="{{ 'نام کاربری یا ایمیل' if lang == 'fa' else 'Username or Email' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required>
+                <input type="password" id="password" placeholder="{{ 'رمز عبور' if lang == 'fa' else 'Password' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required>
+                <button type="submit" class="w-full bg-blue-600 text-white p-3 rounded-lg hover:bg-blue-700 transition">{{ 'ورود' if lang == 'fa' else 'Login' }}</button>
             </form>
-            <p class="mt-4 text-center text-gray-400">{{ 'حساب ندارید؟' if session.get('lang', 'fa') == 'fa' else 'No account?' }} <a href="#register" onclick="showRegister()" class="text-blue-400 hover:underline">{{ 'ثبت‌نام کنید' if session.get('lang', 'fa') == 'fa' else 'Register' }}</a></p>
+            <p class="mt-4 text-center text-gray-400">{{ 'حساب ندارید؟' if lang == 'fa' else 'No account?' }} <a href="#register" onclick="showRegister()" class="text-blue-400 hover:underline">{{ 'ثبت‌نام کنید' if lang == 'fa' else 'Register' }}</a></p>
         </div>
     </div>
 
@@ -135,20 +2657,20 @@ HTML_TEMPLATE = '''
     <div id="register-page" class="hidden min-h-screen flex items-center justify-center animate-fade-in">
         <div class="bg-gray-800 p-8 rounded-2xl shadow-2xl max-w-md w-full">
             <form id="register-form" enctype="multipart/form-data">
-                <input type="text" id="reg-username" placeholder="{{ 'نام کاربری' if session.get('lang', 'fa') == 'fa' else 'Username' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required pattern="[A-Za-z0-9_]{3,20}">
-                <input type="email" id="reg-email" placeholder="{{ 'ایمیل' if session.get('lang', 'fa') == 'fa' else 'Email' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required>
-                <input type="password" id="reg-password" placeholder="{{ 'رمز عبور' if session.get('lang', 'fa') == 'fa' else 'Password' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required minlength="6">
-                <input type="password" id="reg-confirm-password" placeholder="{{ 'تایید رمز عبور' if session.get('lang', 'fa') == 'fa' else 'Confirm Password' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required>
+                <input type="text" id="reg-username" placeholder="{{ 'نام کاربری' if lang == 'fa' else 'Username' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required pattern="[A-Za-z0-9_]{3,20}">
+                <input type="email" id="reg-email" placeholder="{{ 'ایمیل' if lang == 'fa' else 'Email' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required>
+                <input type="password" id="reg-password" placeholder="{{ 'رمز عبور' if lang == 'fa' else 'Password' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required minlength="6">
+                <input type="password" id="reg-confirm-password" placeholder="{{ 'تایید رمز عبور' if lang == 'fa' else 'Confirm Password' }}" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" required>
                 <input type="file" id="reg-avatar" accept="image/*" class="w-full p-3 mb-4 rounded-lg bg-gray-700 text-white">
-                <button type="submit" class="w-full bg-blue-600 text-white p-3 rounded-lg hover:bg-blue-700 transition">{{ 'ثبت‌نام' if session.get('lang', 'fa') == 'fa' else 'Register' }}</button>
+                <button type="submit" class="w-full bg-blue-600 text-white p-3 rounded-lg hover:bg-blue-700 transition">{{ 'ثبت‌نام' if lang == 'fa' else 'Register' }}</button>
             </form>
-            <p class="mt-4 text-center text-gray-400"><a href="#login" onclick="showLogin()" class="text-blue-400 hover:underline">{{ 'بازگشت به ورود' if session.get('lang', 'fa') == 'fa' else 'Back to Login' }}</a></p>
+            <p class="mt-4 text-center text-gray-400"><a href="#login" onclick="showLogin()" class="text-blue-400 hover:underline">{{ 'بازگشت به ورود' if lang == 'fa' else 'Back to Login' }}</a></p>
         </div>
     </div>
 
     <!-- صفحه اصلی -->
-    <div id="main-page" class="{{ '' if session.get('user') else 'hidden' }} min-h-screen p-6 animate-slide-in">
-        <h1 class="text-4xl font-bold mb-8 text-center text-blue-400">{{ 'سلام! به کدوم چت‌روم می‌خوای وارد شی؟' if session.get('lang', 'fa') == 'fa' else 'Hello! Which chat room do you want to join?' }}</h1>
+    <div id="main-page" class="hidden min-h-screen p-6 animate-slide-in">
+        <h1 class="text-4xl font-bold mb-8 text-center text-blue-400">{{ 'سلام! به کدوم چت‌روم می‌خوای وارد شی؟' if lang == 'fa' else 'Hello! Which chat room do you want to join?' }}</h1>
         <div class="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-6">
             {% for room in rooms %}
             <div class="{{ room.color }} p-6 rounded-2xl shadow-lg hover:scale-105 transition cursor-pointer" data-room="{{ room.slug }}" onclick="joinRoom('{{ room.slug }}')">
@@ -158,101 +2680,125 @@ HTML_TEMPLATE = '''
             {% endfor %}
         </div>
         <div class="mt-8 text-center">
-            <a href="/profile" class="text-blue-400 hover:underline text-lg">{{ 'پروفایل' if session.get('lang', 'fa') == 'fa' else 'Profile' }}</a>
-            {% if session.get('user') and session.get('user').get('is_admin') %}
-            <a href="/admin" class="ml-4 text-blue-400 hover:underline text-lg">{{ 'پنل ادمین' if session.get('lang', 'fa') == 'fa' else 'Admin Panel' }}</a>
-            {% endif %}
+            <a href="/profile" class="text-blue-400 hover:underline text-lg">{{ 'پروفایل' if lang == 'fa' else 'Profile' }}</a>
+            <a href="/admin" id="admin-link" class="hidden ml-4 text-blue-400 hover:underline text-lg">{{ 'پنل ادمین' if lang == 'fa' else 'Admin Panel' }}</a>
         </div>
     </div>
+    <script>
+        if (currentUser) {
+            document.getElementById('login-page').classList.add('hidden');
+            document.getElementById('main-page').classList.remove('hidden');
+            if (currentUser.is_admin) document.getElementById('admin-link').classList.remove('hidden');
+        }
+    </script>
 
     <!-- صفحه چت‌روم -->
     <div id="chat-room" class="hidden min-h-screen flex animate-slide-in">
         <div class="w-1/4 bg-gray-800 p-6">
-            <h2 class="text-lg font-bold mb-4 text-blue-400">{{ 'کاربران آنلاین' if session.get('lang', 'fa') == 'fa' else 'Online Users' }}</h2>
+            <h2 class="text-lg font-bold mb-4 text-blue-400">{{ 'کاربران آنلاین' if lang == 'fa' else 'Online Users' }}</h2>
             <ul id="online-users" class="space-y-3"></ul>
         </div>
         <div class="flex-1 flex flex-col">
             <div id="room-header" class="bg-gray-900 text-white p-6 flex items-center shadow-lg">
                 <img src="" id="room-banner" class="h-16 mr-4 rounded-lg shadow-md">
                 <h2 id="room-title" class="text-2xl font-bold"></h2>
-                <button id="voice-call-btn" class="ml-auto bg-green-600 text-white p-2 rounded-lg voice-call-btn transition">{{ 'تماس صوتی' if session.get('lang', 'fa') == 'fa' else 'Voice Call' }}</button>
+                <button id="voice-call-btn" class="ml-auto bg-green-600 text-white p-2 rounded-lg voice-call-btn transition">{{ 'تماس صوتی' if lang == 'fa' else 'Voice Call' }}</button>
             </div>
             <div id="chat-messages" class="flex-1 p-6 overflow-y-auto bg-gray-700 chat-container"></div>
             <div id="typing-indicator" class="p-2 text-gray-400"></div>
             <div class="p-6 bg-gray-800 flex items-center relative">
-                <input id="message-input" type="text" class="flex-1 p-3 rounded-lg bg-gray-600 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" placeholder="{{ 'پیام خود را بنویسید...' if session.get('lang', 'fa') == 'fa' else 'Type your message...' }}">
+                <input id="message-input" type="text" class="flex-1 p-3 rounded-lg bg-gray-600 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" placeholder="{{ 'پیام خود را بنویسید...' if lang == 'fa' else 'Type your message...' }}">
                 <button id="emoji-btn" class="p-3 text-2xl hover:text-blue-400 transition">😊</button>
                 <emoji-picker id="emoji-picker" class="hidden"></emoji-picker>
                 <input type="file" id="file-input" accept="image/*,video/*" class="hidden">
                 <button id="file-btn" class="p-3 text-2xl hover:text-blue-400 transition">📎</button>
-                <button id="send-btn" class="bg-blue-600 text-white p-3 rounded-lg ml-2 hover:bg-blue-700 transition">{{ 'ارسال' if session.get('lang', 'fa') == 'fa' else 'Send' }}</button>
+                <button id="send-btn" class="bg-blue-600 text-white p-3 rounded-lg ml-2 hover:bg-blue-700 transition">{{ 'ارسال' if lang == 'fa' else 'Send' }}</button>
             </div>
         </div>
     </div>
 
     <!-- صفحه پروفایل -->
     <div id="profile-page" class="hidden min-h-screen p-6 animate-slide-in">
-        <h1 class="text-4xl font-bold mb-8 text-blue-400">{{ 'پروفایل' if session.get('lang', 'fa') == 'fa' else 'Profile' }}</h1>
-        <img src="{{ session.get('user').get('avatar') if session.get('user') else '' }}" alt="Avatar" class="h-32 rounded-full mb-6 shadow-lg avatar">
-        <p class="mb-4 text-lg"><strong>{{ 'نام کاربری' if session.get('lang', 'fa') == 'fa' else 'Username' }}:</strong> {{ session.get('user').get('username') if session.get('user') else '' }}</p>
-        <p class="mb-4 text-lg"><strong>{{ 'ایمیل' if session.get('lang', 'fa') == 'fa' else 'Email' }}:</strong> {{ session.get('user').get('email') if session.get('user') else '' }}</p>
-        <p class="mb-4 text-lg"><strong>{{ 'بیوگرافی' if session.get('lang', 'fa') == 'fa' else 'Bio' }}:</strong> <input id="bio-input" value="{{ session.get('user').get('bio') if session.get('user') else '' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500"></p>
+        <h1 class="text-4xl font-bold mb-8 text-blue-400">{{ 'پروفایل' if lang == 'fa' else 'Profile' }}</h1>
+        <img id="profile-avatar" src="" alt="Avatar" class="h-32 rounded-full mb-6 shadow-lg avatar">
+        <p class="mb-4 text-lg"><strong>{{ 'نام کاربری' if lang == 'fa' else 'Username' }}:</strong> <span id="profile-username"></span></p>
+        <p class="mb-4 text-lg"><strong>{{ 'ایمیل' if lang == 'fa' else 'Email' }}:</strong> <span id="profile-email"></span></p>
+        <p class="mb-4 text-lg"><strong>{{ 'بیوگرافی' if lang == 'fa' else 'Bio' }}:</strong> <input id="bio-input" value="" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500"></p>
         <input type="file" id="avatar-input" accept="image/*" class="p-3 mb-4 rounded-lg bg-gray-600 text-white w-full">
-        <button onclick="updateProfile()" class="bg-blue-600 text-white p-3 rounded-lg hover:bg-blue-700 transition">{{ 'ذخیره' if session.get('lang', 'fa') == 'fa' else 'Save' }}</button>
-        <a href="/" class="mt-4 inline-block text-blue-400 hover:underline text-lg">{{ 'بازگشت' if session.get('lang', 'fa') == 'fa' else 'Back' }}</a>
+        <button onclick="updateProfile()" class="bg-blue-600 text-white p-3 rounded-lg hover:bg-blue-700 transition">{{ 'ذخیره' if lang == 'fa' else 'Save' }}</button>
+        <a href="/" class="mt-4 inline-block text-blue-400 hover:underline text-lg">{{ 'بازگشت' if lang == 'fa' else 'Back' }}</a>
     </div>
+    <script>
+        if (currentUser) {
+            document.getElementById('profile-avatar').src = currentUser.avatar;
+            document.getElementById('profile-username').textContent = currentUser.username;
+            document.getElementById('profile-email').textContent = currentUser.email;
+            document.getElementById('bio-input').value = currentUser.bio || '';
+        }
+    </script>
 
     <!-- صفحه ادمین -->
     <div id="admin-page" class="hidden min-h-screen p-6 animate-slide-in">
-        <h1 class="text-4xl font-bold mb-8 text-blue-400">{{ 'پنل ادمین' if session.get('lang', 'fa') == 'fa' else 'Admin Panel' }}</h1>
-        <h2 class="text-xl font-bold mb-4 text-blue-400">{{ 'مدیریت روم‌ها' if session.get('lang', 'fa') == 'fa' else 'Manage Rooms' }}</h2>
+        <h1 class="text-4xl font-bold mb-8 text-blue-400">{{ 'پنل ادمین' if lang == 'fa' else 'Admin Panel' }}</h1>
+        <h2 class="text-xl font-bold mb-4 text-blue-400">{{ 'مدیریت روم‌ها' if lang == 'fa' else 'Manage Rooms' }}</h2>
         <form id="room-form" class="space-y-4">
-            <input id="room-title" placeholder="{{ 'عنوان' if session.get('lang', 'fa') == 'fa' else 'Title' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500">
-            <input id="room-slug" placeholder="{{ 'شناسه' if session.get('lang', 'fa') == 'fa' else 'Slug' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500">
-            <input id="room-color" placeholder="{{ 'رنگ (مثال: bg-blue-600)' if session.get('lang', 'fa') == 'fa' else 'Color (e.g., bg-blue-600)' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500">
-            <input id="room-banner" placeholder="{{ 'آدرس بنر' if session.get('lang', 'fa') == 'fa' else 'Banner URL' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500">
-            <button type="submit" class="bg-blue-600 text-white p-3 rounded-lg hover:bg-blue-700 transition">{{ 'ایجاد روم' if session.get('lang', 'fa') == 'fa' else 'Create Room' }}</button>
+            <input id="new-room-title" placeholder="{{ 'عنوان' if lang == 'fa' else 'Title' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500">
+            <input id="new-room-slug" placeholder="{{ 'شناسه' if lang == 'fa' else 'Slug' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500">
+            <input id="new-room-color" placeholder="{{ 'رنگ (مثال: bg-blue-600)' if lang == 'fa' else 'Color (e.g., bg-blue-600)' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500">
+            <input id="new-room-banner" placeholder="{{ 'آدرس بنر' if lang == 'fa' else 'Banner URL' }}" class="p-3 rounded-lg bg-gray-600 text-white w-full focus:outline-none focus:ring-2 focus:ring-blue-500">
+            <button type="submit" class="bg-blue-600 text-white p-3 rounded-lg hover:bg-blue-700 transition">{{ 'ایجاد روم' if lang == 'fa' else 'Create Room' }}</button>
         </form>
         <ul id="room-list-admin" class="mt-6 space-y-3">
             {% for room in rooms %}
-            <li class="{{ room.color }} p-4 rounded-lg shadow-md">{{ room.title }} <button onclick="deleteRoom('{{ room.slug }}')" class="text-red-400 ml-4 hover:underline">{{ 'حذف' if session.get('lang', 'fa') == 'fa' else 'Delete' }}</button></li>
-            {% endfor %}
-        </ul>
-        <h2 class="text-xl font-bold mb-4 mt-6 text-blue-400">{{ 'مدیریت کاربران' if session.get('lang', 'fa') == 'fa' else 'Manage Users' }}</h2>
-        <ul id="user-list-admin" class="mt-6 space-y-3">
-            {% for user in users %}
-            <li class="bg-gray-800 p-4 rounded-lg shadow-md">{{ user.username }} ({{ 'آنلاین' if user.online else 'آفلاین' if session.get('lang', 'fa') == 'fa' else 'Online' if user.online else 'Offline' }}) <button onclick="banUser('{{ user.id }}')" class="text-red-400 ml-4 hover:underline">{{ 'مسدود' if session.get('lang', 'fa') == 'fa' else 'Ban' }}</button></li>
+            <li class="{{ room.color }} p-4 rounded-lg shadow-md">{{ room.title }} <button onclick="deleteRoom('{{ room.slug }}')" class="text-red-400 ml-4 hover:underline">{{ 'حذف' if lang == 'fa' else 'Delete' }}</button></li>
             {% endfor %}
         </ul>
-        <a href="/" class="mt-6 inline-block text-blue-400 hover:underline text-lg">{{ 'بازگشت' if session.get('lang', 'fa') == 'fa' else 'Back' }}</a>
+        <h2 class="text-xl font-bold mb-4 mt-6 text-blue-400">{{ 'مدیریت کاربران' if lang == 'fa' else 'Manage Users' }}</h2>
+        <ul id="user-list-admin" class="mt-6 space-y-3"></ul>
+        <a href="/" class="mt-6 inline-block text-blue-400 hover:underline text-lg">{{ 'بازگشت' if lang == 'fa' else 'Back' }}</a>
     </div>
+    <script>
+        (adminUsers || []).forEach(user => {
+            const li = document.createElement('li');
+            li.classList.add('bg-gray-800', 'p-4', 'rounded-lg', 'shadow-md');
+            li.textContent = `${user.username} (${user.online ? '{{ 'آنلاین' if lang == 'fa' else 'Online' }}' : '{{ 'آفلاین' if lang == 'fa' else 'Offline' }}'}) `;
+            const button = document.createElement('button');
+            button.className = 'text-red-400 ml-4 hover:underline';
+            button.textContent = '{{ 'مسدود' if lang == 'fa' else 'Ban' }}';
+            button.onclick = () => banUser(user.id);
+            li.appendChild(button);
+            document.getElementById('user-list-admin').appendChild(li);
+        });
+    </script>
 
     <!-- مودال چت خصوصی -->
     <div id="private-chat-modal" class="hidden fixed inset-0 bg-black bg-opacity-50 flex items-center justify-center z-50">
         <div class="bg-gray-800 p-6 rounded-2xl shadow-2xl max-w-md w-full">
-            <h2 id="private-chat-title" class="text-xl font-bold mb-4 text-blue-400">{{ 'چت خصوصی' if session.get('lang', 'fa') == 'fa' else 'Private Chat' }}</h2>
+            <h2 id="private-chat-title" class="text-xl font-bold mb-4 text-blue-400">{{ 'چت خصوصی' if lang == 'fa' else 'Private Chat' }}</h2>
             <div id="private-chat-messages" class="h-64 overflow-y-auto bg-gray-700 p-4 rounded-lg mb-4"></div>
             <div class="flex">
-                <input id="private-message-input" type="text" class="flex-1 p-3 rounded-lg bg-gray-600 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" placeholder="{{ 'پیام خود را بنویسید...' if session.get('lang', 'fa') == 'fa' else 'Type your message...' }}">
-                <button id="private-send-btn" class="bg-blue-600 text-white p-3 rounded-lg ml-2 hover:bg-blue-700 transition">{{ 'ارسال' if session.get('lang', 'fa') == 'fa' else 'Send' }}</button>
+                <input id="private-message-input" type="text" class="flex-1 p-3 rounded-lg bg-gray-600 text-white focus:outline-none focus:ring-2 focus:ring-blue-500" placeholder="{{ 'پیام خود را بنویسید...' if lang == 'fa' else 'Type your message...' }}">
+                <button id="private-send-btn" class="bg-blue-600 text-white p-3 rounded-lg ml-2 hover:bg-blue-700 transition">{{ 'ارسال' if lang == 'fa' else 'Send' }}</button>
             </div>
-            <button onclick="closePrivateChat()" class="mt-4 text-blue-400 hover:underline">{{ 'بستن' if session.get('lang', 'fa') == 'fa' else 'Close' }}</button>
+            <button onclick="closePrivateChat()" class="mt-4 text-blue-400 hover:underline">{{ 'بستن' if lang == 'fa' else 'Close' }}</button>
         </div>
     </div>
 
     <!-- مودال تماس صوتی -->
     <div id="voice-call-modal" class="hidden fixed inset-0 bg-black bg-opacity-50 flex items-center justify-center z-50">
         <div class="bg-gray-800 p-6 rounded-2xl shadow-2xl max-w-md w-full">
-            <h2 class="text-xl font-bold mb-4 text-blue-400">{{ 'تماس صوتی' if session.get('lang', 'fa') == 'fa' else 'Voice Call' }}</h2>
+            <h2 class="text-xl font-bold mb-4 text-blue-400">{{ 'تماس صوتی' if lang == 'fa' else 'Voice Call' }}</h2>
             <video id="local-video" autoplay muted class="h-32 w-full rounded-lg mb-4"></video>
             <video id="remote-video" autoplay class="h-32 w-full rounded-lg mb-4"></video>
-            <button id="end-call-btn" class="bg-red-600 text-white p-3 rounded-lg hover:bg-red-700 transition">{{ 'پایان تماس' if session.get('lang', 'fa') == 'fa' else 'End Call' }}</button>
+            <button id="end-call-btn" class="bg-red-600 text-white p-3 rounded-lg hover:bg-red-700 transition">{{ 'پایان تماس' if lang == 'fa' else 'End Call' }}</button>
         </div>
     </div>
 
     <script src="https://cdn.socket.io/4.5.0/socket.io.min.js"></script>
     <script>
-        const socket = io();
+        // پیام‌ها به صورت فشرده: آرایه با شناسه کاربر و زمان میلی‌ثانیه‌ای
+        const socket = io({ auth: { compact: true } });
+        const currentUsername = currentUser ? currentUser.username : '';
         const rooms = {{ rooms | tojson }};
         let currentPrivateChatUser = null;
         let currentRoom = null;
@@ -273,7 +2819,6 @@ HTML_TEMPLATE = '''
         // منوی کشویی روم‌ها
         document.getElementById('room-menu-btn').addEventListener('click', () => {
             document.getElementById('room-menu').classList.toggle('hidden');
-            updateUnreadCount();
         });
 
         // انتخابگر ایموجی
@@ -289,24 +2834,53 @@ HTML_TEMPLATE = '''
         document.getElementById('file-btn').addEventListener('click', () => {
             document.getElementById('file-input').click();
         });
+        // آپلود تکه‌تکه: بعد از قطع شبکه از آخرین offset ثبت‌شده روی سرور ادامه می‌دهد
+        async function uploadFile(file) {
+            const res = await fetch('/uploads', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({ filename: file.name, size: file.size })
+            }).then(res => res.json());
+            if (!res.success) {
+                alert(res.error);
+                return null;
+            }
+            let offset = 0;
+            let failures = 0;
+            while (offset < file.size) {
+                try {
+                    const chunkRes = await fetch(`/uploads/${res.uploadId}?offset=${offset}`, {
+                        method: 'PUT',
+                        body: file.slice(offset, offset + res.chunkSize)
+                    });
+                    const data = await chunkRes.json();
+                    if (!data.success && chunkRes.status !== 409) {
+                        alert(data.error);
+                        return null;
+                    }
+                    offset = data.offset;
+                    failures = 0;
+                } catch (err) {
+                    if (++failures > 5) throw err;
+                    await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                    offset = (await fetch(`/uploads/${res.uploadId}`).then(res => res.json())).offset;
+                }
+            }
+            const done = await fetch(`/uploads/${res.uploadId}/complete`, { method: 'POST' }).then(res => res.json());
+            return done.success ? done : null;
+        }
+
         document.getElementById('file-input').addEventListener('change', async () => {
             const file = document.getElementById('file-input').files[0];
             if (file && currentRoom) {
-                const formData = new FormData();
-                formData.append('file', file);
-                formData.append('roomId', currentRoom);
-                await fetch('/upload', {
-                    method: 'POST',
-                    body: formData
-                }).then(res => res.json()).then(data => {
-                    if (data.success) {
-                        socket.emit('sendMessage', {
-                            roomId: currentRoom,
-                            message: `<a href="${data.fileUrl}" target="_blank">فایل: ${file.name}</a>`,
-                            user: {{ session.get('user') | tojson }}
-                        });
-                    }
-                });
+                const roomId = currentRoom;
+                const uploaded = await uploadFile(file);
+                if (uploaded) {
+                    const message = uploaded.previewUrl
+                        ? `<a href="${uploaded.fileUrl}" target="_blank"><img src="${uploaded.previewUrl}" onerror="this.onerror=null;this.src='${uploaded.fileUrl}'" class="max-h-48 rounded-lg"></a>`
+                        : `<a href="${uploaded.fileUrl}" target="_blank">فایل: ${file.name}</a>`;
+                    socket.emit('sendMessage', { roomId, message });
+                }
             }
         });
 
@@ -380,45 +2954,145 @@ HTML_TEMPLATE = '''
         function joinRoom(slug) {
             currentRoom = slug;
             const room = rooms.find(r => r.slug === slug);
-            socket.emit('joinRoom', { roomId: slug, user: {{ session.get('user') | tojson }} });
+            socket.emit('joinRoom', { roomId: slug });
             document.getElementById('main-page').classList.add('hidden');
             document.getElementById('chat-room').classList.remove('hidden');
             document.getElementById('room-title').innerText = room.title;
             document.getElementById('room-banner').src = room.banner;
             document.getElementById('chat-messages').innerHTML = '';
-            fetchMessages(slug);
-            updateUnreadCount();
+            document.getElementById('typing-indicator').innerText = '';
+            typingReports = {};
+            oldestMessageId = null;
+            hasMoreHistory = false;
+            if (bootstrap && !bootstrapShown && slug === bootstrap.room) {
+                // اولین ورود به روم پیش‌فرض: پیام‌ها و کاربران از داده‌های صفحه، درخواست فقط پیام‌های جدیدتر را اضافه می‌کند
+                bootstrapShown = true;
+                showOnlineUsers(bootstrap.users);
+                showLatestMessages(bootstrap.messages);
+                const newest = bootstrap.messages.length ? bootstrap.messages[bootstrap.messages.length - 1].id : 0;
+                fetchMessages(slug, null, newest);
+            } else {
+                fetchMessages(slug);
+            }
+            unreadCounts[slug] = 0;
+            renderUnreadCounts();
+        }
+
+        // تاریخچه صفحه‌بندی‌شده: فقط آخرین صفحه، صفحات قبلی با اسکرول به بالا
+        const HISTORY_PAGE_SIZE = 50;
+        let oldestMessageId = null;
+        let hasMoreHistory = false;
+        let loadingHistory = false;
+        let bootstrapShown = false;
+
+        function showLatestMessages(messages) {
+            hasMoreHistory = messages.length === HISTORY_PAGE_SIZE;
+            if (messages.length) oldestMessageId = messages[0].id;
+            const container = document.getElementById('chat-messages');
+            messages.forEach(msg => container.appendChild(createMessageElement(msg)));
+            container.scrollTop = container.scrollHeight;
         }
 
-        async function fetchMessages(roomId) {
-            const res = await fetch(`/messages/${roomId}`);
+        async function fetchMessages(roomId, before = null, after = null) {
+            const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE });
+            if (before) params.set('before', before);
+            const res = await fetch(`/messages/${roomId}?${params}`);
             const messages = await res.json();
-            messages.forEach(msg => displayMessage(msg));
+            if (roomId !== currentRoom) return;
+            if (before) {
+                hasMoreHistory = messages.length === HISTORY_PAGE_SIZE;
+                if (messages.length) oldestMessageId = messages[0].id;
+                prependMessages(messages);
+            } else if (after !== null && messages.length && messages[0].id <= after) {
+                const container = document.getElementById('chat-messages');
+                messages.filter(msg => msg.id > after).forEach(msg => container.appendChild(createMessageElement(msg)));
+                container.scrollTop = container.scrollHeight;
+            } else {
+                // بیش از یک صفحه پیام از زمان ساخت صفحه رسیده: صفحه جدید جای قبلی را می‌گیرد
+                if (after !== null) document.getElementById('chat-messages').innerHTML = '';
+                showLatestMessages(messages);
+            }
         }
 
-        function displayMessage(msg) {
-            const messages = document.getElementById('chat-messages');
+        async function loadOlderMessages() {
+            if (!currentRoom || !hasMoreHistory || loadingHistory || !oldestMessageId) return;
+            loadingHistory = true;
+            try {
+                await fetchMessages(currentRoom, oldestMessageId);
+            } finally {
+                loadingHistory = false;
+            }
+        }
+
+        function prependMessages(messages) {
+            const container = document.getElementById('chat-messages');
+            const previousHeight = container.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            messages.forEach(msg => fragment.appendChild(createMessageElement(msg)));
+            container.insertBefore(fragment, container.firstChild);
+            container.scrollTop += container.scrollHeight - previousHeight;
+        }
+
+        document.getElementById('chat-messages').addEventListener('scroll', (e) => {
+            if (e.target.scrollTop < 50) loadOlderMessages();
+        });
+
+        function createMessageElement(msg) {
             const div = document.createElement('div');
-            div.classList.add('chat-bubble', msg.user === '{{ session.get('user').get('username') if session.get('user') else '' }}' ? 'me' : '');
+            div.classList.add('chat-bubble', msg.user === currentUsername ? 'me' : '');
             if (msg.user === 'System') div.classList.add('notification');
             div.innerHTML = `<strong>${msg.user}</strong>: ${msg.text} <span class="text-xs text-gray-400">${new Date(msg.timestamp).toLocaleTimeString()}</span>`;
-            messages.appendChild(div);
+            return div;
+        }
+
+        function displayMessage(msg) {
+            const messages = document.getElementById('chat-messages');
+            messages.appendChild(createMessageElement(msg));
             messages.scrollTop = messages.scrollHeight;
             new Audio('/static/notification.mp3').play();
         }
 
-        async function updateUnreadCount() {
-            const res = await fetch('/unread-messages');
-            const data = await res.json();
+        // شمارنده‌های خوانده‌نشده: مقدار اولیه و تغییرات از سرور push می‌شوند
+        let unreadCounts = {};
+        let markReadTimer = null;
+
+        function renderUnreadCounts() {
             let totalUnread = 0;
             for (const room of rooms) {
-                const count = data[room.slug] || 0;
-                document.getElementById(`unread-${room.slug}`).innerText = count > 0 ? count : '';
+                const count = unreadCounts[room.slug] || 0;
+                const badge = document.getElementById(`unread-${room.slug}`);
+                if (badge) badge.innerText = count > 0 ? count : '';
                 totalUnread += count;
             }
             document.getElementById('unread-count').innerText = totalUnread > 0 ? totalUnread : '';
         }
 
+        function scheduleMarkRead() {
+            clearTimeout(markReadTimer);
+            markReadTimer = setTimeout(() => {
+                if (currentRoom) socket.emit('markRead', { roomId: currentRoom });
+            }, 1000);
+        }
+
+        if (bootstrap) {
+            unreadCounts = bootstrap.unread;
+            renderUnreadCounts();
+        }
+
+        socket.on('unreadCounts', (counts) => {
+            unreadCounts = counts;
+            if (currentRoom) unreadCounts[currentRoom] = 0;
+            renderUnreadCounts();
+        });
+
+        socket.on('roomActivity', (data) => {
+            for (const [roomId, count] of Object.entries(data.rooms)) {
+                if (roomId === currentRoom) continue;
+                unreadCounts[roomId] = (unreadCounts[roomId] || 0) + count;
+            }
+            renderUnreadCounts();
+        });
+
         document.getElementById('login-form').addEventListener('submit', async (e) => {
             e.preventDefault();
             const username = document.getElementById('username').value;
@@ -431,7 +3105,7 @@ HTML_TEMPLATE = '''
             if (res.success) {
                 window.location.reload();
             } else {
-                alert(res.error || '{{ 'ورود ناموفق: نام کاربری یا رمز عبور اشتباه است' if session.get('lang', 'fa') == 'fa' else 'Login failed: Incorrect username or password' }}');
+                alert(res.error || '{{ 'ورود ناموفق: نام کاربری یا رمز عبور اشتباه است' if lang == 'fa' else 'Login failed: Incorrect username or password' }}');
             }
         });
 
@@ -443,7 +3117,7 @@ HTML_TEMPLATE = '''
             const confirmPassword = document.getElementById('reg-confirm-password').value;
             const avatar = document.getElementById('reg-avatar').files[0];
             if (password !== confirmPassword) {
-                alert('{{ 'رمزهای عبور یکسان نیستند' if session.get('lang', 'fa') == 'fa' else 'Passwords do not match' }}');
+                alert('{{ 'رمزهای عبور یکسان نیستند' if lang == 'fa' else 'Passwords do not match' }}');
                 return;
             }
             const formData = new FormData();
@@ -458,55 +3132,120 @@ HTML_TEMPLATE = '''
             if (res.success) {
                 window.location.reload();
             } else {
-                alert(res.error || '{{ 'ثبت‌نام ناموفق' if session.get('lang', 'fa') == 'fa' else 'Registration failed' }}');
+                alert(res.error || '{{ 'ثبت‌نام ناموفق' if lang == 'fa' else 'Registration failed' }}');
             }
         });
 
+        // نشانگر تایپ: حداکثر هر دو ثانیه یک رویداد، سرور وضعیت روم را جمع‌بندی می‌کند
+        let lastTypingSent = 0;
         document.getElementById('message-input').addEventListener('input', () => {
-            if (currentRoom) {
-                socket.emit('typing', { roomId: currentRoom, user: '{{ session.get('user').get('username') if session.get('user') else '' }}' });
+            if (currentRoom && Date.now() - lastTypingSent > 2000) {
+                lastTypingSent = Date.now();
+                socket.emit('typing', { roomId: currentRoom });
             }
         });
 
         document.getElementById('send-btn').addEventListener('click', () => {
             const message = document.getElementById('message-input').value;
             if (message && currentRoom) {
-                socket.emit('sendMessage', { roomId: currentRoom, message, user: {{ session.get('user') | tojson }} });
+                socket.emit('sendMessage', { roomId: currentRoom, message });
                 document.getElementById('message-input').value = '';
-                socket.emit('stopTyping', { roomId: currentRoom });
+                lastTypingSent = 0;
             }
         });
 
         socket.on('message', (msg) => {
             displayMessage(msg);
-            updateUnreadCount();
+            scheduleMarkRead();
         });
 
-        socket.on('typing', (data) => {
-            if (data.roomId === currentRoom && data.user !== '{{ session.get('user').get('username') if session.get('user') else '' }}') {
-                document.getElementById('typing-indicator').innerText = `${data.user} {{ 'در حال تایپ است...' if session.get('lang', 'fa') == 'fa' else 'is typing...' }}`;
-                setTimeout(() => {
-                    document.getElementById('typing-indicator').innerText = '';
-                }, 3000);
+        // دیکشنری کاربران برای رویدادهای فشرده؛ شناسه‌های ناشناخته یک بار از سرور پرسیده می‌شوند
+        const userDirectory = new Map([[0, { id: 0, username: 'System' }]]);
+        let compactEvents = Promise.resolve();
+
+        async function resolveUsers(ids) {
+            const missing = [...new Set(ids)].filter(id => !userDirectory.has(id));
+            if (missing.length) {
+                const found = await new Promise(resolve => socket.emit('users', missing, resolve));
+                for (const [id, [username, avatar]] of Object.entries(found || {})) {
+                    userDirectory.set(Number(id), { id: Number(id), username, avatar });
+                }
             }
+            return ids.map(id => userDirectory.get(id) || { id, username: '?' });
+        }
+
+        // پرسیدن کاربران async است؛ رویدادها یکی‌یکی پردازش می‌شوند تا ترتیبشان به هم نخورد
+        function onCompact(event, handler) {
+            socket.on(event, (data) => {
+                compactEvents = compactEvents.then(() => handler(data)).catch(console.error);
+            });
+        }
+
+        onCompact('m', async ([id, userId, text, timestamp]) => {
+            const [user] = await resolveUsers([userId]);
+            displayMessage({ id, user: user.username, text, timestamp });
+            scheduleMarkRead();
+        });
+
+        onCompact('pm', async ([id, userId, text, timestamp]) => {
+            const [user] = await resolveUsers([userId]);
+            showPrivateMessage({ id, from: user.username, text, timestamp });
+        });
+
+        onCompact('u', async (ids) => {
+            showOnlineUsers(await resolveUsers(ids));
         });
 
-        socket.on('stopTyping', (data) => {
-            if (data.roomId === currentRoom) {
-                document.getElementById('typing-indicator').innerText = '';
+        // هر ورکر تایپ‌کننده‌های خودش را می‌فرستد؛ اینجا با هم ادغام می‌شوند
+        let typingReports = {};
+        socket.on('typingUsers', (data) => {
+            if (data.roomId !== currentRoom) return;
+            typingReports[data.worker] = data;
+            const others = [];
+            let count = 0;
+            for (const report of Object.values(typingReports)) {
+                const mine = report.users.includes(currentUsername) ? 1 : 0;
+                others.push(...report.users.filter(user => user !== currentUsername));
+                count += report.count - mine;
+            }
+            const indicator = document.getElementById('typing-indicator');
+            if (count === 0) {
+                indicator.innerText = '';
+            } else if (count === 1 && others.length) {
+                indicator.innerText = `${others[0]} {{ 'در حال تایپ است...' if lang == 'fa' else 'is typing...' }}`;
+            } else {
+                indicator.innerText = `${count} {{ 'نفر در حال تایپ هستند...' if lang == 'fa' else 'people are typing...' }}`;
             }
         });
 
-        socket.on('updateUsers', (users) => {
+        socket.on('rateLimited', (data) => {
+            if (data.event !== 'typing') alert(data.error);
+        });
+
+        // لیست آنلاین‌ها: یک بار کامل هنگام ورود، بعد فقط تغییرات
+        function addOnlineUser(user) {
             const onlineUsers = document.getElementById('online-users');
-            onlineUsers.innerHTML = '';
-            users.forEach(user => {
-                const li = document.createElement('li');
-                li.classList.add('p-3', 'hover:bg-gray-700', 'rounded-lg', 'cursor-pointer', 'flex', 'items-center');
-                li.innerHTML = `<img src="${user.avatar}" class="inline-block h-10 w-10 rounded-full mr-3 shadow-md avatar"> ${user.username}`;
-                li.onclick = () => startPrivateChat(user.username);
-                onlineUsers.appendChild(li);
-            });
+            if (onlineUsers.querySelector(`[data-username="${CSS.escape(user.username)}"]`)) return;
+            const li = document.createElement('li');
+            li.dataset.username = user.username;
+            li.classList.add('p-3', 'hover:bg-gray-700', 'rounded-lg', 'cursor-pointer', 'flex', 'items-center');
+            li.innerHTML = `<img src="${user.avatar}" class="inline-block h-10 w-10 rounded-full mr-3 shadow-md avatar"> ${user.username}`;
+            li.onclick = () => startPrivateChat(user.username);
+            onlineUsers.appendChild(li);
+        }
+
+        function showOnlineUsers(users) {
+            document.getElementById('online-users').innerHTML = '';
+            users.forEach(addOnlineUser);
+        }
+
+        socket.on('updateUsers', showOnlineUsers);
+
+        socket.on('userJoined', addOnlineUser);
+
+        socket.on('userLeft', (user) => {
+            const li = document.getElementById('online-users').querySelector(`[data-username="${CSS.escape(user.username)}"]`);
+            if (li) li.remove();
         });
 
         async function changeLanguage(lang) {
@@ -529,8 +3268,27 @@ HTML_TEMPLATE = '''
             }).then(res => res.json()).then(() => window.location.reload());
         }
 
+        document.getElementById('room-form').addEventListener('submit', async (e) => {
+            e.preventDefault();
+            const res = await fetch('/admin/rooms', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    title: document.getElementById('new-room-title').value,
+                    slug: document.getElementById('new-room-slug').value,
+                    color: document.getElementById('new-room-color').value,
+                    banner: document.getElementById('new-room-banner').value
+                })
+            }).then(res => res.json());
+            if (res.success) {
+                window.location.reload();
+            } else {
+                alert(res.error);
+            }
+        });
+
         async function deleteRoom(slug) {
-            if (confirm('{{ 'آیا مطمئن هستید؟' if session.get('lang', 'fa') == 'fa' else 'Are you sure?' }}')) {
+            if (confirm('{{ 'آیا مطمئن هستید؟' if lang == 'fa' else 'Are you sure?' }}')) {
                 await fetch(`/admin/rooms/${slug}`, {
                     method: 'DELETE',
                     headers: { 'Content-Type': 'application/json' }
@@ -539,7 +3297,7 @@ HTML_TEMPLATE = '''
         }
 
         async function banUser(userId) {
-            if (confirm('{{ 'آیا مطمئن هستید؟' if session.get('lang', 'fa') == 'fa' else 'Are you sure?' }}')) {
+            if (confirm('{{ 'آیا مطمئن هستید؟' if lang == 'fa' else 'Are you sure?' }}')) {
                 await fetch(`/admin/users/${userId}/ban`, {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' }
@@ -550,25 +3308,57 @@ HTML_TEMPLATE = '''
         function startPrivateChat(username) {
             currentPrivateChatUser = username;
             document.getElementById('private-chat-modal').classList.remove('hidden');
-            document.getElementById('private-chat-title').innerText = `{{ 'چت خصوصی با' if session.get('lang', 'fa') == 'fa' else 'Private Chat with' }} ${username}`;
+            document.getElementById('private-chat-title').innerText = `{{ 'چت خصوصی با' if lang == 'fa' else 'Private Chat with' }} ${username}`;
             document.getElementById('private-chat-messages').innerHTML = '';
-            socket.emit('joinPrivateRoom', { user1: '{{ session.get('user').get('username') if session.get('user') else '' }}', user2: username });
+            oldestPrivateMessageId = null;
+            hasMorePrivateHistory = false;
+            socket.emit('joinPrivateRoom', { user1: currentUsername, user2: username });
             fetchPrivateMessages(username);
         }
 
-        async function fetchPrivateMessages(toUser) {
-            const res = await fetch(`/private-messages/${toUser}`);
+        let oldestPrivateMessageId = null;
+        let hasMorePrivateHistory = false;
+        let loadingPrivateHistory = false;
+
+        function createPrivateMessageElement(msg) {
+            const div = document.createElement('div');
+            div.classList.add('chat-bubble', msg.from === currentUsername ? 'me' : '');
+            div.innerHTML = `<strong>${msg.from}</strong>: ${msg.text} <span class="text-xs text-gray-400">${new Date(msg.timestamp).toLocaleTimeString()}</span>`;
+            return div;
+        }
+
+        async function fetchPrivateMessages(toUser, before = null) {
+            const params = new URLSearchParams({ limit: HISTORY_PAGE_SIZE });
+            if (before) params.set('before', before);
+            const res = await fetch(`/private-messages/${toUser}?${params}`);
             const messages = await res.json();
-            messages.forEach(msg => {
-                const messages = document.getElementById('private-chat-messages');
-                const div = document.createElement('div');
-                div.classList.add('chat-bubble', msg.from === '{{ session.get('user').get('username') if session.get('user') else '' }}' ? 'me' : '');
-                div.innerHTML = `<strong>${msg.from}</strong>: ${msg.text} <span class="text-xs text-gray-400">${new Date(msg.timestamp).toLocaleTimeString()}</span>`;
-                messages.appendChild(div);
-                messages.scrollTop = messages.scrollHeight;
-            });
+            if (toUser !== currentPrivateChatUser) return;
+            hasMorePrivateHistory = messages.length === HISTORY_PAGE_SIZE;
+            if (messages.length) oldestPrivateMessageId = messages[0].id;
+            const container = document.getElementById('private-chat-messages');
+            const previousHeight = container.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            messages.forEach(msg => fragment.appendChild(createPrivateMessageElement(msg)));
+            if (before) {
+                container.insertBefore(fragment, container.firstChild);
+                container.scrollTop += container.scrollHeight - previousHeight;
+            } else {
+                container.appendChild(fragment);
+                container.scrollTop = container.scrollHeight;
+            }
         }
 
+        document.getElementById('private-chat-messages').addEventListener('scroll', async (e) => {
+            if (e.target.scrollTop >= 50 || !currentPrivateChatUser || !hasMorePrivateHistory
+                || loadingPrivateHistory || !oldestPrivateMessageId) return;
+            loadingPrivateHistory = true;
+            try {
+                await fetchPrivateMessages(currentPrivateChatUser, oldestPrivateMessageId);
+            } finally {
+                loadingPrivateHistory = false;
+            }
+        });
+
         function closePrivateChat() {
             document.getElementById('private-chat-modal').classList.add('hidden');
             currentPrivateChatUser = null;
@@ -577,56 +3367,184 @@ HTML_TEMPLATE = '''
         document.getElementById('private-send-btn').addEventListener('click', () => {
             const message = document.getElementById('private-message-input').value;
             if (message && currentPrivateChatUser) {
-                socket.emit('sendPrivateMessage', {
-                    to: currentPrivateChatUser,
-                    message,
-                    user: {{ session.get('user') | tojson }}
-                });
+                socket.emit('sendPrivateMessage', { to: currentPrivateChatUser, message });
                 document.getElementById('private-message-input').value = '';
             }
         });
 
-        socket.on('privateMessage', (msg) => {
-            if (msg.from === currentPrivateChatUser || msg.from === '{{ session.get('user').get('username') if session.get('user') else '' }}') {
+        function showPrivateMessage(msg) {
+            if (msg.from === currentPrivateChatUser || msg.from === currentUsername) {
                 const messages = document.getElementById('private-chat-messages');
-                const div = document.createElement('div');
-                div.classList.add('chat-bubble', msg.from === '{{ session.get('user').get('username') if session.get('user') else '' }}' ? 'me' : '');
-                div.innerHTML = `<strong>${msg.from}</strong>: ${msg.text} <span class="text-xs text-gray-400">${new Date(msg.timestamp).toLocaleTimeString()}</span>`;
-                messages.appendChild(div);
+                messages.appendChild(createPrivateMessageElement(msg));
                 messages.scrollTop = messages.scrollHeight;
                 new Audio('/static/notification.mp3').play();
             }
-        });
+        }
+
+        socket.on('privateMessage', showPrivateMessage);
     </script>
 </body>
 </html>
 '''
 
+# قالب صفحه فقط یک بار کامپایل می‌شود و پوسته ثابت هر زبان کش می‌شود؛
+# داده‌های هر کاربر جداگانه جای PAGE_DATA_MARKER قرار می‌گیرد
+PAGE_TEMPLATE = app.jinja_env.from_string(HTML_TEMPLATE)
+PAGE_DATA_MARKER = '/*page-data*/'
+_page_shells = {}
+
+
+def _page_shell(lang, rooms):
+    """Return (head, tail, digest) of the page rendered for ``lang`` and ``rooms``."""
+    cached = _page_shells.get(lang)
+    if cached is None or cached[0] != rooms:
+        html = PAGE_TEMPLATE.render(lang=lang, rooms=rooms)
+        head, tail = html.split(PAGE_DATA_MARKER, 1)
+        cached = (rooms, head, tail, hashlib.sha1(html.encode()).hexdigest())
+        _page_shells[lang] = cached
+    return cached[1:]
+
+
+def render_page(rooms, admin_users=None):
+    lang = 'fa' if session.get('lang', 'fa') == 'fa' else 'en'
+    head, tail, digest = _page_shell(lang, rooms)
+    user = current_user()
+    if user:
+        user = dict(user, avatar=avatar_url(user['avatar'], 128))
+    page_data = (f'const currentUser = {htmlsafe_json_dumps(user)};'
+                 f' const adminUsers = {htmlsafe_json_dumps(admin_users)};'
+                 f' const bootstrap = {htmlsafe_json_dumps(bootstrap_data(user) if user else None)};')
+    etag = hashlib.sha1(f'{digest}:{page_data}'.encode()).hexdigest()
+    # compress_response weakens the tag of compressed bodies
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(head + page_data + tail, mimetype='text/html')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
 # Routes
+# اندازه‌گیری زمان درخواست‌ها و خروجی /metrics
+WORKER_GAUGES = [
+    Gauge('chatroom_socketio_connected', 'Sockets connected to this worker.',
+          lambda: len(socketio.server.manager.rooms.get('/', {}).get(None, ()))),
+    Gauge('chatroom_message_writer_pending', 'Rows queued for the message writer.', lambda: message_writer.pending()),
+    Gauge('chatroom_image_queue_depth', 'Images waiting for thumbnail generation.',
+          lambda: image_pipeline.stats()['queue_depth']),
+    Gauge('chatroom_recent_messages_bytes', 'Approximate size of the per-room recent message buffers.',
+          lambda: recent_messages.stats()['bytes']),
+    Gauge('chatroom_password_hash_pending', 'Password hashing jobs in flight.', lambda: password_hasher.stats()['pending']),
+]
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                     request.method, response.status_code)
+    return response
+
+# فشرده‌سازی پاسخ‌های متنی؛ پاسخ‌های فایل (direct_passthrough) دست نمی‌خورند
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/plain', 'application/json'}
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5   # about as fast as gzip level 6; 11 is ~100x slower for a few percent
+
+
+@app.after_request
+def compress_response(response):
+    min_size = app.config['COMPRESS_MIN_SIZE']
+    if not min_size or response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough \
+            or response.is_streamed:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    if brotli is not None and request.accept_encodings['br']:
+        response.set_data(brotli.compress(data, quality=BROTLI_QUALITY))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'success': False}), 403
+    lines = []
+    for metric in METRICS + WORKER_GAUGES:
+        lines += metric.render()
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+def admin_profiler():
+    if not current_user() or not current_user().get('is_admin'):
+        return jsonify({'success': False}), 403
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        action = data.get('action') if isinstance(data, dict) else None
+        if action == 'start':
+            interval = data.get('intervalMs', 10)
+            if isinstance(interval, bool) or not isinstance(interval, (int, float)) or not math.isfinite(interval):
+                return jsonify({'success': False, 'error': 'بازه نمونه‌برداری نامعتبر است' if session.get('lang', 'fa') == 'fa' else 'Invalid sampling interval'}), 400
+            profiler.start(max(interval, 1) / 1000)
+        elif action == 'stop':
+            profiler.stop()
+        return jsonify({'success': True, 'running': profiler.running})
+    if request.args.get('format') == 'folded':
+        return app.response_class('\n'.join(profiler.report()) + '\n', mimetype='text/plain')
+    return jsonify({'running': profiler.running, 'samples': profiler.samples,
+                    'stacks': profiler.report(request.args.get('limit', 50, type=int))})
+
 @app.route('/')
 def index():
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM rooms')
-    rooms = [{'slug': r[1], 'title': r[2], 'color': r[3], 'banner': r[4]} for r in c.fetchall()]
-    conn.close()
-    return render_template_string(HTML_TEMPLATE, rooms=rooms)
+    return render_page(rooms_cache.all())
 
 @app.route('/login', methods=['POST'])
 def login():
-    username = request.json.get('username')
-    password = request.json.get('password')
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM users WHERE username = ? OR email = ?', (username, username))
-    user = c.fetchone()
-    if user and check_password_hash(user[3], password):
-        session['user'] = {'id': user[0], 'username': user[1], 'email': user[2], 'avatar': user[4], 'bio': user[5], 'is_admin': user[0] == 1}
-        c.execute('UPDATE users SET online = 1 WHERE id = ?', (user[0],))
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True})
-    conn.close()
+    data = request.get_json(silent=True)
+    username = data.get('username') if isinstance(data, dict) else None
+    password = data.get('password') if isinstance(data, dict) else None
+    if not isinstance(username, str) or not isinstance(password, str):
+        return credentials_missing()
+    throttled = auth_throttled(username)
+    if throttled:
+        return throttled
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute('SELECT * FROM users WHERE username = ? OR email = ?', (username, username))
+        user = c.fetchone()
+    if user:
+        valid = password_hasher.check(user[3], password)
+        if valid is None:
+            return hasher_busy()
+        if valid:
+            if password_hasher.needs_rehash(user[3]):
+                rehashed = password_hasher.hash(password)
+                if rehashed:
+                    with get_write_db() as conn:
+                        conn.execute('UPDATE users SET password = ? WHERE id = ?', (rehashed, user[0]))
+                        conn.commit()
+            session.rotate()
+            session['user_id'] = user[0]
+            return jsonify({'success': True})
     return jsonify({'success': False, 'error': 'نام کاربری یا رمز عبور اشتباه است' if session.get('lang', 'fa') == 'fa' else 'Incorrect username or password'}), 401
 
 @app.route('/register', methods=['POST'])
@@ -635,24 +3553,29 @@ def register():
     email = request.form.get('email')
     password = request.form.get('password')
     avatar = request.files.get('avatar')
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
+    if username is None or password is None:
+        return credentials_missing()
+    throttled = auth_throttled()
+    if throttled:
+        return throttled
+    password_hash = password_hasher.hash(password)
+    if password_hash is None:
+        return hasher_busy()
     avatar_path = '/static/avatars/default.jpg'
     if avatar:
-        avatar_filename = f"{username}_{avatar.filename}"
-        avatar_path = f"/static/avatars/{avatar_filename}"
-        avatar.save(os.path.join('static/avatars', avatar_filename))
-    try:
-        c.execute('INSERT INTO users (username, email, password, avatar, bio, online) VALUES (?, ?, ?, ?, ?, ?)',
-                  (username, email, generate_password_hash(password), avatar_path, '', 1))
-        conn.commit()
-        session['user'] = {'username': username, 'email': email, 'avatar': avatar_path, 'bio': '', 'is_admin': False}
-        conn.close()
-        return jsonify({'success': True})
-    except sqlite3.IntegrityError as e:
-        conn.close()
-        error_msg = 'نام کاربری یا ایمیل قبلاً ثبت شده است' if session.get('lang', 'fa') == 'fa' else 'Username or email already exists'
-        return jsonify({'success': False, 'error': error_msg}), 400
+        avatar_path = save_avatar(avatar, username)
+    with get_write_db() as conn:
+        c = conn.cursor()
+        try:
+            c.execute('INSERT INTO users (username, email, password, avatar, bio, online) VALUES (?, ?, ?, ?, ?, ?)',
+                      (username, email, password_hash, avatar_path, '', 0))
+            conn.commit()
+            session.rotate()
+            session['user_id'] = c.lastrowid
+            return jsonify({'success': True})
+        except sqlite3.IntegrityError as e:
+            error_msg = 'نام کاربری یا ایمیل قبلاً ثبت شده است' if session.get('lang', 'fa') == 'fa' else 'Username or email already exists'
+            return jsonify({'success': False, 'error': error_msg}), 400
 
 @app.route('/set-language', methods=['POST'])
 def set_language():
@@ -661,180 +3584,638 @@ def set_language():
 
 @app.route('/profile', methods=['GET', 'POST'])
 def profile():
-    if not session.get('user'):
+    if not current_user():
         return jsonify({'success': False}), 401
     if request.method == 'POST':
         bio = request.form.get('bio')
         avatar = request.files.get('avatar')
-        conn = sqlite3.connect('chatroom.db')
-        c = conn.cursor()
-        if avatar:
-            avatar_filename = f"{session['user']['username']}_{avatar.filename}"
-            avatar_path = f"/static/avatars/{avatar_filename}"
-            avatar.save(os.path.join('static/avatars', avatar_filename))
-            c.execute('UPDATE users SET bio = ?, avatar = ? WHERE id = ?', (bio, avatar_path, session['user']['id']))
-            session['user']['avatar'] = avatar_path
-        else:
-            c.execute('UPDATE users SET bio = ? WHERE id = ?', (bio, session['user']['id']))
-        conn.commit()
-        session['user']['bio'] = bio
-        conn.close()
+        # the image work happens before the writer is taken
+        avatar_path = save_avatar(avatar, current_user()['username']) if avatar else None
+        with get_write_db() as conn:
+            c = conn.cursor()
+            if avatar_path:
+                c.execute('UPDATE users SET bio = ?, avatar = ? WHERE id = ?', (bio, avatar_path, current_user()['id']))
+            else:
+                c.execute('UPDATE users SET bio = ? WHERE id = ?', (bio, current_user()['id']))
+            conn.commit()
+        user_cache.invalidate(current_user()['id'])
         return jsonify({'success': True})
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM rooms')
-    rooms = [{'slug': r[1], 'title': r[2], 'color': r[3], 'banner': r[4]} for r in c.fetchall()]
-    conn.close()
-    return render_template_string(HTML_TEMPLATE, rooms=rooms)
+    return render_page(rooms_cache.all())
 
 @app.route('/admin', methods=['GET'])
 def admin():
-    if not session.get('user') or not session.get('user').get('is_admin'):
+    if not current_user() or not current_user().get('is_admin'):
         return jsonify({'success': False}), 403
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM rooms')
-    rooms = [{'slug': r[1], 'title': r[2], 'color': r[3], 'banner': r[4]} for r in c.fetchall()]
-    c.execute('SELECT * FROM users')
-    users = [{'id': u[0], 'username': u[1], 'email': u[2], 'online': u[6], 'avatar': u[4]} for u in c.fetchall()]
-    conn.close()
-    return render_template_string(HTML_TEMPLATE, rooms=rooms, users=users)
+    with get_replica_db() as conn:
+        c = conn.cursor()
+        c.execute('SELECT * FROM users')
+        users = [{'id': u[0], 'username': u[1], 'email': u[2], 'online': presence.is_online(u[1]), 'avatar': u[4]} for u in c.fetchall()]
+    return render_page(rooms_cache.all(), admin_users=users)
+
+def valid_retention_days(days):
+    """None (use ARCHIVE_AFTER_DAYS) or a whole number of days, 0 meaning keep forever."""
+    return days is None or (isinstance(days, int) and not isinstance(days, bool) and days >= 0)
+
+def invalid_retention_days():
+    return jsonify({'success': False, 'error': 'تعداد روز نامعتبر است' if session.get('lang', 'fa') == 'fa' else 'Invalid number of days'}), 400
+
+@app.route('/admin/rooms', methods=['POST'])
+def create_room():
+    if not current_user() or not current_user().get('is_admin'):
+        return jsonify({'success': False}), 403
+    slug = (request.json.get('slug') or '').strip()
+    title = (request.json.get('title') or '').strip()
+    if not slug or not title:
+        return jsonify({'success': False, 'error': 'عنوان و شناسه روم الزامی است' if session.get('lang', 'fa') == 'fa' else 'Room title and slug are required'}), 400
+    if not valid_retention_days(request.json.get('retentionDays')):
+        return invalid_retention_days()
+    with get_write_db() as conn:
+        c = conn.cursor()
+        try:
+            c.execute('INSERT INTO rooms (slug, title, color, banner, retention_days) VALUES (?, ?, ?, ?, ?)',
+                      (slug, title, request.json.get('color') or 'bg-gray-800 text-white', request.json.get('banner') or '',
+                       request.json.get('retentionDays')))
+        except sqlite3.IntegrityError:
+            return jsonify({'success': False, 'error': 'این شناسه قبلاً استفاده شده است' if session.get('lang', 'fa') == 'fa' else 'Slug already exists'}), 400
+        rooms_cache.invalidate(conn)
+        conn.commit()
+    return jsonify({'success': True})
 
 @app.route('/admin/rooms/<slug>', methods=['DELETE'])
 def delete_room(slug):
-    if not session.get('user') or not session.get('user').get('is_admin'):
+    if not current_user() or not current_user().get('is_admin'):
         return jsonify({'success': False}), 403
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM rooms WHERE slug = ?', (slug,))
-    conn.commit()
-    conn.close()
+    with get_write_db() as conn:
+        c = conn.cursor()
+        room = rooms_cache.get(slug)
+        c.execute('DELETE FROM rooms WHERE slug = ?', (slug,))
+        rooms_cache.invalidate(conn)
+        conn.commit()
+    if room:
+        recent_messages.discard(room['id'])
     return jsonify({'success': True})
 
+@app.route('/admin/rooms/<slug>/retention', methods=['PUT'])
+def set_room_retention(slug):
+    if not current_user() or not current_user().get('is_admin'):
+        return jsonify({'success': False}), 403
+    days = request.json.get('days')
+    if not valid_retention_days(days):
+        return invalid_retention_days()
+    with get_write_db() as conn:
+        updated = conn.execute('UPDATE rooms SET retention_days = ? WHERE slug = ?', (days, slug)).rowcount
+        conn.commit()
+    return jsonify({'success': bool(updated)}), 200 if updated else 404
+
+@app.route('/admin/cache-stats', methods=['GET'])
+def cache_stats():
+    if not current_user() or not current_user().get('is_admin'):
+        return jsonify({'success': False}), 403
+    return jsonify({'rooms': rooms_cache.stats(), 'recent_messages': recent_messages.stats()})
+
+@app.route('/admin/image-stats', methods=['GET'])
+def image_stats():
+    if not current_user() or not current_user().get('is_admin'):
+        return jsonify({'success': False}), 403
+    return jsonify(image_pipeline.stats())
+
 @app.route('/admin/users/<user_id>/ban', methods=['POST'])
 def ban_user(user_id):
-    if not session.get('user') or not session.get('user').get('is_admin'):
+    if not current_user() or not current_user().get('is_admin'):
         return jsonify({'success': False}), 403
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM users WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with get_write_db() as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        conn.commit()
+    if user_id.isdigit():
+        user_cache.invalidate(int(user_id))
+        connection_identities.revoke(int(user_id))
+    # history hides messages of deleted users
+    recent_messages.discard()
     return jsonify({'success': True})
 
 @app.route('/messages/<room_id>', methods=['GET'])
 def get_messages(room_id):
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT u.username, m.text, m.timestamp FROM messages m JOIN users u ON m.user_id = u.id JOIN rooms r ON m.room_id = r.id WHERE r.slug = ?', (room_id,))
-    messages = [{'user': r[0], 'text': r[1], 'timestamp': r[2]} for r in c.fetchall()]
-    c.execute('UPDATE messages SET read = 1 WHERE room_id = (SELECT id FROM rooms WHERE slug = ?) AND read = 0', (room_id,))
-    conn.commit()
-    conn.close()
-    return jsonify(messages)
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), 1), MESSAGES_PAGE_MAX)
+    room = rooms_cache.get(room_id)
+    if not room:
+        return jsonify([])
+    # read cursors move when the socket joins the room, keeping this route read-only
+    return jsonify(room_history(room['id'], before, limit))
 
 @app.route('/private-messages/<to_user>', methods=['GET'])
 def get_private_messages(to_user):
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT u1.username, pm.text, pm.timestamp FROM private_messages pm '
-              'JOIN users u1 ON pm.from_user_id = u1.id '
-              'JOIN users u2 ON pm.to_user_id = u2.id '
-              'WHERE (u1.username = ? AND u2.username = ?) OR (u1.username = ? AND u2.username = ?)',
-              (session['user']['username'], to_user, to_user, session['user']['username']))
-    messages = [{'from': r[0], 'text': r[1], 'timestamp': r[2]} for r in c.fetchall()]
-    c.execute('UPDATE private_messages SET read = 1 WHERE to_user_id = (SELECT id FROM users WHERE username = ?) AND from_user_id = (SELECT id FROM users WHERE username = ?) AND read = 0',
-              (session['user']['username'], to_user))
-    conn.commit()
-    conn.close()
+    before = request.args.get('before', type=int)
+    limit = min(max(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), 1), MESSAGES_PAGE_MAX)
+    me = current_user()
+    if not me:
+        return jsonify([]), 401
+    with get_db() as conn:
+        other = conn.execute('SELECT id FROM users WHERE username = ?', (to_user,)).fetchone()
+    if not other:
+        return jsonify([])
+    conversation_id = find_conversation(me['id'], other[0])
+    messages = private_history(conversation_id, before or sys.maxsize, limit) if conversation_id else []
+    if len(messages) < limit:
+        oldest = messages[0]['id'] if messages else (before or sys.maxsize)
+        messages = archived_private_messages(me['id'], other[0], oldest, limit - len(messages)) + messages
     return jsonify(messages)
 
+@app.route('/bootstrap', methods=['GET'])
+def bootstrap():
+    user = current_user()
+    if not user:
+        return jsonify({}), 401
+    return jsonify(bootstrap_data(user, request.args.get('room')))
+
 @app.route('/unread-messages', methods=['GET'])
 def get_unread_messages():
-    if not session.get('user'):
+    if not current_user():
         return jsonify({}), 401
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT r.slug, COUNT(m.id) FROM messages m JOIN rooms r ON m.room_id = r.id WHERE m.read = 0 GROUP BY r.slug')
-    unread = {r[0]: r[1] for r in c.fetchall()}
-    conn.close()
-    return jsonify(unread)
+    return jsonify(unread_counts(current_user()['id']))
+
+@app.route('/search', methods=['GET'])
+def search():
+    if not current_user():
+        return jsonify({'success': False}), 401
+    query = fts_query(request.args.get('q', ''))
+    scope = request.args.get('scope', 'all')
+    if query is None or scope not in ('all', 'rooms', 'private'):
+        return jsonify({'success': False, 'error': 'عبارت جستجو معتبر نیست' if session.get('lang', 'fa') == 'fa' else 'Invalid search query'}), 400
+    limit = min(max(request.args.get('limit', SEARCH_PAGE_SIZE, type=int), 1), MESSAGES_PAGE_MAX)
+    offset = min(max(request.args.get('offset', 0, type=int), 0), SEARCH_MAX_OFFSET)
+    room_id = with_user_id = None
+    if request.args.get('room'):
+        room = rooms_cache.get(request.args['room'])
+        if not room:
+            return jsonify({'success': True, 'results': [], 'nextOffset': None})
+        room_id = room['id']
+    if request.args.get('with'):
+        with get_db() as conn:
+            other = conn.execute('SELECT id FROM users WHERE username = ?', (request.args['with'],)).fetchone()
+        if not other:
+            return jsonify({'success': True, 'results': [], 'nextOffset': None})
+        with_user_id = other[0]
+    results = search_messages(current_user()['id'], query, scope, room_id, with_user_id, limit, offset)
+    next_offset = offset + limit if len(results) == limit and offset + limit <= SEARCH_MAX_OFFSET else None
+    return jsonify({'success': True, 'results': results, 'nextOffset': next_offset})
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
+    if not current_user():
+        return jsonify({'success': False}), 401
     file = request.files.get('file')
     room_id = request.form.get('roomId')
     if file and room_id:
-        file_filename = f"{session['user']['username']}_{file.filename}"
-        file_path = f"/static/uploads/{file_filename}"
-        file.save(os.path.join('static/uploads', file_filename))
-        return jsonify({'success': True, 'fileUrl': file_path})
+        path = _partial_upload_path(uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as out:
+            written = _copy_stream(file.stream, out, app.config['MAX_UPLOAD_SIZE'])
+        if written < 0:
+            os.remove(path)
+            return jsonify({'success': False, 'error': 'حجم فایل بیش از حد مجاز است' if session.get('lang', 'fa') == 'fa' else 'File is too large'}), 413
+        digest = _file_digest(path)
+        with get_db() as conn:
+            charge = _upload_charge(conn, current_user()['id'], digest, written)
+            over_quota = charge and _user_upload_usage(conn, current_user()['id']) + charge > app.config['USER_UPLOAD_QUOTA']
+        if over_quota:
+            os.remove(path)
+            return jsonify({'success': False, 'error': 'سهمیه آپلود شما تمام شده است' if session.get('lang', 'fa') == 'fa' else 'Upload quota exceeded'}), 413
+        file_path, _ = store_upload(path, file.filename, current_user()['id'], digest)
+        return jsonify({'success': True, 'fileUrl': file_path, 'previewUrl': queue_upload_preview(file_path)})
     return jsonify({'success': False, 'error': 'فایل یا روم انتخاب نشده' if session.get('lang', 'fa') == 'fa' else 'No file or room selected'}), 400
 
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    if not current_user():
+        return jsonify({'success': False}), 401
+    filename = request.json.get('filename') or 'file'
+    size = request.json.get('size')
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        return jsonify({'success': False, 'error': 'حجم فایل نامعتبر است' if session.get('lang', 'fa') == 'fa' else 'Invalid file size'}), 400
+    if size > app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'success': False, 'error': 'حجم فایل بیش از حد مجاز است' if session.get('lang', 'fa') == 'fa' else 'File is too large'}), 413
+    upload_id = uuid.uuid4().hex
+    with get_write_db() as conn:
+        expire_upload_sessions(conn)
+        if _user_upload_usage(conn, current_user()['id']) + size > app.config['USER_UPLOAD_QUOTA']:
+            conn.commit()
+            return jsonify({'success': False, 'error': 'سهمیه آپلود شما تمام شده است' if session.get('lang', 'fa') == 'fa' else 'Upload quota exceeded'}), 413
+        conn.execute('INSERT INTO upload_sessions (id, user_id, filename, size, created_at) VALUES (?, ?, ?, ?, ?)',
+                     (upload_id, current_user()['id'], filename, size, time.time()))
+        conn.commit()
+    path = _partial_upload_path(upload_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return jsonify({'success': True, 'uploadId': upload_id, 'offset': 0, 'chunkSize': app.config['UPLOAD_CHUNK_SIZE']})
+
+def _upload_session(upload_id):
+    if not current_user():
+        return None
+    with get_db() as conn:
+        return conn.execute('SELECT filename, size FROM upload_sessions WHERE id = ? AND user_id = ?',
+                            (upload_id, current_user()['id'])).fetchone()
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    upload = _upload_session(upload_id)
+    if not upload:
+        return jsonify({'success': False}), 404
+    try:
+        offset = os.path.getsize(_partial_upload_path(upload_id))
+    except FileNotFoundError:
+        return jsonify({'success': False}), 404
+    return jsonify({'success': True, 'offset': offset, 'size': upload[1]})
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    upload = _upload_session(upload_id)
+    if not upload:
+        return jsonify({'success': False}), 404
+    # the size check and the append happen under one lock, so two requests for the
+    # same offset (a retry racing its original, or another tab) cannot both append
+    try:
+        with _locked_partial_upload(upload_id) as out:
+            if out is None:
+                return jsonify({'success': False, 'offset': os.path.getsize(_partial_upload_path(upload_id))}), 409
+            offset = os.fstat(out.fileno()).st_size
+            if request.args.get('offset', type=int) != offset:
+                return jsonify({'success': False, 'offset': offset}), 409
+            out.seek(offset)
+            written = _copy_stream(request.stream, out, upload[1] - offset)
+            if written < 0:
+                out.truncate(offset)
+                return jsonify({'success': False, 'offset': offset, 'error': 'داده بیشتر از حجم اعلام‌شده است' if session.get('lang', 'fa') == 'fa' else 'More data than the declared file size'}), 413
+    except FileNotFoundError:
+        return jsonify({'success': False}), 404
+    return jsonify({'success': True, 'offset': offset + written})
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    upload = _upload_session(upload_id)
+    if not upload:
+        return jsonify({'success': False}), 404
+    path = _partial_upload_path(upload_id)
+    try:
+        with _locked_partial_upload(upload_id) as partial:
+            offset = os.path.getsize(path)
+            if partial is None or offset != upload[1]:
+                return jsonify({'success': False, 'offset': offset}), 409
+            file_path, digest = store_upload(path, upload[0], current_user()['id'])
+    except FileNotFoundError:
+        # a second complete, or the session expired meanwhile
+        return jsonify({'success': False}), 404
+    with get_write_db() as conn:
+        conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+        conn.commit()
+    return jsonify({'success': True, 'fileUrl': file_path, 'hash': digest, 'previewUrl': queue_upload_preview(file_path)})
+
+# سرو فایل‌های رسانه: Range، ETag و کش بلندمدت برای نام‌های هش‌شده
+# uploads are stored as <sha256><ext>, previews as <sha256>-<size>.webp
+CONTENT_ADDRESSED_NAME = re.compile(r'[0-9a-f]{64}(-\d+)?\.\w+')
+
+@app.route('/static/uploads/<path:filename>', defaults={'kind': 'uploads'})
+@app.route('/static/avatars/<path:filename>', defaults={'kind': 'avatars'})
+def serve_media(kind, filename):
+    # normalize first so x/../<name> cannot slip past, then refuse any dot segment
+    # (this also rejects a leading .. and the .partial directory of older installs)
+    filename = posixpath.normpath(filename)
+    if any(part.startswith('.') for part in filename.split('/')):
+        return jsonify({'success': False}), 404
+    immutable = kind == 'uploads' and CONTENT_ADDRESSED_NAME.fullmatch(filename)
+    accel_prefix = app.config['MEDIA_ACCEL_REDIRECT']
+    if accel_prefix:
+        # nginx streams the file itself from an internal location
+        if not os.path.isfile(safe_join(MEDIA_DIRS[kind], filename) or ''):
+            return jsonify({'success': False}), 404
+        response = app.response_class()
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{kind}/{filename}"
+    else:
+        # conditional=True answers If-None-Match/If-Modified-Since and Range requests;
+        # the body goes out through wsgi.file_wrapper (sendfile) where the server has it
+        # content-addressed names double as ETags that agree across workers and hosts
+        response = send_from_directory(os.path.abspath(MEDIA_DIRS[kind]), filename, conditional=True,
+                                       etag=os.path.splitext(filename)[0] if immutable else True)
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+# فرمت فشرده رویدادها: کلاینت‌هایی که هنگام connect درخواست کنند پیام‌ها را به صورت آرایه با
+# شناسه عددی کاربر و زمان میلی‌ثانیه‌ای می‌گیرند؛ نام و آواتار را یک بار با رویداد users می‌پرسند
+COMPACT_SUFFIX = '#compact'
+COMPACT_LOOKUP_MAX = 100
+SYSTEM_USER_ID = 0
+
+
+def socket_room(room, compact):
+    """Socket.IO room a connection joins for ``room``; compact clients get a shadow room."""
+    return room + COMPACT_SUFFIX if compact else room
+
+
+def room_targets(room):
+    """Both socket rooms of ``room``, for events that are the same in either format."""
+    return [room, room + COMPACT_SUFFIX]
+
+
+def message_text(data):
+    """The ``message`` of a send event, or None unless it is a non-empty string."""
+    text = data.get('message') if isinstance(data, dict) else None
+    return text if isinstance(text, str) and text else None
+
+
+def epoch_ms(timestamp):
+    return int(datetime.fromisoformat(timestamp).timestamp() * 1000)
+
+
+def broadcast_message(event, compact_event, room, message, user_id):
+    """Emit ``message`` to ``room``: as is to verbose clients, as [id, user id, text, ms] to compact ones."""
+    emit(event, message, to=room)
+    emit(compact_event, [message.get('id'), user_id, message['text'], epoch_ms(message['timestamp'])],
+         to=room + COMPACT_SUFFIX)
+
+# هویت هر اتصال سوکت هنگام connect از نشست گرفته می‌شود، نه از داده‌ای که کلاینت می‌فرستد
+class ConnectionIdentities:
+    """sid -> {'id', 'username', 'compact'} of the signed-in user, bound when the socket connects."""
+
+    def __init__(self):
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def bind(self, sid, user, compact=False):
+        with self._lock:
+            self._users[sid] = {'id': user['id'], 'username': user['username'], 'compact': compact}
+
+    def get(self, sid):
+        with self._lock:
+            return self._users.get(sid)
+
+    def forget(self, sid):
+        with self._lock:
+            self._users.pop(sid, None)
+
+    def revoke(self, user_id):
+        """Stop accepting events from every connection of ``user_id`` on this worker."""
+        with self._lock:
+            for sid in [sid for sid, user in self._users.items() if user['id'] == user_id]:
+                del self._users[sid]
+
+
+connection_identities = ConnectionIdentities()
+
+
+def identified(limit=None):
+    """Decorator calling ``handler(user, data)`` with the connection's identity.
+
+    Events from anonymous sockets are dropped, and so are events over the
+    ``limit`` rate limit, with a 'rateLimited' notice to the sender.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(data):
+            user = connection_identities.get(request.sid)
+            if user is None:
+                return None
+            if limit and not rate_limiter.allow(request.sid, limit):
+                emit('rateLimited', {'event': limit, 'error': 'پیام‌ها خیلی سریع ارسال می‌شوند' if session.get('lang', 'fa') == 'fa' else 'You are sending messages too fast'})
+                return None
+            return handler(user, data)
+        return wrapper
+    return decorator
+
+@socketio.on('connect')
+def on_connect(auth=None):
+    user = current_user()
+    if user:
+        connection_identities.bind(request.sid, user, compact=bool((auth or {}).get('compact')))
+        presence.connect(request.sid, {'id': user['id'], 'username': user['username'],
+                                       'avatar': avatar_url(user['avatar'], 80)})
+        emit('unreadCounts', unread_counts(user['id']))
+
+@socketio.on('disconnect')
+def on_disconnect():
+    rate_limiter.forget(request.sid)
+    connection_identities.forget(request.sid)
+    user, left = presence.disconnect(request.sid)
+    for room in left:
+        typing_tracker.stop(room, user['username'])
+        emit('userLeft', {'username': user['username']}, to=room_targets(room))
+
 @socketio.on('joinRoom')
-def on_join_room(data):
-    join_room(data['roomId'])
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT username, avatar FROM users WHERE online = 1')
-    users = [{'username': u[0], 'avatar': u[1]} for u in c.fetchall()]
-    conn.close()
-    emit('updateUsers', users, room=data['roomId'])
-    emit('message', {
+@identified()
+def on_join_room(me, data):
+    room = data['roomId']
+    # only real rooms; anything else could name another pair's private room
+    joined = rooms_cache.get(room)
+    if not joined:
+        return
+    for previous in presence.rooms_of(request.sid) - {room}:
+        leave_room(socket_room(previous, me['compact']))
+        user, last = presence.leave(previous, request.sid)
+        if last:
+            typing_tracker.stop(previous, user['username'])
+            emit('userLeft', {'username': user['username']}, to=room_targets(previous))
+    join_room(socket_room(room, me['compact']))
+    mark_room_read(me['id'], joined['id'])
+    user, first = presence.join(room, request.sid)
+    if me['compact']:
+        emit('u', [member['id'] for member in presence.members(room)])
+    else:
+        emit('updateUsers', presence.members(room))
+    if first:
+        emit('userJoined', user, to=room_targets(room), include_self=False)
+    broadcast_message('message', 'm', room, {
         'user': 'System',
-        'text': f"{data['user']['username']} joined the room!",
+        'text': f"{me['username']} joined the room!",
         'timestamp': datetime.now().isoformat()
-    }, room=data['roomId'])
+    }, SYSTEM_USER_ID)
+
+@socketio.on('markRead')
+@identified()
+def on_mark_read(me, data):
+    room = rooms_cache.get(data['roomId'])
+    if room:
+        mark_room_read(me['id'], room['id'])
 
 @socketio.on('joinPrivateRoom')
-def on_join_private_room(data):
-    room_id = f"private_{min(data['user1'], data['user2'])}_{max(data['user1'], data['user2'])}"
-    join_room(room_id)
-    emit('privateRoomJoined', {'roomId': room_id}, to=room_id)
+@identified()
+def on_join_private_room(me, data):
+    if me['username'] not in (data['user1'], data['user2']):
+        return
+    other = data['user2'] if data['user1'] == me['username'] else data['user1']
+    with get_db() as conn:
+        other = conn.execute('SELECT id FROM users WHERE username = ?', (other,)).fetchone()
+    if not other:
+        return
+    room_id = private_room(me['id'], other[0])
+    join_room(socket_room(room_id, me['compact']))
+    conversation_id = find_conversation(me['id'], other[0])
+    if conversation_id:
+        mark_private_read(conversation_id, me['id'])
+    emit('privateRoomJoined', {'roomId': room_id}, to=room_targets(room_id))
 
 @socketio.on('sendMessage')
-def on_send_message(data):
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('SELECT id FROM rooms WHERE slug = ?', (data['roomId'],))
-    room = c.fetchone()
-    if room:
-        room_id = room[0]
-        c.execute('INSERT INTO messages (room_id, user_id, text, timestamp) VALUES (?, (SELECT id FROM users WHERE username = ?), ?, ?)',
-                  (room_id, data['user']['username'], data['message'], datetime.now().isoformat()))
-        conn.commit()
-        emit('message', {
-            'user': data['user']['username'],
-            'text': data['message'],
-            'timestamp': datetime.now().isoformat()
-        }, room=data['roomId'])
-    conn.close()
+@identified(limit='sendMessage')
+def on_send_message(me, data):
+    text = message_text(data)
+    room = rooms_cache.get(data['roomId']) if text else None
+    if not room:
+        return
+    typing_tracker.stop(data['roomId'], me['username'])
+    message = {'user': me['username'], 'text': text, 'timestamp': datetime.now().isoformat()}
+    message_id = message_writer.submit(
+        'INSERT INTO messages (room_id, user_id, text, timestamp) VALUES (?, ?, ?, ?)',
+        (room['id'], me['id'], message['text'], message['timestamp']),
+        lambda row_id: recent_messages.append(room['id'], dict(message, id=row_id)))
+    broadcast_message('message', 'm', data['roomId'], dict(message, id=message_id), me['id'])
+    room_activity.add(data['roomId'])
 
 @socketio.on('sendPrivateMessage')
-def on_send_private_message(data):
-    conn = sqlite3.connect('chatroom.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO private_messages (from_user_id, to_user_id, text, timestamp) VALUES '
-              '((SELECT id FROM users WHERE username = ?), (SELECT id FROM users WHERE username = ?), ?, ?)',
-              (data['user']['username'], data['to'], data['message'], datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-    room_id = f"private_{min(data['user']['username'], data['to'])}_{max(data['user']['username'], data['to'])}"
-    emit('privateMessage', {
-        'from': data['user']['username'],
-        'text': data['message'],
-        'timestamp': datetime.now().isoformat()
-    }, room=room_id)
+@identified(limit='sendMessage')
+def on_send_private_message(me, data):
+    text = message_text(data)
+    if not text:
+        return
+    with get_db() as conn:
+        other = conn.execute('SELECT id FROM users WHERE username = ?', (data['to'],)).fetchone()
+    if not other:
+        return
+    conversation_id = open_conversation(me['id'], other[0])
+    timestamp = datetime.now().isoformat()
+    message_id = submit_private_message(conversation_id, me['id'], other[0], text, timestamp)
+    broadcast_message('privateMessage', 'pm', private_room(me['id'], other[0]), {
+        'id': message_id,
+        'from': me['username'],
+        'text': text,
+        'timestamp': timestamp
+    }, me['id'])
+
+@socketio.on('users')
+@identified()
+def on_users(me, user_ids):
+    """Acknowledge with {id: [username, avatar]} so compact clients can fill their user dictionary."""
+    users = {}
+    for user_id in user_ids[:COMPACT_LOOKUP_MAX]:
+        user = user_cache.get(user_id) if isinstance(user_id, int) else None
+        if user:
+            users[user_id] = [user['username'], avatar_url(user['avatar'], 80)]
+    return users
+
+def in_joined_room(room):
+    """True if ``room`` is a real room that the calling socket has joined, as joinRoom would allow."""
+    return bool(rooms_cache.get(room)) and presence.in_room(request.sid, room)
 
 @socketio.on('typing')
-def on_typing(data):
-    emit('typing', data, room=data['roomId'], broadcast=True)
+@identified(limit='typing')
+def on_typing(me, data):
+    if in_joined_room(data['roomId']):
+        typing_tracker.start(data['roomId'], me['username'])
 
 @socketio.on('stopTyping')
-def on_stop_typing(data):
-    emit('stopTyping', data, room=data['roomId'], broadcast=True)
+@identified()
+def on_stop_typing(me, data):
+    if in_joined_room(data['roomId']):
+        typing_tracker.stop(data['roomId'], me['username'])
+
+def exit_on_sigterm():
+    """Make SIGTERM end socketio.run() with SystemExit, as Ctrl+C does, so the message writer is flushed."""
+    if ASYNC_MODE == 'threading':
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        return
+    import greenlet
+
+    main = greenlet.getcurrent()
+
+    def handler(signum, frame):
+        # the handler runs in whichever greenlet the signal interrupted, and a Socket.IO
+        # event handler there swallows SystemExit; throw it into the greenlet running the server
+        if greenlet.getcurrent() is main:
+            sys.exit(0)
+        if ASYNC_MODE == 'gevent':
+            gevent.get_hub().loop.run_callback(main.throw, SystemExit(0))
+        else:
+            from eventlet import hubs
+            hubs.get_hub().schedule_call_global(0, main.throw, SystemExit(0))
+    signal.signal(signal.SIGTERM, handler)
+
+def run_workers(count, host, port):
+    """Start ``count`` worker processes on consecutive ports and wait for them.
+
+    Put a load balancer with sticky sessions in front of the ports (see
+    README); Socket.IO long-polling breaks if requests hop between workers.
+    """
+    if not app.config['MESSAGE_QUEUE']:
+        sys.exit('--workers > 1 needs CHATROOM_MESSAGE_QUEUE so emits reach clients on other workers')
+    if not app.config['PRESENCE_URL']:
+        print('warning: CHATROOM_PRESENCE_URL is not set, each worker will only see its own online users',
+              file=sys.stderr)
+    # only the first worker runs the archiver and the replica refresher; workers get their own
+    # session so a terminal Ctrl+C reaches them once, through the forwarding below
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--host', host, '--port', str(port + i)]
+                                + (['--no-archiver'] if i else []), start_new_session=True)
+               for i in range(count)]
+
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signum)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, forward)
+    for worker in workers:
+        worker.wait()
+
 
 if __name__ == '__main__':
-    os.makedirs('static/avatars', exist_ok=True)
-    os.makedirs('static/uploads', exist_ok=True)
-    socketio.run(app, host='0.0.0.0', port=5000)
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, listening on --port, --port + 1, ...')
+    parser.add_argument('--check-query-plans', action='store_true',
+                        help='exit non-zero if any hot query falls back to a full table scan')
+    parser.add_argument('--archive', action='store_true',
+                        help='move messages past their retention period to the archive once and exit')
+    parser.add_argument('--no-archiver', action='store_true',
+                        help='do not archive old messages or refresh the read replica in the background '
+                             '(for all but one worker)')
+    args = parser.parse_args()
+    if args.archive:
+        print(f'archived {archive_messages()} messages')
+        sys.exit(0)
+    if args.check_query_plans:
+        with get_db() as conn:
+            regressions = find_full_scans(conn)
+        for name, detail in regressions:
+            print(f'{name}: {detail}')
+        sys.exit(1 if regressions else 0)
+    move_legacy_media()
+    if args.workers > 1:
+        run_workers(args.workers, args.host, args.port)
+        sys.exit(0)
+    recent_messages.warm_up()
+    if app.config['ARCHIVE_INTERVAL'] > 0 and not args.no_archiver:
+        socketio.start_background_task(run_archiver, app.config['ARCHIVE_INTERVAL'])
+    if replica_pool is not None and app.config['READ_REPLICA_INTERVAL'] > 0 and not args.no_archiver:
+        socketio.start_background_task(run_replica_refresher, app.config['READ_REPLICA_INTERVAL'])
+    if isinstance(presence, RedisPresenceRegistry):
+        socketio.start_background_task(run_presence_heartbeat, app.config['PRESENCE_TTL'] / 3)
+        atexit.register(presence.shutdown)
+    exit_on_sigterm()
+    run_options = {}
+    if ASYNC_MODE == 'eventlet':
+        # eventlet.wsgi otherwise stops accepting at 1024 concurrent connections
+        run_options['max_size'] = app.config['MAX_CONNECTIONS']
+    elif ASYNC_MODE == 'gevent':
+        run_options['spawn'] = app.config['MAX_CONNECTIONS']
+    else:
+        # threading mode serves with Werkzeug, which Flask-SocketIO refuses unless told to;
+        # it is fine for small installs, gevent is the mode for many connections
+        run_options['allow_unsafe_werkzeug'] = True
+    socketio.run(app, host=args.host, port=args.port, **run_options)
\ No newline at end of file
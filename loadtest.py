@@ -0,0 +1,215 @@
+"""Load test for chatroomsite: many Socket.IO clients spread over one or more workers.
+
+Logs in a few accounts and opens ``--clients`` sockets round-robin over the
+``--url`` workers (the accounts' session cookies are shared between sockets,
+since logins are throttled). Every socket joins one room, and ``--senders``
+of them post messages at ``--rate`` per second. Each copy a socket receives
+is timed from send to receipt, so copies that cross workers through the
+message queue are measured end to end. Senders and receivers must share a
+clock, so run it on one machine or on hosts kept in sync with NTP.
+
+    pip install "python-socketio[asyncio_client]"
+    python loadtest.py --url http://127.0.0.1:5000 --url http://127.0.0.1:5001 --clients 2000
+
+``--spawn N`` first starts ``chatroomsite.py --workers N`` on a scratch
+database and stops it with SIGTERM afterwards. ``--fake-redis`` runs an
+in-process fakeredis server as its message queue and presence store
+(``pip install fakeredis``), so this is a cross-worker smoke test that needs
+no Redis install and exits non-zero if any copy is lost:
+
+    python loadtest.py --spawn 2 --fake-redis --clients 200 --check
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+import socketio
+
+MARKER = 'loadtest'
+PASSWORD = 'loadtest-password'
+
+
+def session_cookie(base, username):
+    """Register ``username`` (or log in when it exists) and return its ``name=value`` session cookie."""
+    form = urllib.parse.urlencode({'username': username, 'email': f'{username}@loadtest.invalid',
+                                   'password': PASSWORD}).encode()
+    try:
+        response = urllib.request.urlopen(f'{base}/register', data=form)
+    except urllib.error.HTTPError as error:
+        if error.code != 400:
+            raise
+        response = urllib.request.urlopen(urllib.request.Request(
+            f'{base}/login', data=json.dumps({'username': username, 'password': PASSWORD}).encode(),
+            headers={'Content-Type': 'application/json'}))
+    return response.headers['Set-Cookie'].split(';', 1)[0]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Run:
+    """Counters shared by every client of one load test run."""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex[:8]
+        self.sent = 0
+        self.latencies = []
+        self.connect_errors = 0
+
+    def received(self, text):
+        parts = text.split(':')
+        if len(parts) == 4 and parts[0] == MARKER and parts[1] == self.id:
+            self.latencies.append(time.time() - float(parts[2]))
+
+
+async def open_client(run, url, cookie, room, gate):
+    client = socketio.AsyncClient(reconnection=False)
+
+    @client.on('message')
+    async def on_message(message):
+        run.received(message.get('text') or '')
+
+    async with gate:
+        try:
+            await client.connect(url, headers={'Cookie': cookie}, transports=['websocket'], wait_timeout=10)
+            await client.emit('joinRoom', {'roomId': room})
+        except Exception as error:
+            run.connect_errors += 1
+            print(f'connect to {url} failed: {error}', file=sys.stderr)
+            return None
+    return client
+
+
+async def send_messages(run, client, room, rate, duration):
+    deadline = time.monotonic() + duration
+    sequence = 0
+    while time.monotonic() < deadline:
+        await client.emit('sendMessage', {'roomId': room, 'message': f'{MARKER}:{run.id}:{time.time():.6f}:{sequence}'})
+        run.sent += 1
+        sequence += 1
+        await asyncio.sleep(1 / rate)
+
+
+async def load_test(args, urls):
+    run = Run()
+    cookies = [session_cookie(urls[0], f'{MARKER}{index}') for index in range(args.accounts)]
+    gate = asyncio.Semaphore(args.connect_concurrency)
+    started = time.monotonic()
+    clients = await asyncio.gather(*(open_client(run, urls[index % len(urls)], cookies[index % len(cookies)], args.room, gate)
+                                     for index in range(args.clients)))
+    clients = [client for client in clients if client is not None]
+    print(f'{len(clients)} clients connected over {len(urls)} worker(s) in {time.monotonic() - started:.1f}s')
+    # joins are not acknowledged; give them time to land before the first message
+    await asyncio.sleep(args.settle)
+    await asyncio.gather(*(send_messages(run, client, args.room, args.rate, args.duration)
+                           for client in clients[:args.senders]))
+    await asyncio.sleep(args.drain)
+    await asyncio.gather(*(client.disconnect() for client in clients))
+    expected = run.sent * len(clients)
+    latencies = sorted(run.latencies)
+    print(f'sent {run.sent} messages, delivered {len(latencies)}/{expected} copies')
+    if latencies:
+        print('latency ms: ' + ' '.join(f'{name} {percentile(latencies, fraction) * 1000:.1f}'
+                                        for name, fraction in (('p50', .5), ('p90', .9), ('p99', .99), ('max', 1))))
+    return run.connect_errors == 0 and len(clients) == args.clients and len(latencies) == expected
+
+
+def start_fake_redis():
+    from fakeredis import TcpFakeServer
+
+    server = TcpFakeServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'redis://127.0.0.1:{server.server_address[1]}'
+
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'worker on port {port} did not start within {timeout}s')
+
+
+def spawn_workers(count, port, redis_url):
+    work = tempfile.mkdtemp(prefix='chatroom-loadtest-')
+    env = dict(os.environ, CHATROOM_DB=os.path.join(work, 'chatroom.db'), CHATROOM_LOGIN_IP_BURST='1000')
+    if redis_url:
+        env.update(CHATROOM_MESSAGE_QUEUE=f'{redis_url}/0', CHATROOM_PRESENCE_URL=f'{redis_url}/1')
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chatroomsite.py')
+    launcher = subprocess.Popen([sys.executable, script, '--workers', str(count), '--host', '127.0.0.1',
+                                 '--port', str(port)], cwd=work, env=env)
+    try:
+        for index in range(count):
+            wait_for_port(port + index, 30)
+    except Exception:
+        launcher.kill()
+        raise
+    return launcher
+
+
+def stop_workers(launcher):
+    """SIGTERM the launcher, which passes it on to its workers; True if they all exit in time."""
+    launcher.send_signal(signal.SIGTERM)
+    try:
+        return launcher.wait(timeout=30) == 0
+    except subprocess.TimeoutExpired:
+        launcher.kill()
+        print('workers did not stop within 30s of SIGTERM', file=sys.stderr)
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', 1)[0])
+    parser.add_argument('--url', action='append', help='worker base URL, repeat for each worker')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--senders', type=int, default=20, help='clients that post messages')
+    parser.add_argument('--rate', type=float, default=1, help='messages per second per sender (server allows 2)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--room', default='public')
+    parser.add_argument('--accounts', type=int, default=10, help='accounts whose sessions the clients share')
+    parser.add_argument('--connect-concurrency', type=int, default=100)
+    parser.add_argument('--settle', type=float, default=2, help='seconds between joining and sending')
+    parser.add_argument('--drain', type=float, default=3, help='seconds to wait for the last copies')
+    parser.add_argument('--spawn', type=int, default=0, metavar='N', help='start N workers on a scratch database')
+    parser.add_argument('--port', type=int, default=5600, help='first port for --spawn')
+    parser.add_argument('--fake-redis', action='store_true', help='use an in-process fakeredis with --spawn')
+    parser.add_argument('--check', action='store_true', help='exit 1 unless every copy is delivered')
+    args = parser.parse_args()
+    if args.spawn and args.url:
+        parser.error('--spawn starts its own workers; leave out --url')
+    if not args.spawn and not args.url:
+        parser.error('give --url for each worker, or --spawn N')
+    launcher = None
+    urls = args.url
+    if args.spawn:
+        if args.spawn > 1 and not args.fake_redis and not os.environ.get('CHATROOM_MESSAGE_QUEUE'):
+            parser.error('--spawn with several workers needs --fake-redis or CHATROOM_MESSAGE_QUEUE')
+        launcher = spawn_workers(args.spawn, args.port, start_fake_redis() if args.fake_redis else None)
+        urls = [f'http://127.0.0.1:{args.port + index}' for index in range(args.spawn)]
+    ok = False
+    try:
+        ok = asyncio.run(load_test(args, urls))
+    finally:
+        if launcher is not None:
+            ok = stop_workers(launcher) and ok
+    sys.exit(0 if ok or not args.check else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""CPU-heavy jobs that chatroomsite.py runs in separate processes.
+
+The pools are spawned, and each spawned process imports this module to
+unpickle the job it is handed, so importing it must stay cheap and free of
+side effects: no app, no database, no monkey patching.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+def spawn_pool(workers):
+    # forking a process that has eventlet tpool or writer threads running can
+    # deadlock the child; spawn starts clean (forkserver is unavailable under eventlet)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def hash_password(password, method):
+    return generate_password_hash(password, method)
+
+
+def check_password(pwhash, password):
+    return check_password_hash(pwhash, password)
+
+
+def image_variant_path(path, size):
+    return f'{os.path.splitext(path)[0]}-{size}.webp'
+
+
+def make_image_variants(path, sizes, crop):
+    """Write a WebP of ``path`` for each size, without EXIF or other metadata."""
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as img:
+        img = ImageOps.exif_transpose(img)
+        img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+        for size in sizes:
+            if crop:
+                variant = ImageOps.fit(img, (size, size), Image.LANCZOS)
+            else:
+                variant = img.copy()
+                variant.thumbnail((size, size), Image.LANCZOS)
+            target = image_variant_path(path, size)
+            variant.save(target + '.tmp', 'WEBP', quality=80, method=4)
+            os.replace(target + '.tmp', target)
+    return len(sizes)
@@ -0,0 +1,22 @@
+"""chatroomsite configures itself and opens its database on import, so the
+scratch directory and CHATROOM_* settings are in place before any test
+module imports it."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK = tempfile.mkdtemp(prefix='chatroom-tests-')
+
+os.chdir(WORK)
+os.environ['CHATROOM_DB'] = os.path.join(WORK, 'chatroom.db')
+os.environ['CHATROOM_LOGIN_IP_BURST'] = '1000000'
+sys.path.insert(0, REPO)
+
+
+@pytest.fixture(scope='session')
+def cs():
+    import chatroomsite
+    return chatroomsite
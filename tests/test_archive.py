@@ -0,0 +1,72 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+
+@pytest.fixture
+def room(cs, monkeypatch):
+    """A room with a one-day retention and an author, archived in batches of 3."""
+    monkeypatch.setitem(cs.app.config, 'ARCHIVE_BATCH_SIZE', 3)
+    slug = f'archive-{datetime.now().timestamp()}'
+    with cs.get_write_db() as conn:
+        room_id = conn.execute("INSERT INTO rooms (slug, title, retention_days) VALUES (?, 'Archive', 1)", (slug,)).lastrowid
+        user_id = conn.execute("INSERT INTO users (username, email, password) VALUES (?, ?, '')",
+                               (slug, f'{slug}@test.invalid')).lastrowid
+        cs.rooms_cache.invalidate(conn)
+        conn.commit()
+    yield room_id, user_id
+    with cs.get_write_db() as conn:
+        conn.execute('UPDATE rooms SET retention_days = 0 WHERE id = ?', (room_id,))
+        conn.commit()
+
+
+def insert_messages(cs, room_id, user_id, timestamps):
+    with cs.get_write_db() as conn:
+        ids = [conn.execute('INSERT INTO messages (room_id, user_id, text, timestamp) VALUES (?, ?, ?, ?)',
+                            (room_id, user_id, f'message {index}', timestamp)).lastrowid
+               for index, timestamp in enumerate(timestamps)]
+        conn.commit()
+    return ids
+
+
+def hot_ids(cs, room_id):
+    with cs.get_db() as conn:
+        return [row[0] for row in conn.execute('SELECT id FROM messages WHERE room_id = ? ORDER BY id', (room_id,))]
+
+
+def test_rows_without_a_usable_timestamp_do_not_stop_archiving(cs, room):
+    room_id, user_id = room
+    now = datetime.now()
+    old = (now - timedelta(days=10)).isoformat()
+    future = (now + timedelta(days=10)).isoformat()
+    # a full batch of rows that must stay, in front of rows that must go
+    kept = insert_messages(cs, room_id, user_id, [None, future, None, future])
+    moved = insert_messages(cs, room_id, user_id, [old] * 7)
+    kept += insert_messages(cs, room_id, user_id, [now.isoformat()])
+    assert cs.archive_messages(now) == len(moved)
+    assert hot_ids(cs, room_id) == kept
+    assert [message['id'] for message in cs.archived_room_messages(room_id, kept[-1], 20)] == moved
+
+
+def test_room_history_reads_the_archive_only_for_archived_rooms(cs, room, monkeypatch):
+    room_id, user_id = room
+    now = datetime.now()
+    moved = insert_messages(cs, room_id, user_id, [(now - timedelta(days=10)).isoformat()] * 2)
+    kept = insert_messages(cs, room_id, user_id, [now.isoformat()])
+    cs.recent_messages.discard(room_id)
+    reads = []
+    read_archive = cs._read_archive
+    monkeypatch.setattr(cs, '_read_archive', lambda *args: reads.append(args) or read_archive(*args))
+
+    assert [message['id'] for message in cs.room_history(room_id)] == moved + kept
+    assert reads == []   # nothing archived yet: the short page never opens an archive file
+    # and once the recent buffer and the archived rooms are loaded, a page needs no query at all
+    monkeypatch.setattr(cs.archived_rooms, 'check_interval', 60)
+    with monkeypatch.context() as patched:
+        patched.setattr(cs, 'get_db', None)
+        assert [message['id'] for message in cs.room_history(room_id)] == moved + kept
+
+    cs.archive_messages(now)
+    cs.recent_messages.discard(room_id)
+    assert [message['id'] for message in cs.room_history(room_id)] == moved + kept
+    assert len(reads) == 1
@@ -0,0 +1,34 @@
+import pytest
+
+
+@pytest.fixture(scope='module')
+def account(cs):
+    client = cs.app.test_client()
+    assert client.post('/register', data={'username': 'loginuser', 'email': 'loginuser@test.invalid',
+                                          'password': 'secret1'}).status_code == 200
+    return 'loginuser', 'secret1'
+
+
+def test_login(cs, account):
+    username, password = account
+    client = cs.app.test_client()
+    assert client.post('/login', json={'username': username, 'password': 'wrong'}).status_code == 401
+    assert client.post('/login', json={'username': username, 'password': password}).status_code == 200
+
+
+@pytest.mark.parametrize('body', [
+    {'username': ['loginuser'], 'password': 'secret1'},
+    {'username': 7, 'password': 'secret1'},
+    {'username': 'loginuser', 'password': {'x': 1}},
+    {'username': 'loginuser'},
+    {},
+    ['loginuser', 'secret1'],
+    'loginuser',
+])
+def test_login_rejects_malformed_credentials(cs, account, body):
+    assert cs.app.test_client().post('/login', json=body).status_code == 400
+
+
+def test_register_without_password_is_rejected(cs):
+    response = cs.app.test_client().post('/register', data={'username': 'nopassword', 'email': 'np@test.invalid'})
+    assert response.status_code == 400
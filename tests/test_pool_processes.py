@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+
+from conftest import REPO
+
+
+def run_python(code, cwd, **env):
+    return subprocess.run([sys.executable, '-c', code], cwd=cwd, env={**os.environ, **env},
+                          capture_output=True, text=True, timeout=120)
+
+
+def test_offload_imports_nothing_of_the_app(tmp_path):
+    result = run_python(f'import sys; sys.path.insert(0, {REPO!r}); import offload; '
+                        'print(sorted(m for m in sys.modules if m.split(".")[0] in '
+                        '("chatroomsite", "flask", "flask_socketio", "sqlite3", "eventlet", "gevent")))', tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[]'
+
+
+def test_pool_process_rerunning_the_script_leaves_the_database_alone(tmp_path):
+    # what multiprocessing's spawn does in every pool process when chatroomsite.py is the main script
+    database = tmp_path / 'chatroom.db'
+    result = run_python(f'import runpy, socket, sys; sys.path.insert(0, {REPO!r}); '
+                        f'runpy.run_path({os.path.join(REPO, "chatroomsite.py")!r}, run_name="__mp_main__"); '
+                        'print(socket.socket.__module__)',
+                        tmp_path, CHATROOM_DB=str(database), CHATROOM_ASYNC_MODE='gevent')
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == 'socket'   # not monkey patched
+    assert not database.exists()
@@ -0,0 +1,41 @@
+import sys
+import time
+
+import pytest
+
+
+@pytest.fixture
+def admin(cs):
+    with cs.get_write_db() as conn:
+        conn.execute("INSERT OR IGNORE INTO users (id, username, email, password) VALUES (1, 'admin', 'admin@test.invalid', '')")
+        conn.commit()
+    client = cs.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+    yield client
+    cs.profiler.stop()
+
+
+def samplers(cs):
+    return [frame for frame in sys._current_frames().values()
+            if frame.f_code is cs.SamplingProfiler._run.__code__]
+
+
+@pytest.mark.parametrize('interval', ['10', None, True, [10], {'ms': 10}, float('inf')])
+def test_start_rejects_a_malformed_interval(cs, admin, interval):
+    response = admin.post('/admin/profiler', json={'action': 'start', 'intervalMs': interval})
+    assert response.status_code == 400
+    assert not cs.profiler.running
+
+
+def test_a_restart_leaves_one_sampler(cs, admin):
+    for _ in range(5):
+        assert admin.post('/admin/profiler', json={'action': 'start', 'intervalMs': 100}).json['running']
+        assert not admin.post('/admin/profiler', json={'action': 'stop'}).json['running']
+    assert admin.post('/admin/profiler', json={'action': 'start', 'intervalMs': 100}).json['running']
+    time.sleep(0.3)   # every stopped sampler wakes up once and sees its run is over
+    assert len(samplers(cs)) == 1
+    assert cs.profiler.samples >= 1
+    admin.post('/admin/profiler', json={'action': 'stop'})
+    time.sleep(0.3)
+    assert samplers(cs) == []
@@ -0,0 +1,26 @@
+import sqlite3
+
+import pytest
+
+
+def migrated_database(cs, path):
+    conn = sqlite3.connect(path)
+    cs._create_schema(conn)
+    cs.migrate(conn)
+    return conn
+
+
+def test_hot_queries_use_indexes(cs, tmp_path):
+    conn = migrated_database(cs, tmp_path / 'fresh.db')
+    assert cs.find_full_scans(conn) == []
+
+
+@pytest.mark.parametrize('index, query', [
+    ('idx_messages_room_id', 'room_history'),
+    ('idx_messages_room_id', 'unread_count'),
+    ('idx_private_messages_conversation', 'private_history'),
+])
+def test_dropped_index_is_reported(cs, tmp_path, index, query):
+    conn = migrated_database(cs, tmp_path / 'fresh.db')
+    conn.execute(f'DROP INDEX {index}')
+    assert query in dict(cs.find_full_scans(conn))
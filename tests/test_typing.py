@@ -0,0 +1,30 @@
+import pytest
+
+
+@pytest.fixture
+def socket(cs):
+    client = cs.app.test_client()
+    assert client.post('/register', data={'username': 'typist', 'email': 'typist@test.invalid',
+                                          'password': 'secret1'}).status_code in (200, 400)
+    assert client.post('/login', json={'username': 'typist', 'password': 'secret1'}).status_code == 200
+    socket = cs.socketio.test_client(cs.app, flask_test_client=client)
+    yield socket
+    socket.disconnect()
+
+
+def typists(cs, room):
+    return set(cs.typing_tracker._rooms.get(room, {}))
+
+
+@pytest.mark.parametrize('room', ['public', 'no-such-room', '1-2'])
+def test_typing_outside_a_joined_room_is_ignored(cs, socket, room):
+    socket.emit('typing', {'roomId': room})
+    assert 'typist' not in typists(cs, room)
+
+
+def test_typing_in_the_joined_room(cs, socket):
+    socket.emit('joinRoom', {'roomId': 'public'})
+    socket.emit('typing', {'roomId': 'public'})
+    assert 'typist' in typists(cs, 'public')
+    socket.emit('stopTyping', {'roomId': 'public'})
+    assert 'typist' not in typists(cs, 'public')
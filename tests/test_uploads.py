@@ -0,0 +1,157 @@
+import functools
+import hashlib
+import io
+import itertools
+import os
+import tracemalloc
+
+import pytest
+
+# size of the synthetic files; CHATROOM_TEST_UPLOAD_MB=1000 for a longer run
+UPLOAD_SIZE = int(os.environ.get('CHATROOM_TEST_UPLOAD_MB', '300')) * 1024 * 1024
+# far below the file size: only the read buffer and request bookkeeping may stay alive
+PEAK_LIMIT = 16 * 1024 * 1024
+
+_users = itertools.count()
+
+
+@functools.lru_cache()
+def random_block(seed):
+    return hashlib.sha256(seed).digest() * 32768   # 1 MiB
+
+
+class SyntheticFile(io.RawIOBase):
+    """Bytes ``start`` to ``start + size`` of an endless repeated random block, made on demand.
+
+    Seekable, because the test client measures request bodies by seeking,
+    but never held in memory as a whole.
+    """
+
+    def __init__(self, size, seed=b'', start=0):
+        # shared, since the test client keeps every request's input stream alive
+        self.block = random_block(seed)
+        self.start = start
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        self.position = max(0, min(self.size, base + offset))
+        return self.position
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.size - self.position)
+        target = memoryview(buffer)
+        filled = 0
+        while filled < n:
+            skip = (self.start + self.position + filled) % len(self.block)
+            piece = min(n - filled, len(self.block) - skip)
+            target[filled:filled + piece] = self.block[skip:skip + piece]
+            filled += piece
+        self.position += n
+        return n
+
+
+def synthetic_digest(size, seed=b''):
+    digest = hashlib.sha256()
+    source = SyntheticFile(size, seed)
+    for chunk in iter(lambda: source.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+@pytest.fixture
+def client(cs):
+    client = cs.app.test_client()
+    name = f'uploader{next(_users)}'
+    assert client.post('/register', data={'username': name, 'email': f'{name}@test.invalid',
+                                          'password': 'secret1'}).status_code == 200
+    return client
+
+
+def chunked_upload(client, size, seed=b''):
+    created = client.post('/uploads', json={'filename': 'big.bin', 'size': size}).get_json()
+    offset = 0
+    while offset < size:
+        chunk = SyntheticFile(min(created['chunkSize'], size - offset), seed, offset)
+        response = client.put(f"/uploads/{created['uploadId']}?offset={offset}", input_stream=chunk)
+        assert response.status_code == 200, response.get_json()
+        offset = response.get_json()['offset']
+    return created['uploadId'], client.post(f"/uploads/{created['uploadId']}/complete").get_json()
+
+
+def test_chunked_upload_memory_stays_bounded(cs, client):
+    tracemalloc.start()
+    try:
+        _, done = chunked_upload(client, UPLOAD_SIZE)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert done['success'] and done['hash'] == synthetic_digest(UPLOAD_SIZE)
+    assert os.path.getsize(cs.media_path(done['fileUrl'])) == UPLOAD_SIZE
+    assert peak < PEAK_LIMIT
+
+
+def test_single_request_upload_memory_stays_bounded(client):
+    tracemalloc.start()
+    try:
+        response = client.post('/upload', data={'roomId': 'public', 'file': (SyntheticFile(UPLOAD_SIZE, b'single'), 'big.bin')})
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert response.get_json()['success']
+    assert peak < PEAK_LIMIT
+
+
+def test_identical_files_are_stored_once_and_charged_once(cs, client, monkeypatch):
+    monkeypatch.setitem(cs.app.config, 'USER_UPLOAD_QUOTA', 1500)
+    urls = [client.post('/upload', data={'roomId': 'public', 'file': (io.BytesIO(b'x' * 1000), 'same.txt')}).get_json()
+            for _ in range(3)]
+    assert all(url['success'] for url in urls)
+    assert len({url['fileUrl'] for url in urls}) == 1
+    # 1000 bytes are stored for this user; another 1000 distinct bytes do not fit
+    response = client.post('/upload', data={'roomId': 'public', 'file': (io.BytesIO(b'y' * 1000), 'other.txt')})
+    assert response.status_code == 413
+
+
+@pytest.mark.parametrize('size', [True, 0, -5, 1.5, '10'])
+def test_invalid_declared_size_is_rejected(client, size):
+    assert client.post('/uploads', json={'filename': 'f', 'size': size}).status_code == 400
+
+
+def test_finished_or_expired_upload_is_404(cs, client):
+    upload_id, done = chunked_upload(client, 1000, b'twice')
+    assert done['success']
+    assert client.post(f'/uploads/{upload_id}/complete').status_code == 404
+    assert client.get(f'/uploads/{upload_id}').status_code == 404
+
+    created = client.post('/uploads', json={'filename': 'gone.bin', 'size': 10}).get_json()
+    os.remove(cs._partial_upload_path(created['uploadId']))
+    assert client.get(f"/uploads/{created['uploadId']}").status_code == 404
+    assert client.put(f"/uploads/{created['uploadId']}?offset=0", data=b'0123456789').status_code == 404
+    assert client.post(f"/uploads/{created['uploadId']}/complete").status_code == 404
+
+
+def test_media_is_only_reachable_through_serve_media(cs, client, monkeypatch):
+    # as when the app runs from its own directory, where Flask serves static/
+    monkeypatch.setattr(cs.app, 'static_folder', os.path.abspath('static'))
+    url = client.post('/upload', data={'roomId': 'public', 'file': (io.BytesIO(b'<b>hi</b>'), 'page.html')}).get_json()['fileUrl']
+    served = client.get(url)
+    assert served.status_code == 200 and served.headers['X-Content-Type-Options'] == 'nosniff'
+    assert client.get(url.replace('/static/', '/static/./')).status_code == 404
+
+    created = client.post('/uploads', json={'filename': 'partial.bin', 'size': 10}).get_json()
+    assert client.put(f"/uploads/{created['uploadId']}?offset=0", data=b'01234').status_code == 200
+    partial = os.path.relpath(cs._partial_upload_path(created['uploadId']))
+    for path in (f'/static/./uploads/.partial/{created["uploadId"]}', f'/static/uploads/.partial/{created["uploadId"]}',
+                 f'/static/uploads/../../{partial}', f'/static/./../{partial}'):
+        assert client.get(path).status_code == 404, path